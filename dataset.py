@@ -25,7 +25,7 @@ from __future__ import unicode_literals
 import os
 from keyword import kwlist
 from collections import namedtuple
-from itertools import compress
+from itertools import compress, islice
 from functools import partial
 from inspect import getargspec
 
@@ -34,7 +34,8 @@ from compat import unicode, uni, ifilter, imap, izip, iteritems, str_types, buil
 import blob
 from extras import DotDict, job_params
 from jobid import resolve_jobid_filename
-from gzwrite import typed_writer
+from gzwrite import typed_writer, parse_compression, recompress, dict_types
+from gzutil import GzInt32
 
 kwlist = set(kwlist)
 # Add some python3 keywords
@@ -42,7 +43,7 @@ kwlist.update({'False', 'None', 'True', 'nonlocal', 'async', 'await'})
 iskeyword = frozenset(kwlist).__contains__
 
 # A dataset is defined by a pickled DotDict containing at least the following (all strings are unicode):
-#     version = (2, 2,),
+#     version = (2, 6,),
 #     filename = "filename" or None,
 #     hashlabel = "column name" or None,
 #     caption = "caption",
@@ -61,12 +62,28 @@ iskeyword = frozenset(kwlist).__contains__
 #     min = minimum value in this dataset or None
 #     max = maximum value in this dataset or None
 #     offsets = (offset, per, slice) or None for non-merged slices.
+#     compression = "gzip" (the default), "none" (only for fixed width types,
+#         see sourcedata.raw_types), "bz2" or "lzma", optionally with a level
+#         like "gzip:9" (see gzwrite.parse_compression).
+#         (Added in version 2.3, older columns are "gzip".)
+#     blocks = (block_rows, [[offset, per, block], per, slice]) or None.
+#         Every block_rows values are a separate stream (gzip member)
+#         at these offsets from the start of the slice, so reading can
+#         start at any block. (Added in version 2.4.)
+#     block_minmax = [[(min, max, has None) per block] per slice] or None,
+#         for blocked columns of types with min and max. (Added in version 2.5.)
+#     dictionary = [[values] or None per slice] or None. For compression "dict"
+#         the values of the codes in each slice. Slices without a dictionary
+#         (too many values) are lines like for "gzip". (Added in version 2.6.)
 #
 # Going from a DatasetColumn to a filename is like this for version 2 datasets:
 #     jid, path = dc.location.split('/', 1)
 #     if dc.offsets:
 #         resolve_jobid_filename(jid, path)
 #         seek to dc.offsets[sliceno], read only ds.lines[sliceno] values.
+#         (The offsets are in the file, so with compression "none" the values
+#         are dc.offsets[sliceno] bytes in, and other compressions have a
+#         separate stream for each slice.)
 #     else:
 #         resolve_jobid_filename(jid, path % sliceno)
 # There is a ds.column_filename function to do this for you (not the seeking, obviously).
@@ -97,7 +114,21 @@ def _dsid(t):
 # If we want to add fields to later versions, using a versioned name will
 # allow still loading the old versions without messing with the constructor.
 _DatasetColumn_2_0 = namedtuple('_DatasetColumn_2_0', 'type name location min max offsets')
-DatasetColumn = _DatasetColumn_2_0
+_DatasetColumn_2_3 = namedtuple('_DatasetColumn_2_3', 'type name location min max offsets compression')
+_DatasetColumn_2_4 = namedtuple('_DatasetColumn_2_4', 'type name location min max offsets compression blocks')
+_DatasetColumn_2_5 = namedtuple('_DatasetColumn_2_5', 'type name location min max offsets compression blocks block_minmax')
+_DatasetColumn_2_6 = namedtuple('_DatasetColumn_2_6', 'type name location min max offsets compression blocks block_minmax dictionary')
+DatasetColumn = _DatasetColumn_2_6
+
+# Values for fields that older DatasetColumns don't have.
+_dc_defaults = dict(compression='gzip', blocks=None, block_minmax=None, dictionary=None)
+
+def _dc_upgrade(dc):
+	if isinstance(dc, DatasetColumn):
+		return dc
+	fields = dict(_dc_defaults)
+	fields.update(dc._asdict())
+	return DatasetColumn(**fields)
 
 class _New_dataset_marker(unicode): pass
 _new_dataset_marker = _New_dataset_marker('new')
@@ -158,7 +189,7 @@ class Dataset(unicode):
 		obj.name = uni(name or 'default')
 		if jobid is _new_dataset_marker:
 			obj._data = DotDict({
-				'version': (2, 2,),
+				'version': (2, 6,),
 				'filename': None,
 				'hashlabel': None,
 				'caption': '',
@@ -172,7 +203,7 @@ class Dataset(unicode):
 			obj.jobid = jobid
 			obj._data = DotDict(_ds_load(obj))
 			assert obj._data.version[0] == 2 and obj._data.version[1] >= 2, "%s/%s: Unsupported dataset pickle version %r" % (jobid, name, obj._data.version,)
-			obj._data.columns = dict(obj._data.columns)
+			obj._data.columns = {k: _dc_upgrade(dc) for k, dc in obj._data.columns.items()}
 		return obj
 
 	# Look like a string after pickling
@@ -231,12 +262,30 @@ class Dataset(unicode):
 		self.name = uni(name)
 		self._save()
 
-	def _column_iterator(self, sliceno, col, **kw):
-		from sourcedata import type2iter
+	def _column_iterator(self, sliceno, col, rows=None, **kw):
+		from sourcedata import typed_reader, raw_types
 		dc = self.columns[col]
-		mkiter = partial(type2iter[dc.type], **kw)
 		def one_slice(sliceno):
+			mkiter = partial(typed_reader(dc.type, dc.compression, dc.dictionary and dc.dictionary[sliceno]), **kw)
 			fn = self.column_filename(col, sliceno)
+			if rows:
+				start, stop, _ = slice(*rows).indices(self.lines[sliceno])
+				if start >= stop:
+					return iter(())
+				seek = dc.offsets[sliceno] if dc.offsets else 0
+				skip = start
+				if dc.compression == 'none':
+					seek += start * raw_types[dc.type][0]
+					skip = 0
+				elif dc.blocks:
+					block_rows, blocks = dc.blocks
+					block = start // block_rows
+					seek += blocks[sliceno][block]
+					skip -= block * block_rows
+				it = mkiter(fn, seek=seek, max_count=stop - start + skip)
+				if skip:
+					next(islice(it, skip - 1, None))
+				return it
 			if dc.offsets:
 				return mkiter(fn, seek=dc.offsets[sliceno], max_count=self.lines[sliceno])
 			else:
@@ -248,12 +297,12 @@ class Dataset(unicode):
 		else:
 			return one_slice(sliceno)
 
-	def _iterator(self, sliceno, columns=None):
+	def _iterator(self, sliceno, columns=None, rows=None):
 		res = []
 		not_found = []
 		for col in columns or sorted(self.columns):
 			if col in self.columns:
-				res.append(self._column_iterator(sliceno, col))
+				res.append(self._column_iterator(sliceno, col, rows))
 			else:
 				not_found.append(col)
 		assert not not_found, 'Columns %r not found in %s/%s' % (not_found, self.jobid, self.name)
@@ -263,6 +312,36 @@ class Dataset(unicode):
 		from g import SLICES
 		return compress(it, self._column_iterator(None, hashlabel, hashfilter=(sliceno, SLICES)))
 
+	def _range_rows(self, sliceno, columns, colname, bottom, top, rows=None):
+		"""[(start, stop)] of the rows in sliceno that can have
+		bottom <= colname < top according to the block minmax, or None
+		if that's not known (or it's not worth it)."""
+		dc = self.columns[colname]
+		if not dc.block_minmax:
+			return None
+		for n in set(columns) | {colname}:
+			c = self.columns.get(n)
+			if not c or not (c.blocks or c.compression == 'none'):
+				# (Each run would be read from the start of the slice.)
+				return None
+		lines = self.lines[sliceno]
+		start, stop, _ = slice(*rows).indices(lines) if rows else (0, lines, 1)
+		block_rows = dc.blocks[0]
+		res = []
+		for ix, (lo, hi, has_none) in enumerate(dc.block_minmax[sliceno]):
+			if lo is not None and ((top is not None and lo >= top and not (has_none and bottom is None)) or (bottom is not None and hi < bottom)):
+				# (None < top, so None values are in range without a bottom.)
+				continue
+			b_start = max(start, ix * block_rows)
+			b_stop = min(stop, (ix + 1) * block_rows)
+			if b_start >= b_stop:
+				continue
+			if res and res[-1][1] == b_start:
+				res[-1] = (res[-1][0], b_stop)
+			else:
+				res.append((b_start, b_stop))
+		return res
+
 	def column_filename(self, colname, sliceno=None):
 		dc = self.columns[colname]
 		jid, name = dc.location.split('/', 1)
@@ -273,6 +352,39 @@ class Dataset(unicode):
 				sliceno = '%s'
 			return resolve_jobid_filename(jid, name % (sliceno,))
 
+	def column_dictionary(self, colname, sliceno):
+		"""For dictionary encoded columns: The values in sliceno (by
+		code, see column_codes), or None if that slice isn't encoded."""
+		dc = self.columns[colname]
+		assert dc.compression.startswith('dict'), "%s in %s is not dictionary encoded" % (colname, self,)
+		return dc.dictionary[sliceno]
+
+	def column_codes(self, colname, sliceno):
+		"""For dictionary encoded columns: Iterator over the codes (index
+		in column_dictionary, or None for None) in sliceno. Filtering or
+		grouping on these is faster than on the values."""
+		dc = self.columns[colname]
+		assert self.column_dictionary(colname, sliceno) is not None, "%s slice %d in %s is not dictionary encoded" % (colname, sliceno, self,)
+		fn = self.column_filename(colname, sliceno)
+		if dc.offsets:
+			return GzInt32(fn, seek=dc.offsets[sliceno], max_count=self.lines[sliceno])
+		else:
+			return GzInt32(fn)
+
+	def column_mmap(self, colname, sliceno):
+		"""For uncompressed columns: (mmap, start, stop) for the values
+		of this slice. Close the mmap when you are done with it."""
+		from mmap import mmap, PROT_READ
+		from sourcedata import raw_types
+		dc = self.columns[colname]
+		assert dc.compression == 'none', "%s in %s is %s compressed" % (colname, self, dc.compression,)
+		start = dc.offsets[sliceno] if dc.offsets else 0
+		stop = start + self.lines[sliceno] * raw_types[dc.type][0]
+		with open(self.column_filename(colname, sliceno), 'rb') as fh:
+			size = os.fstat(fh.fileno()).st_size
+			assert stop <= size, "%s is only %d bytes" % (fh.name, size,)
+			return mmap(fh.fileno(), size, prot=PROT_READ) if size else None, start, stop
+
 	def chain(self, length=-1, reverse=False, stop_ds=None):
 		if stop_ds:
 			# resolve all formats to the same format
@@ -293,12 +405,12 @@ class Dataset(unicode):
 		chain = self.chain(length, reverse, stop_ds)
 		return self.iterate_list(sliceno, columns, chain, range=range, sloppy_range=sloppy_range, hashlabel=hashlabel, pre_callback=pre_callback, post_callback=post_callback, filters=filters, translators=translators, status_reporting=status_reporting)
 
-	def iterate(self, sliceno, columns=None, hashlabel=None, filters=None, translators=None, status_reporting=True):
+	def iterate(self, sliceno, columns=None, hashlabel=None, filters=None, translators=None, status_reporting=True, rows=None):
 		"""Iterate just this dataset. See .iterate_list for details."""
-		return self.iterate_list(sliceno, columns, [self], hashlabel=hashlabel, filters=filters, translators=translators, status_reporting=status_reporting)
+		return self.iterate_list(sliceno, columns, [self], hashlabel=hashlabel, filters=filters, translators=translators, status_reporting=status_reporting, rows=rows)
 
 	@staticmethod
-	def iterate_list(sliceno, columns, datasets, range=None, sloppy_range=False, hashlabel=None, pre_callback=None, post_callback=None, filters=None, translators=None, status_reporting=True):
+	def iterate_list(sliceno, columns, datasets, range=None, sloppy_range=False, hashlabel=None, pre_callback=None, post_callback=None, filters=None, translators=None, status_reporting=True, rows=None):
 		"""Iterator over the specified columns from datasets
 		(iterable of dataset-specifiers, or single dataset-specifier).
 		callbacks are called before and after each dataset is iterated.
@@ -333,6 +445,16 @@ class Dataset(unicode):
 		only rows where start <= colvalue < stop will be returned.
 		If you set sloppy_range=True you may get all rows from datasets that
 		contain any rows you asked for. (This can be faster.)
+		Datasets written with block_rows (see DatasetWriter) also know the
+		min and max of each block, and blocks outside the range are not
+		read at all. (With sloppy_range you get all rows of the blocks
+		that are read.)
+
+		rows limits which lines of each slice you see, (start, stop) like a
+		python slice, e.g. to split a big slice over several processes.
+		This needs a sliceno and can't be used with rehashing. Datasets
+		written with block_rows (see DatasetWriter) only decompress from
+		the block that start is in, others from the start of the slice.
 
 		status_reporting should normally be left as True, which will give you
 		information about this iteration in ^T, but there is one case where you
@@ -356,6 +478,7 @@ class Dataset(unicode):
 			want_tuple = True
 		to_iter = []
 		if sliceno is None:
+			assert not rows, "rows needs a sliceno"
 			from g import SLICES
 		if range:
 			assert len(range) == 1, "Specify exactly one range column."
@@ -377,16 +500,15 @@ class Dataset(unicode):
 			else:
 				if hashlabel and d.hashlabel != hashlabel:
 					assert hashlabel in d.columns, "Can't rehash %s on non-existant column %s" % (d, hashlabel,)
+					assert not rows, "Can't use rows when rehashing %s" % (d,)
 					rehash = hashlabel
 				else:
 					rehash = False
 				to_iter.append((d, sliceno, rehash,))
 		filter_func = Dataset._resolve_filters(columns, filters, want_tuple)
 		translation_func, translators = Dataset._resolve_translators(columns, translators)
-		if sloppy_range:
-			range = None
 		from itertools import chain
-		return chain.from_iterable(Dataset._iterate_datasets(to_iter, columns, pre_callback, post_callback, filter_func, translation_func, translators, want_tuple, range, status_reporting))
+		return chain.from_iterable(Dataset._iterate_datasets(to_iter, columns, pre_callback, post_callback, filter_func, translation_func, translators, want_tuple, range, sloppy_range, status_reporting, rows))
 
 	@staticmethod
 	def _resolve_filters(columns, filters, want_tuple):
@@ -432,7 +554,7 @@ class Dataset(unicode):
 			return None, res
 
 	@staticmethod
-	def _iterate_datasets(to_iter, columns, pre_callback, post_callback, filter_func, translation_func, translators, want_tuple, range, status_reporting):
+	def _iterate_datasets(to_iter, columns, pre_callback, post_callback, filter_func, translation_func, translators, want_tuple, range, sloppy_range, status_reporting, rows):
 		skip_ds = None
 		def argfixup(func, is_post):
 			if func:
@@ -481,6 +603,34 @@ class Dataset(unicode):
 			msg_head = 'Iterating %s to %s' % (fmt_dsname(*to_iter[0]), fmt_dsname(*to_iter[-1]),)
 			def update_status(update, ix, d, sliceno, rehash):
 				update('%s, %d/%d (%s)' % (msg_head, ix, len(to_iter), fmt_dsname(d, sliceno, rehash)))
+		def mkiter(d, sliceno, rehash, rows):
+			it = d._iterator(None if rehash else sliceno, columns, rows)
+			for ix, trans in translators.items():
+				it[ix] = imap(trans, it[ix])
+			if want_tuple:
+				it = izip(*it)
+			else:
+				it = it[0]
+			if rehash:
+				it = d._hashfilter(sliceno, rehash, it)
+			if translation_func:
+				it = imap(translation_func, it)
+			if range and not sloppy_range:
+				c = d.columns[range_k]
+				if c.min is not None and (not range_check(c.min) or not range_check(c.max)):
+					if has_range_column:
+						it = ifilter(range_f, it)
+					else:
+						if rehash:
+							filter_it = d._hashfilter(sliceno, rehash, d._column_iterator(None, range_k))
+						else:
+							filter_it = d._column_iterator(sliceno, range_k, rows)
+						it = compress(it, imap(range_check, filter_it))
+			if filter_func:
+				it = ifilter(filter_func, it)
+			return it
+
+		from itertools import chain
 		with status(msg_head) as update:
 			for ix, (d, sliceno, rehash) in enumerate(to_iter, 1):
 				if unsliced_post_callback:
@@ -498,30 +648,14 @@ class Dataset(unicode):
 					except SkipJob:
 						skip_ds = d
 						continue
-				it = d._iterator(None if rehash else sliceno, columns)
-				for ix, trans in translators.items():
-					it[ix] = imap(trans, it[ix])
-				if want_tuple:
-					it = izip(*it)
+				if range and not rehash:
+					runs = d._range_rows(sliceno, columns, range_k, range_bottom, range_top, rows)
 				else:
-					it = it[0]
-				if rehash:
-					it = d._hashfilter(sliceno, rehash, it)
-				if translation_func:
-					it = imap(translation_func, it)
-				if range:
-					c = d.columns[range_k]
-					if c.min is not None and (not range_check(c.min) or not range_check(c.max)):
-						if has_range_column:
-							it = ifilter(range_f, it)
-						else:
-							if rehash:
-								filter_it = d._hashfilter(sliceno, rehash, d._column_iterator(None, range_k))
-							else:
-								filter_it = d._column_iterator(sliceno, range_k)
-							it = compress(it, imap(range_check, filter_it))
-				if filter_func:
-					it = ifilter(filter_func, it)
+					runs = None
+				if runs is None:
+					it = mkiter(d, sliceno, rehash, rows)
+				else:
+					it = chain.from_iterable(mkiter(d, sliceno, False, run) for run in runs)
 				yield it
 				if post_callback and not unsliced_post_callback:
 					post_callback(d, sliceno)
@@ -529,8 +663,14 @@ class Dataset(unicode):
 				post_callback(None)
 
 	@staticmethod
-	def new(columns, filenames, lines, minmax={}, filename=None, hashlabel=None, caption=None, previous=None, name='default'):
-		"""columns = {"colname": "type"}, lines = [n, ...] or {sliceno: n}"""
+	def new(columns, filenames, lines, minmax={}, filename=None, hashlabel=None, caption=None, previous=None, name='default', compressions={}, blocks={}, dictionaries={}):
+		"""columns = {"colname": "type"}, lines = [n, ...] or {sliceno: n}
+		compressions = {"colname": "compression"} for columns that are not
+		plain "gzip" (see gzwrite.parse_compression)
+		blocks = {"colname": (block_rows, [[offsets] per slice],
+		[[(min, max, has None)] per slice] or None)} for columns written in blocks
+		dictionaries = {"colname": [[values] or None per slice]} for
+		"dict" columns (see gzwrite.recompress)"""
 		columns = {uni(k): uni(v) for k, v in columns.items()}
 		if hashlabel:
 			hashlabel = uni(hashlabel)
@@ -538,7 +678,7 @@ class Dataset(unicode):
 		res = Dataset(_new_dataset_marker, name)
 		res._data.lines = list(Dataset._linefixup(lines))
 		res._data.hashlabel = hashlabel
-		res._append(columns, filenames, minmax, filename, caption, previous, name)
+		res._append(columns, filenames, minmax, filename, caption, previous, name, compressions, blocks, dictionaries)
 		return res
 
 	@staticmethod
@@ -550,14 +690,14 @@ class Dataset(unicode):
 		assert len(lines) == SLICES, "Lines must be specified for all slices"
 		return lines
 
-	def append(self, columns, filenames, lines, minmax={}, filename=None, hashlabel=None, hashlabel_override=False, caption=None, previous=None, name='default'):
+	def append(self, columns, filenames, lines, minmax={}, filename=None, hashlabel=None, hashlabel_override=False, caption=None, previous=None, name='default', compressions={}, blocks={}, dictionaries={}):
 		if hashlabel:
 			hashlabel = uni(hashlabel)
 			if not hashlabel_override:
 				assert self.hashlabel == hashlabel, 'Hashlabel mismatch %s != %s' % (self.hashlabel, hashlabel,)
 		assert self._linefixup(lines) == self.lines, "New columns don't have the same number of lines as parent columns"
 		columns = {uni(k): uni(v) for k, v in columns.items()}
-		self._append(columns, filenames, minmax, filename, caption, previous, name)
+		self._append(columns, filenames, minmax, filename, caption, previous, name, compressions, blocks, dictionaries)
 
 	def _minmax_merge(self, minmax):
 		def minmax_fixup(a, b):
@@ -575,8 +715,8 @@ class Dataset(unicode):
 					res[name] = [min(mm[0], omm[0]), max(mm[1], omm[1])]
 		return res
 
-	def _append(self, columns, filenames, minmax, filename, caption, previous, name):
-		from sourcedata import type2iter
+	def _append(self, columns, filenames, minmax, filename, caption, previous, name, compressions, blocks, dictionaries):
+		from sourcedata import type2iter, raw_types
 		from g import JOBID
 		jobid = uni(JOBID)
 		name = uni(name)
@@ -595,6 +735,24 @@ class Dataset(unicode):
 		for n, t in sorted(columns.items()):
 			if t not in type2iter:
 				raise Exception('Unknown type %s on column %s' % (t, n,))
+			compression = uni(compressions.get(n, 'gzip'))
+			try:
+				codec, _ = parse_compression(compression)
+			except ValueError as e:
+				raise Exception('%s on column %s' % (e, n,))
+			if (codec == 'none' and t not in raw_types) or (codec == 'dict' and t not in dict_types):
+				raise Exception('Compression %s not supported for column %s (%s)' % (compression, n, t,))
+			dictionary = dictionaries.get(n)
+			if codec == 'dict':
+				assert dictionary and len(dictionary) == len(self._data.lines), "Dictionaries must be specified for all slices (%s)" % (n,)
+			else:
+				assert not dictionary, "Dictionary for non-dict column %s" % (n,)
+			block_rows, block_offsets, block_minmax = blocks.get(n, (None, None, None))
+			if block_rows:
+				assert len(block_offsets) == len(self._data.lines), "Blocks must be specified for all slices (%s)" % (n,)
+				col_blocks = (block_rows, block_offsets,)
+			else:
+				col_blocks = block_minmax = None
 			mm = minmax.get(n, (None, None,))
 			self._data.columns[n] = DatasetColumn(
 				type=uni(t),
@@ -603,6 +761,10 @@ class Dataset(unicode):
 				min=mm[0],
 				max=mm[1],
 				offsets=None,
+				compression=compression,
+				blocks=col_blocks,
+				block_minmax=block_minmax,
+				dictionary=dictionary,
 			)
 			self._maybe_merge(n)
 		self._update_caches()
@@ -719,13 +881,37 @@ class DatasetWriter(object):
 	If you need to handle everything yourself, set meta_only=True and
 	use dw.column_filename(colname) to find the right files to write to.
 	In this case you also need to call dw.set_lines(sliceno, count)
-	before finishing. You should also call
-	dw.set_minmax(sliceno, {colname: (min, max)}) if you can.
+	before finishing. If you call it in analysis(sliceno), when the files
+	of that slice are written, columns that need recompressing are
+	recompressed there instead of slice by slice in finish. You should
+	also call dw.set_minmax(sliceno, {colname: (min, max)}) if you can.
+	
+	Columns can be stored with other compressions than the default
+	"gzip" (level 6), with dw.add(colname, coltype, compression=...):
+	"gzip:9" for smaller (slower) files, "bz2" or "lzma" (with optional
+	levels) for archival data, or for fixed width columns "none", so
+	they can be read without inflating (or mmap:ed, see
+	Dataset.column_mmap). Columns that are not gzip are still written
+	gzipped (also in meta_only writers) and recompressed when the slice
+	is closed. Only gzip and none columns can be read from C code.
+	
+	String (bytes, ascii and unicode) columns with few different values
+	can use compression='dict', which stores a dictionary of the values
+	in each slice and small integer codes for the lines. Iterating gives
+	the same object for equal values, and Dataset.column_codes gives the
+	codes (for fast filtering or grouping).
+	
+	With block_rows=N every N values in each slice are compressed as a
+	separate stream, and the offsets are stored in the dataset, so that
+	Dataset.iterate(..., rows=(start, stop)) can start reading near
+	start. The min and max of each block is also stored, so iterating
+	with range= only reads the blocks that can have matching values.
+	This costs a recompression when the slice is closed.
 	"""
 
 	_split = _split_dict = _split_list = _allwriters_ = None
 
-	def __new__(cls, columns={}, filename=None, hashlabel=None, hashlabel_override=False, caption=None, previous=None, name='default', parent=None, meta_only=False, for_single_slice=None):
+	def __new__(cls, columns={}, filename=None, hashlabel=None, hashlabel_override=False, caption=None, previous=None, name='default', parent=None, meta_only=False, for_single_slice=None, block_rows=None):
 		"""columns can be {'name': 'type'} or {'name': DatasetColumn}
 		to simplify basing your dataset on another."""
 		name = uni(name)
@@ -733,7 +919,7 @@ class DatasetWriter(object):
 		from g import running
 		if running == 'analysis':
 			assert name in _datasetwriters, 'Dataset with name "%s" not created' % (name,)
-			assert not columns and not filename and not hashlabel and not caption and not parent and for_single_slice is None, "Don't specify any arguments (except optionally name) in analysis"
+			assert not columns and not filename and not hashlabel and not caption and not parent and for_single_slice is None and not block_rows, "Don't specify any arguments (except optionally name) in analysis"
 			return _datasetwriters[name]
 		else:
 			assert name not in _datasetwriters, 'Duplicate dataset name "%s"' % (name,)
@@ -761,15 +947,22 @@ class DatasetWriter(object):
 			obj._lens = {}
 			obj._minmax = {}
 			obj._order = []
+			obj._compressions = {}
+			obj._recompressed = set()
+			assert not block_rows or block_rows > 0, "block_rows must be positive"
+			obj.block_rows = block_rows
+			obj._recompress_res = {}
 			for k, v in sorted(columns.items()):
 				if isinstance(v, tuple):
-					v = v.type
-				obj.add(k, v)
+					obj.add(k, v.type, compression=v.compression)
+				else:
+					obj.add(k, v)
 			_datasetwriters[name] = obj
 			return obj
 
-	def add(self, colname, coltype, default=_nodefault):
+	def add(self, colname, coltype, default=_nodefault, compression='gzip'):
 		from g import running
+		from sourcedata import raw_types
 		assert running == self._running, "Add all columns in the same step as creation"
 		assert not self._started, "Add all columns before setting slice"
 		colname = uni(colname)
@@ -777,7 +970,13 @@ class DatasetWriter(object):
 		assert colname not in self.columns, colname
 		assert colname
 		typed_writer(coltype) # gives error for unknown types
+		compression = uni(compression)
+		codec, _ = parse_compression(compression)
+		assert codec != 'none' or coltype.split(':')[-1] in raw_types, "%s can't be uncompressed" % (coltype,)
+		assert codec != 'dict' or coltype.split(':')[-1] in dict_types, "%s can't be dictionary encoded" % (coltype,)
 		self.columns[colname] = (coltype, default)
+		if compression != 'gzip':
+			self._compressions[colname] = compression
 		self._order.append(colname)
 		if colname in self._pcolumns:
 			self._clean_names[colname] = self._pcolumns[colname].name
@@ -814,6 +1013,11 @@ class DatasetWriter(object):
 		for colname, (coltype, default) in self.columns.items():
 			wt = typed_writer(coltype)
 			kw = {} if default is _nodefault else {'default': default}
+			codec, level = parse_compression(self._compressions.get(colname))
+			if codec != 'gzip' or self.block_rows:
+				kw['mode'] = 'w1' # recompressed when closed
+			elif level:
+				kw['mode'] = 'w%d' % (level,)
 			fn = self.column_filename(colname, sliceno)
 			if filtered and colname == self.hashlabel:
 				from g import SLICES
@@ -933,6 +1137,18 @@ class DatasetWriter(object):
 		assert len(len_set) == 1, "Not all columns have the same linecount in slice %d: %r" % (sliceno, lens)
 		self._lens[sliceno] = len_set.pop()
 		self._minmax[sliceno] = minmax
+		self._recompress(sliceno)
+
+	def _recompress(self, sliceno):
+		if sliceno in self._recompressed:
+			return
+		self._recompressed.add(sliceno)
+		res = self._recompress_res[sliceno] = {}
+		for colname, (coltype, _) in self.columns.items():
+			compression = self._compressions.get(colname, 'gzip')
+			# gzip:level is written directly, except by meta_only users
+			if self.block_rows or (colname in self._compressions and (self.meta_only or not compression.startswith('gzip'))):
+				res[colname] = recompress(self.column_filename(colname, sliceno), compression, coltype.split(':')[-1], self.block_rows)
 
 	def close(self):
 		if self._started == 2:
@@ -964,6 +1180,22 @@ class DatasetWriter(object):
 		assert running == self._running or running == 'synthesis', "Finish where you started or in synthesis"
 		self.close()
 		assert len(self._lens) == SLICES, "Not all slices written, missing %r" % (set(range(SLICES)) - set(self._lens),)
+		if self.meta_only:
+			for sliceno in range(SLICES):
+				self._recompress(sliceno)
+		blocks = {}
+		dictionaries = {}
+		for colname in self.columns:
+			res = [self._recompress_res[sliceno].get(colname) for sliceno in range(SLICES)]
+			if not res[0]:
+				continue
+			offsets, minmax, dictionary = zip(*res)
+			if self.block_rows:
+				if minmax[0] is None:
+					minmax = None
+				blocks[colname] = (self.block_rows, list(offsets), minmax and list(minmax),)
+			if self._compressions.get(colname, 'gzip').startswith('dict'):
+				dictionaries[colname] = list(dictionary)
 		args = dict(
 			columns={k: v[0].split(':')[-1] for k, v in self.columns.items()},
 			filenames=self._clean_names,
@@ -974,6 +1206,9 @@ class DatasetWriter(object):
 			caption=self.caption,
 			previous=self.previous,
 			name=self.name,
+			compressions=self._compressions,
+			blocks=blocks,
+			dictionaries=dictionaries,
 		)
 		if self.parent:
 			res = Dataset(self.parent)
@@ -19,6 +19,9 @@
 from __future__ import print_function
 from __future__ import division
 
+import os
+from array import array
+
 import gzutil
 from compat import unicode, str_types, PY3
 
@@ -89,3 +92,202 @@ class GzWriteParsedJson(GzWriteJson):
 		self.count += 1
 		self.fh.write(dumps(o, ensure_ascii=False))
 _convfuncs['parsed:json'] = GzWriteParsedJson
+
+
+# Column files can be stored with other compressions than gzip.
+# The compression is "codec" or "codec:level", e.g. "gzip:9" or "lzma".
+# "none" is only for fixed width types (see sourcedata.raw_types).
+# "dict" is only for bytes, ascii and unicode. It stores a dictionary of the
+# values in each slice (in the dataset) and gzipped int32 codes in the file.
+# (Slices with more than DICT_MAX_VALUES different values stay as lines.)
+# All writers write gzip, other compressions are made by recompressing the
+# finished file (except for gzip:level, which the writers do directly).
+_compression_levels = {
+	'gzip': range(1, 10),
+	'bz2' : range(1, 10),
+	'lzma': range(0, 10),
+	'none': (),
+	'dict': range(1, 10),
+}
+
+dict_types = ('bytes', 'ascii', 'unicode',)
+DICT_MAX_VALUES = 4096
+
+def parse_compression(compression):
+	"""(codec, level or None) for a compression string, ValueError if
+	it isn't a valid (and available) compression."""
+	codec, _, level = (compression or 'gzip').partition(':')
+	if codec not in _compression_levels:
+		raise ValueError("Unknown compression %r" % (compression,))
+	if level:
+		try:
+			level = int(level)
+		except ValueError:
+			level = -1
+		if level not in _compression_levels[codec]:
+			raise ValueError("Bad level in compression %r" % (compression,))
+	else:
+		level = None
+	if codec == 'lzma':
+		try:
+			import lzma
+		except ImportError:
+			raise ValueError("Compression lzma needs the lzma module (python 3)")
+	return codec, level
+
+def _compressor(codec, level):
+	if codec in ('gzip', 'dict',):
+		from zlib import compressobj, DEFLATED, MAX_WBITS
+		return compressobj(6 if level is None else level, DEFLATED, MAX_WBITS | 16)
+	if codec == 'bz2':
+		from bz2 import BZ2Compressor
+		return BZ2Compressor(9 if level is None else level)
+	if codec == 'lzma':
+		from lzma import LZMACompressor
+		return LZMACompressor(preset=level)
+
+def _value_ends(typename):
+	"""A function (data, n) -> (bytes, values) for the first (at most)
+	n whole values in data (uncompressed column data)."""
+	if typename == 'number':
+		def number_ends(data, n):
+			b = bytearray(data)
+			pos = count = 0
+			while count < n and pos < len(b):
+				size = 1 if b[pos] == 0 else 9 if b[pos] in (1, 8) else b[pos] + 1
+				if pos + size > len(b):
+					break
+				pos += size
+				count += 1
+			return pos, count
+		return number_ends
+	from sourcedata import raw_types
+	if typename in raw_types:
+		width = raw_types[typename][0]
+		def fixed_ends(data, n):
+			count = min(n, len(data) // width)
+			return count * width, count
+		return fixed_ends
+	def line_ends(data, n):
+		parts = data.split(b'\n', n)
+		return len(data) - len(parts[-1]), len(parts) - 1
+	return line_ends
+
+class _TooManyValues(Exception):
+	pass
+
+def _dict_codes(chunks, codes):
+	"""int32 codes for the lines in chunks, adding new values to codes"""
+	from sourcedata import raw_types
+	typecode = raw_types['int32'][1]
+	setdefault = codes.setdefault
+	left = b''
+	for data in chunks:
+		lines = data.split(b'\n')
+		lines[0] = left + lines[0]
+		left = lines.pop()
+		# (codes has the None line too, with its own code.)
+		data = array(typecode, [setdefault(line, len(codes) - 1) for line in lines])
+		if len(codes) > DICT_MAX_VALUES + 1:
+			raise _TooManyValues()
+		yield data.tobytes() if PY3 else data.tostring()
+	assert not left, "Partial line at end of data"
+
+def recompress(fn, compression, typename=None, block_rows=None):
+	"""Replace a gzip file (possibly several members) with its contents
+	as compression (one stream, or just the contents for "none").
+	With block_rows (and typename) every block_rows values get a
+	separate stream (a gzip member for gzip) that can be decompressed
+	on its own.
+	Returns (byte offsets of the blocks, [(min, max, has None)] of the blocks,
+	dictionary). The first two are None without block_rows, the second
+	also for types without minmax. The dictionary is the values (by
+	code) for "dict", or None (also for slices that were kept as lines)."""
+	from gzip import GzipFile
+	from sourcedata import minmax_values, has_minmax, line_decoders
+	codec, level = parse_compression(compression)
+	def gunzipped():
+		with open(fn, 'rb') as ifh:
+			if os.fstat(ifh.fileno()).st_size:
+				src = GzipFile(fileobj=ifh)
+				while True:
+					data = src.read(1024 * 1024)
+					if not data:
+						break
+					yield data
+	chunks = gunzipped()
+	if codec == 'dict':
+		assert typename in dict_types, "%s can't be dictionary encoded" % (typename,)
+		codes = {b'\0': -0x80000000} # None
+		chunks = _dict_codes(chunks, codes)
+		value_typename = 'int32'
+	else:
+		value_typename = typename
+	def compress(data):
+		if c:
+			data = c.compress(data)
+		ofh.write(data)
+	if block_rows:
+		value_ends = _value_ends(value_typename)
+		want_minmax = has_minmax(value_typename) and codec != 'dict'
+	else:
+		want_minmax = False
+	tmp_fn = fn + '.recompress'
+	blocks = [0]
+	minmax = [(None, None, False)]
+	def update_minmax(data):
+		lo, hi, has_none = minmax[-1]
+		mi, ma, none = minmax_values(typename, data)
+		if mi is not None:
+			if lo is None:
+				lo, hi = mi, ma
+			else:
+				lo, hi = min(lo, mi), max(hi, ma)
+		minmax[-1] = (lo, hi, has_none or none)
+	try:
+		with open(tmp_fn, 'wb') as ofh:
+			c = _compressor(codec, level)
+			rows_left = block_rows
+			left = b''
+			for data in chunks:
+				if not block_rows:
+					compress(data)
+					continue
+				data = left + data
+				while True:
+					pos, count = value_ends(data, rows_left)
+					if pos: # (gzip writes a header even for nothing)
+						compress(data[:pos])
+						if want_minmax:
+							update_minmax(data[:pos])
+					data = data[pos:]
+					rows_left -= count
+					if rows_left:
+						break
+					# The block is full, start a new stream.
+					if c:
+						ofh.write(c.flush())
+						c = _compressor(codec, level)
+					blocks.append(ofh.tell())
+					minmax.append((None, None, False))
+					rows_left = block_rows
+				left = data
+			assert not left, "%s: partial value at end of file" % (fn,)
+			if block_rows and rows_left == block_rows and len(blocks) > 1:
+				# the last block was empty
+				blocks.pop()
+				minmax.pop()
+			elif c:
+				ofh.write(c.flush())
+	except _TooManyValues:
+		os.unlink(tmp_fn)
+		return recompress(fn, 'gzip' if level is None else 'gzip:%d' % (level,), typename, block_rows)
+	os.rename(tmp_fn, fn)
+	if codec == 'dict':
+		del codes[b'\0']
+		dictionary = line_decoders[typename](sorted(codes, key=codes.get))
+	else:
+		dictionary = None
+	if block_rows:
+		return blocks, (minmax if want_minmax else None), dictionary
+	return None, None, dictionary
@@ -92,16 +92,21 @@ def call_analysis(analysis_func, sliceno_, q, preserve_result, parent_pid, **kw)
 		from extras import saved_files
 		dw_lens = {}
 		dw_minmax = {}
+		dw_recompress_res = {}
 		for name, dw in dataset._datasetwriters.items():
 			if dw._for_single_slice in (None, sliceno_,):
 				dw.close()
+				if dw.meta_only and sliceno_ in dw._lens:
+					# set_lines in analysis, so this slice is done.
+					dw._recompress(sliceno_)
 				dw_lens[name] = dw._lens
 				dw_minmax[name] = dw._minmax
+				dw_recompress_res[name] = dw._recompress_res
 		status._end()
-		q.put((sliceno_, time(), saved_files, dw_lens, dw_minmax, None,))
+		q.put((sliceno_, time(), saved_files, dw_lens, dw_minmax, dw_recompress_res, None,))
 	except:
 		status._end()
-		q.put((sliceno_, time(), {}, {}, {}, fmt_tb(1),))
+		q.put((sliceno_, time(), {}, {}, {}, {}, fmt_tb(1),))
 		print_exc()
 		sleep(5) # give launcher time to report error (and kill us)
 		exitfunction()
@@ -119,7 +124,7 @@ def fork_analysis(slices, analysis_func, kw, preserve_result):
 	per_slice = []
 	temp_files = {}
 	for p in children:
-		s_no, s_t, s_temp_files, s_dw_lens, s_dw_minmax, s_tb = q.get()
+		s_no, s_t, s_temp_files, s_dw_lens, s_dw_minmax, s_dw_recompress_res, s_tb = q.get()
 		if s_tb:
 			data = [{'analysis(%d)' % (s_no,): s_tb}, None]
 			os.write(_prof_fd, json.dumps(data).encode('utf-8'))
@@ -130,6 +135,9 @@ def fork_analysis(slices, analysis_func, kw, preserve_result):
 			dataset._datasetwriters[name]._lens.update(lens)
 		for name, minmax in s_dw_minmax.items():
 			dataset._datasetwriters[name]._minmax.update(minmax)
+		for name, res in s_dw_recompress_res.items():
+			dataset._datasetwriters[name]._recompress_res.update(res)
+			dataset._datasetwriters[name]._recompressed.update(res)
 	for p in children:
 		p.join()
 	if preserve_result:
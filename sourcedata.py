@@ -19,11 +19,20 @@
 from __future__ import print_function
 from __future__ import division
 
+import os
+from array import array
+from mmap import mmap, PROT_READ
+from itertools import chain, islice, repeat
+from functools import partial
+from struct import unpack_from
+from binascii import hexlify
+from datetime import datetime, date, time
+
 import gzutil
 
 assert gzutil.version >= (2, 8, 1) and gzutil.version[0] == 2, gzutil.version
 
-from compat import PY3
+from compat import PY3, imap, izip
 
 type2iter = {
 	'number'  : gzutil.GzNumber,
@@ -62,7 +71,347 @@ class GzJson(object):
 		self.close()
 type2iter['json'] = GzJson
 
-def typed_reader(typename):
+
+# Columns can be stored with other compressions than gzip (the compression
+# field in the DatasetColumn, see gzwrite.parse_compression):
+#     "gzip" or "gzip:level" is read with gzutil, like always.
+#     "none" (only fixed width types) is the same values as in the gzip
+#         files, little endian. They are read with gzutil (zlib passes
+#         data that isn't gzip through as is), except a slice that happens
+#         to start with the gzip magic, which is read in python.
+#     "bz2" or "lzma" (optionally with a level) is decoded in python.
+#     "dict" (only bytes, ascii and unicode) is int32 codes (gzip) for the
+#         values in a dictionary for each slice (or lines, like gzip, for
+#         slices without a dictionary).
+# When the slices are merged (offsets) each slice is a separate stream.
+
+def codec(compression):
+	return (compression or 'gzip').split(':', 1)[0]
+
+def c_readable(compression):
+	"""Can C code read this with gzread (or read for "none")?"""
+	return codec(compression) in ('gzip', 'none',)
+
+def _typecode(width, signed):
+	for tc in ('bhilq' if signed else 'BHILQ'):
+		try:
+			if array(tc).itemsize == width:
+				return tc
+		except ValueError: # no q/Q in python2
+			pass
+
+def _decode_datetime(a):
+	for ix in range(0, len(a), 2):
+		v0, v1 = a[ix], a[ix + 1]
+		if v0 | v1:
+			yield datetime(v0 >> 14, (v0 >> 10) & 15, (v0 >> 5) & 31, v0 & 31, v1 >> 26, (v1 >> 20) & 63, v1 & 0xfffff)
+		else:
+			yield None
+
+def _decode_time(a):
+	for ix in range(0, len(a), 2):
+		v0, v1 = a[ix], a[ix + 1]
+		if v0 | v1:
+			yield time(v0 & 31, v1 >> 26, (v1 >> 20) & 63, v1 & 0xfffff)
+		else:
+			yield None
+
+def _decode_date(a):
+	for v in a:
+		if v:
+			yield date(v >> 9, (v >> 5) & 15, v & 31)
+		else:
+			yield None
+
+# How None is stored in float columns (dataset_typing uses these too).
+noneval_float64 = b'\xde\xad\xde\xad\xde\xad\xf0\xff'
+noneval_float32 = b'\xde\xad\x80\xff'
+
+# type: (width, value typecode, typecode of the None check, None value or None, decoder)
+# Without a value typecode the decoder gets the None check array.
+raw_types = {
+	'float64' : (8, 'd', _typecode(8, False), unpack_from('=Q', noneval_float64)[0], None),
+	'float32' : (4, 'f', _typecode(4, False), unpack_from('=I', noneval_float32)[0], None),
+	'int64'   : (8, _typecode(8, True), None, -0x8000000000000000, None),
+	'int32'   : (4, _typecode(4, True), None, -0x80000000, None),
+	'bits64'  : (8, _typecode(8, False), None, None, None),
+	'bits32'  : (4, _typecode(4, False), None, None, None),
+	'bool'    : (1, 'B', None, 255, bool),
+	'datetime': (8, None, _typecode(4, False), None, _decode_datetime),
+	'date'    : (4, None, _typecode(4, False), None, _decode_date),
+	'time'    : (8, None, _typecode(4, False), None, _decode_time),
+}
+
+def _tobytes(a):
+	return a.tobytes() if PY3 else a.tostring()
+
+# The bytes of None for the types in raw_types that have a None value.
+_none_bytes = {
+	typename: _tobytes(array(check_tc or value_tc, [none]))
+	for typename, (_, value_tc, check_tc, none, _) in raw_types.items()
+	if none is not None
+}
+
+_none_tuple = (None,)
+
+def _fixed_values(typename, data):
+	width, value_tc, check_tc, none, decoder = raw_types[typename]
+	if not value_tc:
+		return decoder(array(check_tc, data))
+	none_bytes = _none_bytes.get(typename)
+	if none_bytes and none_bytes in data:
+		try:
+			# The values between the Nones, so nothing is done per value
+			# in python. (array fails if a match was not a whole value.)
+			parts = list(map(partial(array, value_tc), data.split(none_bytes)))
+		except ValueError:
+			check = array(check_tc or value_tc, data)
+			values = array(value_tc, data)
+			if decoder:
+				values = imap(decoder, values)
+			return (None if c == none else v for c, v in izip(check, values))
+		if decoder:
+			parts = [imap(decoder, a) for a in parts]
+		values = chain.from_iterable(chain.from_iterable(izip(parts, repeat(_none_tuple))))
+		return islice(values, len(data) // width) # (no None after the last part)
+	values = array(value_tc, data)
+	if decoder:
+		return imap(decoder, values)
+	return iter(values)
+
+def _aligned(chunks, width):
+	"""The chunks, but each a whole number of values"""
+	left = b''
+	for data in chunks:
+		if left:
+			data = left + data
+		end = len(data) - len(data) % width
+		left = data[end:]
+		if end:
+			yield data[:end]
+	assert not left, "Partial value at end of data"
+
+def _lines(chunks):
+	left = b''
+	for data in chunks:
+		lines = data.split(b'\n')
+		lines[0] = left + lines[0]
+		left = lines.pop()
+		yield lines
+	assert not left, "Partial line at end of data"
+
+def _decode_lines(decode):
+	def lines_decoder(lines):
+		return [None if line == b'\0' else decode(line) for line in lines]
+	return lines_decoder
+
+def _bytes_lines(lines):
+	return [None if line == b'\0' else line for line in lines]
+
+def _json_lines(lines):
+	return [loads(line) for line in lines]
+
+def _number_values(data):
+	"""Values in data, and how many bytes of it they were"""
+	res = []
+	pos = 0
+	end = len(data)
+	b = bytearray(data)
+	while pos < end:
+		n = b[pos]
+		size = 1 if n == 0 else 9 if n in (1, 8) else n + 1
+		if pos + size > end:
+			break
+		if n == 0:
+			v = None
+		elif n == 1:
+			v = unpack_from('<d', data, pos + 1)[0]
+		elif n == 8:
+			v = unpack_from('<q', data, pos + 1)[0]
+		else:
+			v = int(hexlify(data[pos + 1:pos + size][::-1]), 16)
+			if b[pos + n] & 0x80:
+				v -= 1 << (8 * n)
+		res.append(v)
+		pos += size
+	return res, pos
+
+def _numbers(chunks):
+	left = b''
+	for data in chunks:
+		if left:
+			data = left + data
+		values, used = _number_values(data)
+		left = data[used:]
+		yield values
+	assert not left, "Partial number at end of data"
+
+def decompressed_chunks(name, compression, seek=0):
+	"""Chunks of the (bz2 or lzma) stream(s) starting at seek in name"""
+	c = codec(compression)
+	if c == 'bz2':
+		from bz2 import BZ2Decompressor as decompressor
+	elif c == 'lzma':
+		from lzma import LZMADecompressor as decompressor
+	else:
+		raise ValueError("Can't decompress %s" % (compression,))
+	d = decompressor()
+	with open(name, 'rb') as fh:
+		fh.seek(seek)
+		data = fh.read(1024 * 1024)
+		while data:
+			try:
+				res = d.decompress(data)
+			except EOFError: # python2 doesn't have .eof, this is how the end shows
+				d = decompressor()
+				continue
+			if res:
+				yield res
+			if d.unused_data or getattr(d, 'eof', False):
+				# Another stream follows (maybe the next slice, but
+				# then the caller stops before reading it).
+				data = d.unused_data
+				d = decompressor()
+				if data:
+					continue
+			data = fh.read(1024 * 1024)
+
+class CodecReader(object):
+	"""Reads a column file that isn't gzip, with the same arguments as
+	the gzutil readers (except that max_count is needed when the file
+	has more values after the ones you want)."""
+
+	def __init__(self, typename, compression, name, seek=0, max_count=-1, hashfilter=None):
+		self.name = name
+		self._mm = None
+		if codec(compression) == 'none':
+			width = raw_types[typename][0]
+			with open(name, 'rb') as fh:
+				size = os.fstat(fh.fileno()).st_size
+				if size:
+					self._mm = mmap(fh.fileno(), size, prot=PROT_READ)
+			end = size if max_count < 0 else min(size, seek + max_count * width)
+			assert (end - seek) % width == 0, "%s: %d bytes is not a whole number of values" % (name, end - seek,)
+			step = 65536 * width
+			chunks = (self._mm[pos:min(end, pos + step)] for pos in range(seek, end, step))
+			max_count = -1 # already limited
+		else:
+			chunks = decompressed_chunks(name, compression, seek)
+		if typename in raw_types:
+			it = chain.from_iterable(imap(partial(_fixed_values, typename), _aligned(chunks, raw_types[typename][0])))
+		elif typename == 'number':
+			it = chain.from_iterable(_numbers(chunks))
+		else:
+			it = chain.from_iterable(imap(line_decoders[typename], _lines(chunks)))
+		if max_count >= 0:
+			it = islice(it, max_count)
+		if hashfilter:
+			from gzwrite import typed_writer
+			h = typed_writer(typename).hash
+			sliceno, slices = hashfilter
+			it = imap(lambda v: h(v) % slices == sliceno, it)
+		self._it = it
+
+	def __next__(self):
+		return next(self._it)
+	next = __next__
+
+	def __iter__(self):
+		# Not self, so iterating doesn't go through __next__ for each value.
+		return self._it
+
+	def close(self):
+		if self._mm:
+			self._mm.close()
+		self._mm = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+def has_minmax(typename):
+	"""Do columns of this type have min and max?"""
+	return typename == 'number' or typename in raw_types
+
+def minmax_values(typename, data):
+	"""(min, max, has None) of the values in data (uncompressed column
+	data, whole values). min and max don't count None and NaN, and are
+	None if there are no other values."""
+	if typename == 'number':
+		values, _ = _number_values(data)
+	else:
+		values = _fixed_values(typename, data)
+	values = list(values)
+	has_none = None in values
+	values = [v for v in values if v is not None and v == v]
+	if values:
+		return min(values), max(values), has_none
+	return None, None, has_none
+
+line_decoders = {
+	'bytes'   : _bytes_lines,
+	'ascii'   : _decode_lines(lambda v: v.decode('ascii')) if PY3 else _bytes_lines,
+	'unicode' : _decode_lines(lambda v: v.decode('utf-8')),
+	'json'    : _json_lines,
+}
+
+class DictReader(object):
+	"""Reads a dictionary encoded column, giving the values from dictionary
+	(so equal values are the same object). Otherwise like the gzutil
+	readers."""
+
+	def __init__(self, typename, dictionary, name, seek=0, max_count=-1, hashfilter=None):
+		self.name = name
+		self.codes = gzutil.GzInt32(name, seek=seek, max_count=max_count)
+		if hashfilter:
+			from gzwrite import typed_writer
+			h = typed_writer(typename).hash
+			sliceno, slices = hashfilter
+			dictionary = [h(v) % slices == sliceno for v in dictionary]
+			none = h(None) % slices == sliceno
+		else:
+			none = None
+		lookup = dict(enumerate(dictionary))
+		lookup[None] = none
+		self._it = imap(lookup.__getitem__, self.codes)
+
+	def __next__(self):
+		return next(self._it)
+	next = __next__
+
+	def __iter__(self):
+		# Not self, so iterating doesn't go through __next__ for each value.
+		return self._it
+
+	def close(self):
+		self.codes.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+def _raw_reader(typename, name, seek=0, **kw):
+	"""Reader for a "none" column"""
+	with open(name, 'rb') as fh:
+		fh.seek(seek)
+		magic = fh.read(2)
+	if magic == b'\x1f\x8b':
+		return CodecReader(typename, 'none', name, seek=seek, **kw)
+	return type2iter[typename](name, seek=seek, **kw)
+
+def typed_reader(typename, compression='gzip', dictionary=None):
+	"""dictionary is needed for "dict" (for one slice)"""
+	if codec(compression) == 'dict':
+		if dictionary is not None:
+			return partial(DictReader, typename, dictionary)
+	elif codec(compression) == 'none' and typename in type2iter:
+		return partial(_raw_reader, typename)
+	elif not compression.startswith('gzip'):
+		return partial(CodecReader, typename, compression)
 	if typename not in type2iter:
 		raise ValueError("Unknown reader for type %s" % (typename,))
 	return type2iter[typename]
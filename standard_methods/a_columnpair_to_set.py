@@ -19,31 +19,67 @@
 from __future__ import division
 from __future__ import absolute_import
 
+description = r'''
+Sets of the values in value_column for each key in key_column, per
+slice, including those from previous.
+
+The default flavour (pickle) saves a dict of sets (and a keyset pickle
+with just the keys). That takes a lot of memory and time to load and
+save for big datasets, so with flavour=compact it is saved as a pairset
+file instead (see pairset.py), which can be used with mmap:
+
+    from . import pairset
+    ps = pairset.load(jobid=jid, sliceno=sliceno)
+    ps.contains(key, value), key in ps, ps[key] (a set)
+
+Only keys and values of simple types (strings, numbers, bools) can be
+stored in a pairset. previous has to have the same flavour.
+'''
+
 from collections import defaultdict, Counter
 
-from extras import JobWithFile, OptionString
+from extras import JobWithFile, OptionString, OptionEnum, job_params
 import blob
+from . import pairset
+
+depend_extra = (pairset,)
+
+FlavourEnum = OptionEnum('pickle compact')
 
 options = {
 	'key_filter'  : JobWithFile, # a set of keys to keep (or nothing)
 	'value_filter': JobWithFile, # a set of values to keep (or nothing)
 	'key_column'  : OptionString,
 	'value_column': OptionString,
+	'flavour'     : FlavourEnum.pickle,
 }
 datasets = ('source',)
 jobids = ('previous',)
 
 
 def prepare(jobids):
-	key_filter   = blob.load(options.key_filter, default=set()),
+	key_filter   = blob.load(options.key_filter, default=set())
 	value_filter = blob.load(options.value_filter, default=set())
-	return key_filter, value_filter
+	if jobids.previous:
+		prev_flavour = job_params(jobids.previous).options.get('flavour') or 'pickle'
+		assert prev_flavour == (options.flavour or 'pickle'), "previous has flavour %s" % (prev_flavour,)
+	if options.flavour == 'compact':
+		d = datasets.source
+		kinds = (
+			pairset.kind_for_type(d.columns[options.key_column].type),
+			pairset.kind_for_type(d.columns[options.value_column].type),
+		)
+	else:
+		kinds = None
+	return key_filter, value_filter, kinds
 
 def analysis(sliceno, prepare_res):
-	key_filter, value_filter = prepare_res
+	key_filter, value_filter, kinds = prepare_res
+	if options.flavour == 'compact':
+		return analysis_compact(sliceno, key_filter, value_filter, kinds)
 	d = blob.load(jobid=jobids.previous, sliceno=sliceno, default=defaultdict(set))
 	if options.key_filter:
-		d = {k: v for k, v in d.iteritems() if k in key_filter}
+		d = defaultdict(set, ((k, v) for k, v in d.iteritems() if k in key_filter))
 	iterator = datasets.source.iterate_chain(
 		sliceno,
 		(options.key_column, options.value_column,),
@@ -81,6 +117,36 @@ def analysis(sliceno, prepare_res):
 	blob.save(set(d), 'keyset', sliceno=sliceno, temp=False)
 	blob.save(Counter(len(v) for v in d.itervalues()), 'setsizehist', sliceno=sliceno, temp=False)
 
+def analysis_compact(sliceno, key_filter, value_filter, kinds):
+	builder = pairset.Builder(*kinds)
+	iterator = datasets.source.iterate_chain(
+		sliceno,
+		(options.key_column, options.value_column,),
+		stop_ds={jobids.previous: 'source'},
+	)
+	if options.key_filter and options.value_filter:
+		iterator = ((k, v) for k, v in iterator if k in key_filter and v in value_filter)
+	elif options.key_filter:
+		iterator = ((k, v) for k, v in iterator if k in key_filter)
+	elif options.value_filter:
+		iterator = ((k, v) for k, v in iterator if v in value_filter)
+	builder.update(iterator)
+	if jobids.previous:
+		# Only the new pairs are built, previous is merged in as it is.
+		builder.save('new', sliceno=sliceno, temp=True)
+		with pairset.load(jobid=jobids.previous, sliceno=sliceno) as prev, pairset.load('new', sliceno=sliceno) as new:
+			pairset.merge(
+				[prev, new],
+				sliceno=sliceno,
+				temp=False,
+				key_filter=key_filter if options.key_filter else None,
+				value_filter=value_filter if options.value_filter else None,
+			)
+	else:
+		builder.save(sliceno=sliceno, temp=False)
+	with pairset.load(sliceno=sliceno) as ps:
+		blob.save(Counter(ps.set_sizes()), 'setsizehist', sliceno=sliceno, temp=False)
+
 def synthesis(params):
 	setsizehist = Counter()
 	for sliceno in range(params.slices):
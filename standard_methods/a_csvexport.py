@@ -19,14 +19,18 @@
 from __future__ import division
 from __future__ import absolute_import
 
+import cffi
 from itertools import izip, imap
-from shutil import copyfileobj
 from os import unlink
 from ujson import dumps
 
 from extras import OptionString, job_params
 from gzwrite import GzWrite
+from sourcedata import c_readable
 from status import status
+from . import file_concat
+
+depend_extra = (file_concat,)
 
 options = dict(
 	filename          = OptionString, # .csv or .gz
@@ -42,6 +46,380 @@ datasets = (['source'],) # normally just one, but you can specify several
 
 jobids = ('previous',)
 
+# Types the C backend can format, as its type numbers.
+# Slices with other types (number, json) use the python exporter.
+c_types = {
+	'ascii'   : 0,
+	'bytes'   : 0,
+	'unicode' : 0,
+	'int64'   : 1,
+	'int32'   : 2,
+	'bits64'  : 3,
+	'bits32'  : 4,
+	'bool'    : 5,
+	'float64' : 6,
+	'float32' : 7,
+	'datetime': 8,
+	'date'    : 9,
+	'time'    : 10,
+}
+
+ffi = cffi.FFI()
+ffi.cdef('''
+int export_slice(const char *out_fn, const int gz, const int n_cols, const char *in_fns[], const int *types, const int *raw, const int64_t *offsets, const int64_t lines, const char separator, const char quote);
+''')
+backend = ffi.verify(r'''
+#include <zlib.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <math.h>
+#include <float.h>
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+
+#define err1(v) if (v) goto err
+#define Z (128 * 1024)
+
+// These are signaling NaNs with extra DEADness in the significand
+static const unsigned char noneval_double[8] = {0xde, 0xad, 0xde, 0xad, 0xde, 0xad, 0xf0, 0xff};
+static const unsigned char noneval_float[4] = {0xde, 0xad, 0x80, 0xff};
+
+typedef struct {
+	gzFile fh;
+	int fd; // instead of fh for uncompressed columns
+	char *buf;
+	int size;
+	int len;
+	int pos;
+} col_t;
+
+typedef struct {
+	gzFile gz;
+	FILE *fh;
+	char *buf;
+	size_t size;
+	size_t len;
+} out_t;
+
+// Move what is left to the start of the buffer (growing it if full) and read more.
+static int col_fill(col_t *c)
+{
+	const int left = c->len - c->pos;
+	if (left && c->pos) memmove(c->buf, c->buf + c->pos, left);
+	c->len = left;
+	c->pos = 0;
+	if (c->len == c->size) {
+		char *buf = realloc(c->buf, c->size * 2);
+		if (!buf) return -1;
+		c->buf = buf;
+		c->size *= 2;
+	}
+	const int len = c->fh ? gzread(c->fh, c->buf + c->len, c->size - c->len) : read(c->fd, c->buf + c->len, c->size - c->len);
+	if (len < 0) return -1;
+	c->len += len;
+	return len;
+}
+
+static const char *col_read(col_t *c, const int size)
+{
+	while (c->len - c->pos < size) {
+		if (col_fill(c) <= 0) return 0;
+	}
+	const char *res = c->buf + c->pos;
+	c->pos += size;
+	return res;
+}
+
+// Lines can contain NUL, so no strchr here.
+static const char *col_read_line(col_t *c, int *len)
+{
+	char *end;
+	while (!(end = memchr(c->buf + c->pos, '\n', c->len - c->pos))) {
+		if (col_fill(c) <= 0) return 0;
+	}
+	const char *res = c->buf + c->pos;
+	*len = end - res;
+	c->pos += *len + 1;
+	return res;
+}
+
+static int out_flush(out_t *o)
+{
+	if (!o->len) return 0;
+	if (o->gz) {
+		if (gzwrite(o->gz, o->buf, o->len) != (int)o->len) return 1;
+	} else {
+		if (fwrite(o->buf, o->len, 1, o->fh) != 1) return 1;
+	}
+	o->len = 0;
+	return 0;
+}
+
+// Make room for len more bytes
+static int out_reserve(out_t *o, const size_t len)
+{
+	if (o->len + len <= o->size) return 0;
+	if (out_flush(o)) return 1;
+	if (len > o->size) {
+		char *buf = realloc(o->buf, len);
+		if (!buf) return 1;
+		o->buf = buf;
+		o->size = len;
+	}
+	return 0;
+}
+
+// Same result as repr(v) in python (2.7 and 3.x).
+static int fmt_double(char *res, const double v)
+{
+	if (isnan(v)) return sprintf(res, "nan");
+	if (isinf(v)) return sprintf(res, v > 0 ? "inf" : "-inf");
+	// The shortest representation that reads back as v.
+	// If there is one with at most 15 digits, the 15 digit one is
+	// that one with zeros after, so at most three tries are needed.
+	// (Except for denormals, which have less precision.)
+	char tmp[32];
+	for (int prec = (fabs(v) < DBL_MIN ? 1 : 15); prec <= 17; prec++) {
+		snprintf(tmp, sizeof(tmp), "%.*e", prec - 1, v);
+		if (strtod(tmp, 0) == v) break;
+	}
+	char *ptr = tmp;
+	char *out = res;
+	if (*ptr == '-') *out++ = *ptr++;
+	char digits[20];
+	int ndigits = 0;
+	for (; *ptr != 'e'; ptr++) {
+		if (*ptr != '.') digits[ndigits++] = *ptr;
+	}
+	const int exp = atoi(ptr + 1);
+	while (ndigits > 1 && digits[ndigits - 1] == '0') ndigits--;
+	const int decpt = exp + 1;
+	if (decpt > -4 && decpt <= 16) {
+		if (decpt <= 0) {
+			*out++ = '0';
+			*out++ = '.';
+			for (int i = decpt; i < 0; i++) *out++ = '0';
+			memcpy(out, digits, ndigits);
+			out += ndigits;
+		} else if (decpt >= ndigits) {
+			memcpy(out, digits, ndigits);
+			out += ndigits;
+			for (int i = ndigits; i < decpt; i++) *out++ = '0';
+			*out++ = '.';
+			*out++ = '0';
+		} else {
+			memcpy(out, digits, decpt);
+			out += decpt;
+			*out++ = '.';
+			memcpy(out, digits + decpt, ndigits - decpt);
+			out += ndigits - decpt;
+		}
+	} else {
+		*out++ = digits[0];
+		if (ndigits > 1) {
+			*out++ = '.';
+			memcpy(out, digits + 1, ndigits - 1);
+			out += ndigits - 1;
+		}
+		out += sprintf(out, "e%+03d", exp);
+	}
+	*out = 0;
+	return out - res;
+}
+
+static int fmt_time(char *res, const uint32_t *p, const int with_date)
+{
+	const int usec = p[1] & 1048575;
+	int len = 0;
+	if (with_date) {
+		len = sprintf(res, "%04d-%02d-%02d ", p[0] >> 14, (p[0] >> 10) & 15, (p[0] >> 5) & 31);
+	}
+	len += sprintf(res + len, "%02d:%02d:%02d", p[0] & 31, p[1] >> 26, (p[1] >> 20) & 63);
+	if (usec) len += sprintf(res + len, ".%06d", usec);
+	return len;
+}
+
+static const int type_sizes[] = {0, 8, 4, 8, 4, 1, 8, 4, 8, 4, 8};
+
+int export_slice(const char *out_fn, const int gz, const int n_cols, const char *in_fns[], const int *types, const int *raw, const int64_t *offsets, const int64_t lines, const char separator, const char quote)
+{
+	int res = 1;
+	col_t cols[n_cols];
+	out_t out;
+	memset(cols, 0, sizeof(cols));
+	memset(&out, 0, sizeof(out));
+	for (int i = 0; i < n_cols; i++) cols[i].fd = -1;
+	for (int i = 0; i < n_cols; i++) {
+		const int fd = open(in_fns[i], O_RDONLY);
+		err1(fd < 0);
+		if (lseek(fd, offsets[i], 0) != offsets[i]) {
+			close(fd);
+			goto err;
+		}
+		if (raw[i]) {
+			cols[i].fd = fd;
+		} else if (!(cols[i].fh = gzdopen(fd, "rb"))) {
+			close(fd);
+			goto err;
+		}
+		cols[i].size = Z;
+		cols[i].buf = malloc(Z);
+		err1(!cols[i].buf);
+	}
+	out.size = Z;
+	out.buf = malloc(Z);
+	err1(!out.buf);
+	if (gz) {
+		out.gz = gzopen(out_fn, "ab");
+		err1(!out.gz);
+	} else {
+		out.fh = fopen(out_fn, "ab");
+		err1(!out.fh);
+	}
+	for (int64_t line = 0; line < lines; line++) {
+		for (int i = 0; i < n_cols; i++) {
+			// Enough for any fixed width value and the separator and quotes.
+			err1(out_reserve(&out, 64));
+			if (i) out.buf[out.len++] = separator;
+			if (quote) out.buf[out.len++] = quote;
+			const int t = types[i];
+			const char *ptr;
+			int len;
+			char *o = out.buf + out.len;
+			if (t) {
+				ptr = col_read(cols + i, type_sizes[t]);
+			} else {
+				ptr = col_read_line(cols + i, &len);
+			}
+			err1(!ptr);
+			switch (t) {
+				case 0: // lines
+					if (len == 1 && !*ptr) {
+						len = sprintf(o, "None");
+					} else {
+						err1(out_reserve(&out, len * 2 + 2));
+						o = out.buf + out.len;
+						if (quote && memchr(ptr, quote, len)) {
+							char *start = o;
+							for (int j = 0; j < len; j++) {
+								if (ptr[j] == quote) *o++ = quote;
+								*o++ = ptr[j];
+							}
+							len = o - start;
+						} else {
+							memcpy(o, ptr, len);
+						}
+					}
+					break;
+				case 1: {
+					int64_t v;
+					memcpy(&v, ptr, 8);
+					if (v == INT64_MIN) {
+						len = sprintf(o, "None");
+					} else {
+						len = sprintf(o, "%lld", (long long)v);
+					}
+					break;
+				}
+				case 2: {
+					int32_t v;
+					memcpy(&v, ptr, 4);
+					if (v == INT32_MIN) {
+						len = sprintf(o, "None");
+					} else {
+						len = sprintf(o, "%d", v);
+					}
+					break;
+				}
+				case 3: {
+					uint64_t v;
+					memcpy(&v, ptr, 8);
+					len = sprintf(o, "%llu", (unsigned long long)v);
+					break;
+				}
+				case 4: {
+					uint32_t v;
+					memcpy(&v, ptr, 4);
+					len = sprintf(o, "%u", v);
+					break;
+				}
+				case 5:
+					if (*ptr == (char)255) {
+						len = sprintf(o, "None");
+					} else {
+						len = sprintf(o, *ptr ? "True" : "False");
+					}
+					break;
+				case 6:
+					if (!memcmp(ptr, noneval_double, 8)) {
+						len = sprintf(o, "None");
+					} else {
+						double v;
+						memcpy(&v, ptr, 8);
+						len = fmt_double(o, v);
+					}
+					break;
+				case 7:
+					if (!memcmp(ptr, noneval_float, 4)) {
+						len = sprintf(o, "None");
+					} else {
+						float v;
+						memcpy(&v, ptr, 4);
+						len = fmt_double(o, v);
+					}
+					break;
+				case 8:
+				case 10: {
+					uint32_t p[2];
+					memcpy(p, ptr, 8);
+					if (!p[0]) {
+						len = sprintf(o, "None");
+					} else {
+						len = fmt_time(o, p, t == 8);
+					}
+					break;
+				}
+				case 9: {
+					uint32_t v;
+					memcpy(&v, ptr, 4);
+					if (!v) {
+						len = sprintf(o, "None");
+					} else {
+						len = sprintf(o, "%04d-%02d-%02d", v >> 9, (v >> 5) & 15, v & 31);
+					}
+					break;
+				}
+				default:
+					goto err;
+			}
+			out.len += len;
+			if (quote) {
+				err1(out_reserve(&out, 1));
+				out.buf[out.len++] = quote;
+			}
+		}
+		err1(out_reserve(&out, 1));
+		out.buf[out.len++] = '\n';
+	}
+	err1(out_flush(&out));
+	res = 0;
+err:
+	for (int i = 0; i < n_cols; i++) {
+		if (cols[i].fh) gzclose(cols[i].fh);
+		if (cols[i].fd >= 0) close(cols[i].fd);
+		free(cols[i].buf);
+	}
+	if (out.gz && gzclose(out.gz)) res = 1;
+	if (out.fh && fclose(out.fh)) res = 1;
+	free(out.buf);
+	return res;
+}
+''', libraries=['z'], extra_compile_args=['-std=c99'])
+
 def csvexport(sliceno, filename, labelsonfirstline):
 	assert len(options.separator) == 1
 	assert options.quote_fields in ('', "'", '"',)
@@ -65,22 +443,26 @@ def csvexport(sliceno, filename, labelsonfirstline):
 			return open(filename, "wb")
 	else:
 		raise Exception("Filename should end with .gz for compressed or .csv for uncompressed")
-	iters = []
-	first = True
-	for label in options.labels:
-		it = d.iterate_list(sliceno, label, datasets.source, status_reporting=first)
-		first = False
-		t = d.columns[label].type
-		if t == 'unicode':
-			it = imap(lambda s: s.encode('utf-8'), it)
-		elif t in ('float32', 'float64', 'number'):
-			it = imap(repr, it)
-		elif t == 'json':
-			it = imap(dumps, it)
-		elif t not in ('ascii', 'bytes'):
-			it = imap(str, it)
-		iters.append(it)
-	it = izip(*iters)
+	use_c = all(ds.columns[label].type in c_types and c_readable(ds.columns[label].compression) for ds in datasets.source for label in options.labels)
+	if use_c:
+		it = ()
+	else:
+		iters = []
+		first = True
+		for label in options.labels:
+			it = d.iterate_list(sliceno, label, datasets.source, status_reporting=first)
+			first = False
+			t = d.columns[label].type
+			if t == 'unicode':
+				it = imap(lambda s: s.encode('utf-8'), it)
+			elif t in ('float32', 'float64', 'number'):
+				it = imap(repr, it)
+			elif t == 'json':
+				it = imap(dumps, it)
+			elif t not in ('ascii', 'bytes'):
+				it = imap(str, it)
+			iters.append(it)
+		it = izip(*iters)
 	with mkwrite(filename) as fh:
 		q = options.quote_fields
 		sep = options.separator
@@ -95,6 +477,17 @@ def csvexport(sliceno, filename, labelsonfirstline):
 				fh.write((sep.join(options.labels) + '\n').encode('utf-8'))
 			for data in it:
 				fh.write(sep.join(data) + '\n')
+	if use_c:
+		# Appends after the labels (as a new gzip member for .gz)
+		gz = filename.lower().endswith('.gz')
+		for ds in datasets.source:
+			with status('Exporting %s (slice %d)' % (ds, sliceno,)):
+				in_fns = [ffi.new('char []', ds.column_filename(label, sliceno).encode('ascii')) for label in options.labels]
+				types = [c_types[ds.columns[label].type] for label in options.labels]
+				raw = [ds.columns[label].compression == 'none' for label in options.labels]
+				offsets = [ds.columns[label].offsets[sliceno] if ds.columns[label].offsets else 0 for label in options.labels]
+				res = backend.export_slice(filename.encode('ascii'), gz, len(in_fns), in_fns, types, raw, offsets, ds.lines[sliceno], sep.encode('ascii'), q.encode('ascii') or b'\0')
+				assert not res, 'Failed to export %s' % (ds,)
 
 def analysis(sliceno):
 	if options.sliced:
@@ -107,9 +500,9 @@ def analysis(sliceno):
 def synthesis(params):
 	if not options.sliced:
 		filename = '%d.gz' if options.filename.lower().endswith('.gz') else '%d.csv'
-		with open(options.filename, "wb") as outfh:
-			for sliceno in range(params.slices):
-				with status("Assembling %s (%d/%d)" % (options.filename, sliceno, params.slices)):
-					with open(filename % sliceno, "rb") as infh:
-						copyfileobj(infh, outfh)
-					unlink(filename % sliceno)
+		fns = [filename % (sliceno,) for sliceno in range(params.slices)]
+		with status("Assembling %s" % (options.filename,)):
+			# gzip files can be concatenated, so this works for .gz too.
+			file_concat.concat(options.filename, fns)
+		for fn in fns:
+			unlink(fn)
@@ -24,6 +24,21 @@ CSV file to dataset.
 
 Read a CSV file, with any single character separator, with or without quotes.
 Labels from first line or specified in options.
+
+With byterange=True the file is only read once. It is split in line
+aligned byte ranges, one per slice, and each slice imports its own range.
+(Compressed files are decompressed once in prepare for this.) With a
+hashlabel each slice then spreads its lines to all slices, and the parts
+are put together in synthesis. This is much faster with many slices, but
+note that quoted fields can not contain newlines in this mode (as the
+ranges would no longer be line aligned), and lines do not end up in
+the same slices as without it.
+
+Columns in column2type are converted while importing, with the same C
+converters as dataset_type uses. (So only types dataset_type can convert
+in C are available.) Fields that fail
+to convert use the value from defaults if there is one, otherwise the
+line is counted as bad. Typing a hashlabel column still hashes the text.
 '''
 
 
@@ -35,6 +50,10 @@ from extras import OptionString
 import blob
 import gzutil
 from dataset import DatasetWriter
+from sourcedata import type2iter
+from . import dataset_typing
+
+depend_extra = (dataset_typing,)
 
 
 options = {
@@ -47,6 +66,9 @@ options = {
 	'rename'                    : {},    # Labels to replace (if they are in the file) (happens first)
 	'discard'                   : set(), # Labels to not include (if they are in the file)
 	'allow_bad'                 : False, # Still succeed if some lines have too few/many fields.
+	'byterange'                 : False, # Read the file once, split in byte ranges over the slices.
+	'column2type'               : {}, # {'COLNAME': type} to convert while importing (after rename), others are bytes.
+	'defaults'                  : {}, # {'COLNAME': value} for column2type fields that fail to convert, else the line is bad.
 }
 
 datasets = ('previous', )
@@ -54,11 +76,73 @@ datasets = ('previous', )
 
 ffi = cffi.FFI()
 ffi.cdef('''
-int import_slice(const char *fn, const int slices, const int sliceno, const int skip_line, const int field_count, const char *out_fns[], const char separator, int hash_idx, uint64_t *res_num, const int quote_support);
+int import_slice(const char *fn, const int64_t offset, const int64_t max_bytes, const int slices, const int sliceno, const int skip_line, const int field_count, const char *out_fns[], const char separator, int hash_idx, uint64_t *res_num, const int quote_support, const int spread, const int *col_types, const char *col_fmts[], const char *col_defaults[], const int *col_default_None, const char *minmax_fns[], uint64_t *default_counts);
 ''')
+
+conv_template = r'''
+static int conv_%(name)s(const char *line, char *ptr, const char *fmt)
+{
+%(convert)s
+	return !!ptr;
+}
+'''
+
+minmax_template = r'''
+static void minmax_setup_%(name)s(char *buf_col_min, char *buf_col_max)
+{
+	%(setup)s;
+}
+
+static void minmax_code_%(name)s(const char *ptr, char *buf_col_min, char *buf_col_max)
+{
+	%(code)s;
+}
+'''
+
+# The C type converters, in the order of the converters table in C.
+# col_types holds indexes into this.
+conv_names = []
+funcs = [dataset_typing.minmax_data, dataset_typing.noneval_data, dataset_typing.strptime_data]
+for name, mm in sorted(dataset_typing.minmaxfuncs.items()):
+	funcs.append(minmax_template % dict(name=name, setup=mm.setup, code=mm.code))
+converters = []
+for name, ct in sorted(dataset_typing.convfuncs.items()):
+	if not ct.conv_code_str:
+		continue
+	shortname = name.split(':', 1)[0]
+	destname = dataset_typing.typerename.get(shortname, shortname)
+	if destname.startswith('bits'):
+		noneval = 'NULL'
+	else:
+		noneval = '&noneval_' + destname
+	funcs.append(conv_template % dict(name=shortname, convert=ct.conv_code_str))
+	converters.append('\t{conv_%s, minmax_setup_%s, minmax_code_%s, %s, %d},\n' % (shortname, destname, destname, noneval, ct.size,))
+	conv_names.append(shortname)
+funcs.append('static const converter converters[] = {\n%s};\n' % (''.join(converters),))
+
 backend = ffi.verify(r'''
 #include <zlib.h>
 #include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <strings.h>
+#include <errno.h>
+#include <time.h>
+#include <math.h>
+#include <float.h>
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+
+typedef struct {
+	int (*conv)(const char *line, char *ptr, const char *fmt);
+	void (*minmax_setup)(char *buf_col_min, char *buf_col_max);
+	void (*minmax_code)(const char *ptr, char *buf_col_min, char *buf_col_max);
+	const void *noneval;
+	int size;
+} converter;
+''' + ''.join(funcs) + r'''
 
 #define err1(v) if (v) goto err
 #define Z (128 * 1024)
@@ -67,6 +151,7 @@ typedef struct {
 	gzFile fh;
 	int len;
 	int pos;
+	int64_t consumed;
 	char buf[Z + 1];
 } g;
 
@@ -93,6 +178,7 @@ static char *read_line(g *g)
 		if (read_chunk(g, linelen)) { // if eof
 			g->pos = g->len;
 			g->buf[linelen] = 0;
+			g->consumed += linelen;
 			return linelen ? g->buf : 0;
 		}
 		ptr = g->buf;
@@ -101,6 +187,7 @@ static char *read_line(g *g)
 	}
 	const int linelen = end - ptr;
 	g->pos += linelen + 1;
+	g->consumed += linelen + (*end == '\n');
 	ptr[linelen] = 0;
 	if (linelen && ptr[linelen - 1] == '\r') ptr[linelen - 1] = 0;
 	return ptr;
@@ -122,33 +209,75 @@ static char *read_line(g *g)
 		line = end + 1; \
 	} while (0)
 
-int import_slice(const char *fn, const int slices, const int sliceno, const int skip_line, const int field_count, const char *out_fns[], const char separator, int hash_idx, uint64_t *res_num, const int quote_support)
+// Reads max_bytes (or everything if < 0) from offset in fn.
+// Without spread only lines belonging to sliceno are kept (res_num[1]).
+// With spread all lines are kept, and written to out_fns[dest * field_count + i]
+// where dest is the slice the line belongs in (counted in res_num[1 + dest]).
+// If col_types is set fields with a type >= 0 are converted by converters[type],
+// and the minmax of the column is written to minmax_fns[field].
+int import_slice(const char *fn, const int64_t offset, const int64_t max_bytes, const int slices, const int sliceno, const int skip_line, const int field_count, const char *out_fns[], const char separator, int hash_idx, uint64_t *res_num, const int quote_support, const int spread, const int *col_types, const char *col_fmts[], const char *col_defaults[], const int *col_default_None, const char *minmax_fns[], uint64_t *default_counts)
 {
 	int res = 1;
 	g g;
-	g.fh = gzopen(fn, "rb");
-	if (!g.fh) return 1;
+	const int fd = open(fn, O_RDONLY);
+	if (fd < 0) return 1;
+	if (offset && lseek(fd, offset, SEEK_SET) != offset) {
+		close(fd);
+		return 1;
+	}
+	g.fh = gzdopen(fd, "rb");
+	if (!g.fh) {
+		close(fd);
+		return 1;
+	}
 	g.pos = g.len = 0;
+	g.consumed = 0;
 	char *line;
 	if (skip_line) read_line(&g);
-	gzFile outfh[field_count];
-	for (int i = 0; i < field_count; i++) {
+	const int out_count = spread ? field_count * slices : field_count;
+	gzFile outfh[out_count];
+	for (int i = 0; i < out_count; i++) {
 		outfh[i] = 0;
 	}
+	// uint64_t for alignment, each value is at most 8 bytes.
+	uint64_t convbuf[field_count];
+	uint64_t defbuf[field_count];
+	uint64_t minmaxbuf[field_count * 2];
+	int has_default[field_count];
+	int defaulted[field_count];
 	PyGILState_STATE gstate = PyGILState_Ensure();
 	uint64_t (*hash)(const void *ptr, const uint64_t len) = PyCapsule_Import("gzutil._C_hash", 0);
 	err1(!hash);
-	for (int i = 0; i < field_count; i++) {
+	for (int i = 0; i < out_count; i++) {
 		if (out_fns[i]) {
 			outfh[i] = gzopen(out_fns[i], "ab");
 			err1(!outfh[i]);
 		}
 	}
+	for (int i = 0; i < field_count; i++) {
+		has_default[i] = 0;
+		if (!col_types || col_types[i] < 0) continue;
+		const converter *c = converters + col_types[i];
+		c->minmax_setup((char *)(minmaxbuf + i * 2), (char *)(minmaxbuf + i * 2 + 1));
+		if (col_defaults[i]) {
+			err1(!c->conv(col_defaults[i], (char *)(defbuf + i), col_fmts[i]));
+			has_default[i] = 1;
+		} else if (col_default_None[i]) {
+			err1(!c->noneval);
+			memcpy(defbuf + i, c->noneval, c->size);
+			has_default[i] = 1;
+		}
+	}
 	long lineno = -1;
-	while ((line = read_line(&g))) {
+	while ((max_bytes < 0 || g.consumed < max_bytes) && (line = read_line(&g))) {
 		lineno++;
+		int dest = 0;
 		if (hash_idx == -1) {
-			if (lineno % slices != sliceno) continue;
+			if (spread) {
+				dest = lineno % slices;
+			} else if (lineno % slices != sliceno) {
+				continue;
+			}
 		}
 		char *field[field_count];
 		int field_len[field_count];
@@ -212,15 +341,44 @@ int import_slice(const char *fn, const int slices, const int sliceno, const int
 		}
 		if (hash_idx != -1) {
 			int h = hash(field[hash_idx], field_len[hash_idx]) % slices;
-			if (h != sliceno) continue;
+			if (spread) {
+				dest = h;
+			} else if (h != sliceno) {
+				continue;
+			}
 		}
+		if (col_types) {
+			for (int i = 0; i < field_count; i++) {
+				defaulted[i] = 0;
+				if (col_types[i] < 0) continue;
+				const converter *c = converters + col_types[i];
+				char *ptr = (char *)(convbuf + i);
+				// Fields are '\n' terminated, converters want NUL.
+				field[i][field_len[i]] = 0;
+				const int ok = c->conv(field[i], ptr, col_fmts[i]);
+				field[i][field_len[i]] = '\n';
+				if (!ok) {
+					if (!has_default[i]) goto bad;
+					memcpy(ptr, defbuf + i, c->size);
+					defaulted[i] = 1;
+				}
+			}
+		}
+		gzFile *dest_outfh = outfh + dest * field_count;
 		for (int i = 0; i < field_count; i++) {
-			if (outfh[i]) {
+			if (!dest_outfh[i]) continue;
+			if (col_types && col_types[i] >= 0) {
+				const converter *c = converters + col_types[i];
+				const char *ptr = (const char *)(convbuf + i);
+				c->minmax_code(ptr, (char *)(minmaxbuf + i * 2), (char *)(minmaxbuf + i * 2 + 1));
+				err1(gzwrite(dest_outfh[i], ptr, c->size) != c->size);
+				default_counts[i] += defaulted[i];
+			} else {
 				const int len = field_len[i] + 1;
-				err1(gzwrite(outfh[i], field[i], len) != len);
+				err1(gzwrite(dest_outfh[i], field[i], len) != len);
 			}
 		}
-		res_num[1]++;
+		res_num[1 + dest]++;
 		continue;
 bad:
 		if (!res_num[0]) {
@@ -228,9 +386,20 @@ bad:
 		}
 		res_num[0]++;
 	}
+	for (int i = 0; i < field_count; i++) {
+		if (!col_types || col_types[i] < 0 || !minmax_fns[i]) continue;
+		const int size = converters[col_types[i]].size;
+		gzFile minmaxfh = gzopen(minmax_fns[i], "wb");
+		err1(!minmaxfh);
+		int bad = 0;
+		if (gzwrite(minmaxfh, minmaxbuf + i * 2, size) != size) bad = 1;
+		if (gzwrite(minmaxfh, minmaxbuf + i * 2 + 1, size) != size) bad = 1;
+		if (gzclose(minmaxfh)) bad = 1;
+		err1(bad);
+	}
 	res = 0;
 err:
-	for (int i = 0; i < field_count; i++) {
+	for (int i = 0; i < out_count; i++) {
 		if (outfh[i] && gzclose(outfh[i])) res = 1;
 	}
 	gzclose(g.fh);
@@ -239,10 +408,93 @@ err:
 }
 ''', libraries=['z'], extra_compile_args=['-std=c99'])
 
-def prepare(SOURCE_DIRECTORY):
+def byterange_offsets(filename, slices):
+	"""Split filename in slices line aligned byte ranges.
+	Returns slices + 1 offsets, slice N gets offsets[N]:offsets[N + 1]."""
+	size = os.path.getsize(filename)
+	offsets = [0]
+	with open(filename, 'rb') as fh:
+		for sliceno in range(1, slices):
+			pos = max(size * sliceno // slices, offsets[-1])
+			if 0 < pos < size:
+				# Start after the first newline at or after pos - 1,
+				# so a range starting at a line start keeps that line.
+				fh.seek(pos - 1)
+				fh.readline()
+				pos = fh.tell()
+			offsets.append(min(pos, size))
+	offsets.append(size)
+	return offsets
+
+
+def parse_labels(labels_str, sep, quote_support):
+	"""Split the first line of a file into labels"""
+	labels_str = labels_str.decode('ascii', 'replace').encode('ascii', 'replace') # garbage -> '?'
+	if not quote_support:
+		return labels_str.split(sep)
+	labels = []
+	while labels_str is not None:
+		if labels_str.startswith(('"', "'",)):
+			q = labels_str[0]
+			pos = 1
+			while pos + 1 < len(labels_str):
+				pos = labels_str.find(q, pos)
+				if pos == -1: # all is lost
+					pos = len(labels_str) - 1
+				if pos + 1 == len(labels_str): # eol
+					break
+				if labels_str[pos + 1] == sep:
+					break
+				# we'll just assume it was a quote, because what else to do?
+				labels_str = labels_str[:pos] + labels_str[pos + 1:]
+				pos += 1
+			labels.append(labels_str[1:pos])
+			if len(labels_str) > pos + 1:
+				labels_str = labels_str[pos + 2:]
+			else:
+				labels_str = None
+		else:
+			if sep in labels_str:
+				field, labels_str = labels_str.split(sep, 1)
+			else:
+				field, labels_str = labels_str, None
+			labels.append(field)
+	return labels
+
+
+def get_labels(options, labels_str):
+	"""Labels from options or labels_str (the first line, or None), renamed"""
+	if labels_str is None:
+		labels = None
+	else:
+		labels = parse_labels(labels_str, options.separator, options.quote_support)
+	labels = options.labels or labels # only from file if not specified in options
+	assert labels, "No labels"
+	labels = [options.rename.get(x, x) for x in labels]
+	assert '' not in labels, "Empty label for column %d" % (labels.index(''),)
+	assert len(labels) == len(set(labels)), "Duplicate labels: %r" % (labels,)
+	return labels
+
+
+def get_columns(options, labels):
+	"""{label: type} for a DatasetWriter, from options.column2type"""
+	columns = {n: 'bytes' for n in labels if n not in options.discard}
+	for colname, coltype in options.column2type.items():
+		assert colname in columns, "Column %s in column2type is not in the file (or discarded)" % (colname,)
+		if ':' in coltype:
+			coltype, fmt = coltype.split(':', 1)
+			assert coltype + ':*' in dataset_typing.convfuncs, "Unknown type %s on column %s" % (coltype, colname,)
+		assert coltype in conv_names, "Type %s on column %s can not be converted in csvimport" % (coltype, colname,)
+		columns[colname] = dataset_typing.typerename.get(coltype, coltype)
+	for colname in options.defaults:
+		assert colname in options.column2type, "Default for column %s which is not in column2type" % (colname,)
+	return columns
+
+
+def prepare(SOURCE_DIRECTORY, params):
 	separator = options.separator
 	assert len(separator) == 1
-	filename  = os.path.join(SOURCE_DIRECTORY, options.filename)
+	filename = os.path.join(SOURCE_DIRECTORY, options.filename)
 	orig_filename = filename
 
 	if filename.lower().endswith('.zip'):
@@ -259,49 +511,28 @@ def prepare(SOURCE_DIRECTORY):
 					if not data:
 						break
 					ofh.write(data)
+	elif options.byterange:
+		with open(filename, 'rb') as fh:
+			is_gz = (fh.read(2) == b'\x1f\x8b')
+		if is_gz:
+			# Byte ranges need an uncompressed file, decompress it once.
+			from gzip import GzipFile
+			from shutil import copyfileobj
+			filename = 'extracted'
+			with GzipFile(orig_filename, 'rb') as zfh:
+				with open(filename, 'wb') as ofh:
+					copyfileobj(zfh, ofh, 1024 * 1024)
 
 	if options.labelsonfirstline:
 		with gzutil.GzBytesLines(filename, strip_bom=True) as fh:
-			labels_str = next(fh).decode('ascii', 'replace').encode('ascii', 'replace') # garbage -> '?'
-		if options.quote_support:
-			labels = []
-			sep = options.separator
-			while labels_str is not None:
-				if labels_str.startswith(('"', "'",)):
-					q = labels_str[0]
-					pos = 1
-					while pos + 1 < len(labels_str):
-						pos = labels_str.find(q, pos)
-						if pos == -1: # all is lost
-							pos = len(labels_str) - 1
-						if pos + 1 == len(labels_str): # eol
-							break
-						if labels_str[pos + 1] == sep:
-							break
-						# we'll just assume it was a quote, because what else to do?
-						labels_str = labels_str[:pos] + labels_str[pos + 1:]
-						pos += 1
-					labels.append(labels_str[1:pos])
-					if len(labels_str) > pos + 1:
-						labels_str = labels_str[pos + 2:]
-					else:
-						labels_str = None
-				else:
-					if sep in labels_str:
-						field, labels_str = labels_str.split(sep, 1)
-					else:
-						field, labels_str = labels_str, None
-					labels.append(field)
-		else:
-			labels = labels_str.split(options.separator)
-	labels = options.labels or labels # only from file if not specified in options
-	assert labels, "No labels"
-	labels = [options.rename.get(x, x) for x in labels]
-	assert '' not in labels, "Empty label for column %d" % (labels.index(''),)
-	assert len(labels) == len(set(labels)), "Duplicate labels: %r" % (labels,)
+			labels_str = next(fh)
+	else:
+		labels_str = None
+	labels = get_labels(options, labels_str)
+	columns = get_columns(options, labels)
 
 	dw = DatasetWriter(
-		columns={n: 'bytes' for n in labels},
+		columns=columns,
 		filename=orig_filename,
 		hashlabel=options.hashlabel,
 		caption='csvimport of ' + orig_filename,
@@ -309,13 +540,20 @@ def prepare(SOURCE_DIRECTORY):
 		meta_only=True,
 	)
 
-	return separator, filename, orig_filename, labels, dw,
+	if options.byterange:
+		offsets = byterange_offsets(filename, params.slices)
+	else:
+		offsets = None
 
+	return separator, filename, orig_filename, labels, dw, offsets,
 
-def analysis(sliceno, prepare_res, params):
-	""" reading complete file, writing to this slice only"""
 
-	separator, filename, _, labels, dw = prepare_res
+def import_file(options, filename, labels, dw, sliceno, slices, mode, skip_line, offset=0, max_bytes=-1):
+	"""Import (part of) filename into the meta_only DatasetWriter dw.
+	mode is "filter" to keep only the lines belonging in sliceno, "all" to
+	keep all lines in sliceno, or "spread" to write all lines to part files
+	in the slices they belong in (join those with join_parts).
+	Returns a dict of line counts (per slice for "spread") and minmax."""
 
 	if options.hashlabel:
 		hash_ix = labels.index(options.hashlabel)
@@ -325,40 +563,155 @@ def analysis(sliceno, prepare_res, params):
 	copied_lines = 0
 	n_labels = len(labels)
 
-	res_num = ffi.new('uint64_t [2]')
+	spread = (mode == 'spread')
+	if mode == 'all':
+		# Everything is for this slice.
+		slices_arg, slice_arg = 1, 0
+	else:
+		slices_arg, slice_arg = slices, sliceno
+
+	def out_fn(l, dest):
+		if l in options.discard:
+			return ffi.NULL
+		fn = dw.column_filename(l, dest)
+		if spread:
+			fn = '%s.part%d' % (fn, sliceno,)
+		return ffi.new('char []', fn.encode('ascii'))
+	if spread:
+		out_fns = [out_fn(l, dest) for dest in range(slices) for l in labels]
+		res_num = ffi.new('uint64_t []', slices + 1)
+	else:
+		out_fns = [out_fn(l, sliceno) for l in labels]
+		res_num = ffi.new('uint64_t []', 2)
 	res_num[0] = 0 # broken_lines
 	res_num[1] = copied_lines
-	out_fns = [ffi.NULL if l in options.discard else ffi.new('char []', dw.column_filename(l).encode('ascii')) for l in labels]
-	err = backend.import_slice(filename, params.slices, sliceno, options.labelsonfirstline, n_labels, out_fns, separator, hash_ix, res_num, options.quote_support)
+
+	typed = [l for l in labels if l in options.column2type and l not in options.discard]
+	if typed:
+		col_types = ffi.new('int []', n_labels)
+		col_fmts = ffi.new('char *[]', n_labels)
+		col_defaults = ffi.new('char *[]', n_labels)
+		col_default_None = ffi.new('int []', n_labels)
+		minmax_fns = ffi.new('char *[]', n_labels)
+		default_counts = ffi.new('uint64_t []', n_labels)
+		keep = [] # cffi only keeps the array alive, not the strings in it
+		def cstr(s):
+			keep.append(ffi.new('char []', s.encode('utf-8')))
+			return keep[-1]
+		for ix, l in enumerate(labels):
+			if l in typed:
+				coltype = options.column2type[l]
+				if ':' in coltype:
+					coltype, fmt = coltype.split(':', 1)
+					col_fmts[ix] = cstr(fmt)
+				col_types[ix] = conv_names.index(coltype)
+				default = options.defaults.get(l)
+				if default is not None:
+					col_defaults[ix] = cstr(default)
+				col_default_None[ix] = (l in options.defaults and default is None)
+				minmax_fns[ix] = cstr('minmax%d.%d' % (sliceno, ix,))
+			else:
+				col_types[ix] = -1
+	else:
+		col_types = col_fmts = col_defaults = col_default_None = minmax_fns = default_counts = ffi.NULL
+
+	err = backend.import_slice(filename, offset, max_bytes, slices_arg, slice_arg, skip_line, n_labels, out_fns, options.separator, hash_ix, res_num, options.quote_support, spread, col_types, col_fmts, col_defaults, col_default_None, minmax_fns, default_counts)
 	assert not err, "c import_slice returned error"
 
-	res = dict(
-		num_broken_lines = res_num[0],
-		num_lines        = res_num[1],
-	)
+	if spread:
+		res = dict(
+			num_broken_lines = res_num[0],
+			num_lines        = list(res_num[1:slices + 1]),
+		)
+		any_lines = any(res['num_lines'])
+	else:
+		res = dict(
+			num_broken_lines = res_num[0],
+			num_lines        = res_num[1],
+		)
+		any_lines = bool(res['num_lines'])
+	res['minmax'] = {}
+	res['num_defaulted'] = {}
+	for ix, l in enumerate(labels):
+		if l in typed:
+			minmax_fn = 'minmax%d.%d' % (sliceno, ix,)
+			if any_lines:
+				with type2iter[dw.columns[l][0]](minmax_fn) as it:
+					res['minmax'][l] = list(it)
+			os.unlink(minmax_fn)
+			res['num_defaulted'][l] = default_counts[ix]
 	return res
 
 
+def join_parts(dw, labels, slices):
+	"""Put together the part files from import_file in "spread" mode.
+	Parts that were never written (by slices that didn't read anything
+	for this dw) are skipped."""
+	from shutil import copyfileobj
+	for l in labels:
+		for sliceno in range(slices):
+			fn = dw.column_filename(l, sliceno)
+			with open(fn, 'wb') as ofh:
+				for partno in range(slices):
+					part_fn = '%s.part%d' % (fn, partno,)
+					if os.path.exists(part_fn):
+						with open(part_fn, 'rb') as ifh:
+							copyfileobj(ifh, ofh)
+						os.unlink(part_fn)
+
+
+def analysis(sliceno, prepare_res, params):
+	""" reading complete file (or our byterange), writing to this slice only
+	(or spreading to all slices, for byterange with hashlabel)"""
+
+	separator, filename, _, labels, dw, offsets = prepare_res
+
+	if offsets:
+		offset = offsets[sliceno]
+		max_bytes = offsets[sliceno + 1] - offset
+		skip_line = options.labelsonfirstline and sliceno == 0
+		mode = 'spread' if options.hashlabel else 'all'
+	else:
+		offset, max_bytes = 0, -1
+		skip_line = options.labelsonfirstline
+		mode = 'filter'
+	return import_file(options, filename, labels, dw, sliceno, params.slices, mode, skip_line, offset, max_bytes)
+
 
 def synthesis(prepare_res, analysis_res, params):
 	from math import sqrt
 
-	separator, filename, orig_filename, labels, dw = prepare_res
+	separator, filename, orig_filename, labels, dw, offsets = prepare_res
 	labels = [n for n in labels if n not in options.discard]
 
 	if filename != orig_filename:
 		os.unlink(filename)
 
+	analysis_res = list(analysis_res)
+	spread = offsets and options.hashlabel
+	if spread:
+		# Each slice wrote a part for every slice, put them together.
+		join_parts(dw, labels, params.slices)
+		lines_per_slice = [sum(tmp['num_lines'][sliceno] for tmp in analysis_res) for sliceno in range(params.slices)]
+	else:
+		lines_per_slice = [tmp['num_lines'] for tmp in analysis_res]
+
 	# aggregate typing and statistics
 	res = {}
 	res['num_broken_lines'] = 0
 	res['num_lines'] = 0
 	res['lines_per_slice'] = []
-	for sliceno, tmp in enumerate(analysis_res):
+	res['num_defaulted'] = {l: 0 for l in options.defaults}
+	for sliceno, (tmp, num_lines) in enumerate(zip(analysis_res, lines_per_slice)):
 		res['num_broken_lines'] += tmp['num_broken_lines']
-		res['num_lines']        += tmp['num_lines']
-		res['lines_per_slice'].append(tmp['num_lines'])
-		dw.set_lines(sliceno, tmp['num_lines'])
+		res['num_lines']        += num_lines
+		res['lines_per_slice'].append(num_lines)
+		dw.set_lines(sliceno, num_lines)
+		# With spread this is not the minmax of the slice, but it all gets merged anyway.
+		dw.set_minmax(sliceno, tmp['minmax'])
+		for l, cnt in tmp['num_defaulted'].items():
+			if l in res['num_defaulted']:
+				res['num_defaulted'][l] += cnt
 
 	blob.save(res, 'import')
 
@@ -381,6 +734,11 @@ def synthesis(prepare_res, analysis_res, params):
 	r.line()
 
 	r.println('Number of columns              %9d' % len(labels,))
+	if res['num_defaulted']:
+		r.line()
+		r.println('Defaulted values')
+		for l, cnt in sorted(res['num_defaulted'].items()):
+			r.println('  %-28s %9d' % (l, cnt,))
 	r.close()
 
 	if res['num_broken_lines'] and not options.allow_bad:
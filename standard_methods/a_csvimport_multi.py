@@ -0,0 +1,290 @@
+############################################################################
+#                                                                          #
+# Copyright (c) 2017 eBay Inc.                                             #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#  http://www.apache.org/licenses/LICENSE-2.0                              #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+#                                                                          #
+############################################################################
+
+from __future__ import division
+from __future__ import absolute_import
+
+description = r'''
+Many CSV files to one dataset (or a chain of datasets).
+
+filenames are relative to SOURCE_DIRECTORY and may be glob patterns,
+matching files are used in sorted order. All members of ZIP files are
+used (in archive order), streamed from the archive without extracting.
+
+Each file is read by only one slice, and the files are spread over the
+slices by size. Without a hashlabel lines stay in the slice that read
+them, with a hashlabel they are sent to the slice they hash to.
+
+With chain=True each file becomes a separate dataset, with the dataset
+from the file before it as previous (the first one gets datasets.previous).
+The last one is the default dataset, the others are named by their
+position in the list of files. Without chain all files go in one dataset.
+
+All files must have the same labels. Other options work as in csvimport.
+'''
+
+import os
+from glob import glob
+from zipfile import ZipFile
+
+import report
+from extras import OptionString
+import blob
+import gzutil
+from dataset import DatasetWriter
+from . import a_csvimport
+from . import dataset_typing
+
+depend_extra = (a_csvimport, dataset_typing,)
+
+
+options = {
+	'filenames'                 : [OptionString], # Globs are expanded, ZIP files contribute all members.
+	'separator'                 : ',',
+	'labelsonfirstline'         : True,
+	'labels'                    : [], # Mandatory if not labelsonfirstline, always sets labels if set.
+	'hashlabel'                 : None,
+	'quote_support'             : False, # 'foo',"bar" style CSV
+	'rename'                    : {},    # Labels to replace (if they are in the file) (happens first)
+	'discard'                   : set(), # Labels to not include (if they are in the file)
+	'allow_bad'                 : False, # Still succeed if some lines have too few/many fields.
+	'column2type'               : {}, # {'COLNAME': type} to convert while importing (after rename), others are bytes.
+	'defaults'                  : {}, # {'COLNAME': value} for column2type fields that fail to convert, else the line is bad.
+	'chain'                     : False, # One dataset per file, linked with previous.
+}
+
+datasets = ('previous', )
+
+
+def first_line(filename, member):
+	"""First line (without BOM) of filename or member in the ZIP filename,
+	or None if it is empty"""
+	if member:
+		with ZipFile(filename, 'r') as z:
+			fh = z.open(member)
+			line = fh.readline()
+			fh.close()
+		if line.startswith(b'\xef\xbb\xbf'):
+			line = line[3:]
+		return line.rstrip(b'\r\n') if line else None
+	else:
+		with gzutil.GzBytesLines(filename, strip_bom=True) as fh:
+			return next(fh, None)
+
+
+def import_member(filename, member, *a):
+	"""import_file for member in the ZIP filename, through a pipe from
+	a process reading the archive"""
+	from shutil import copyfileobj
+	rfd, wfd = os.pipe()
+	pid = os.fork()
+	if not pid:
+		os.close(rfd)
+		status = 1
+		try:
+			with ZipFile(filename, 'r') as z:
+				zfh = z.open(member)
+				with os.fdopen(wfd, 'wb') as ofh:
+					copyfileobj(zfh, ofh, 1024 * 1024)
+			status = 0
+		except Exception:
+			import traceback
+			traceback.print_exc()
+		finally:
+			os._exit(status)
+	os.close(wfd)
+	try:
+		res = a_csvimport.import_file(options, '/dev/fd/%d' % (rfd,), *a)
+	finally:
+		os.close(rfd)
+		_, status = os.waitpid(pid, 0)
+	assert status == 0, "Failed to read %s from %s" % (member, filename,)
+	return res
+
+
+def source_name(source):
+	filename, member, _ = source
+	if member:
+		return '%s:%s' % (filename, member,)
+	else:
+		return filename
+
+
+def prepare(SOURCE_DIRECTORY, params):
+	assert len(options.separator) == 1
+	sources = []
+	for pattern in options.filenames:
+		filenames = sorted(glob(os.path.join(SOURCE_DIRECTORY, pattern)))
+		assert filenames, "No files matching %r" % (pattern,)
+		for filename in filenames:
+			if filename.lower().endswith('.zip'):
+				with ZipFile(filename, 'r') as z:
+					for info in z.infolist():
+						if not info.filename.endswith('/'):
+							sources.append((filename, info.filename, info.file_size,))
+			else:
+				sources.append((filename, None, os.path.getsize(filename),))
+	assert sources, "No files"
+
+	labels = None
+	for source in sources:
+		if options.labelsonfirstline and not options.labels:
+			labels_str = first_line(*source[:2])
+			if labels_str is None:
+				continue # empty file, no lines to disagree with
+		else:
+			labels_str = None
+		source_labels = a_csvimport.get_labels(options, labels_str)
+		if labels is None:
+			labels = source_labels
+		assert source_labels == labels, "%s has labels %r, not %r" % (source_name(source), source_labels, labels,)
+	if labels is None: # only empty files
+		labels = a_csvimport.get_labels(options, None)
+	columns = a_csvimport.get_columns(options, labels)
+
+	def mkdw(name, caption, filename, previous):
+		return DatasetWriter(
+			columns=columns,
+			filename=filename,
+			hashlabel=options.hashlabel,
+			caption=caption,
+			previous=previous,
+			name=name,
+			meta_only=True,
+		)
+	if options.chain:
+		dws = []
+		previous = datasets.previous
+		for ix, source in enumerate(sources):
+			name = 'default' if ix == len(sources) - 1 else str(ix)
+			dws.append(mkdw(name, 'csvimport_multi of ' + source_name(source), source_name(source), previous))
+			previous = (params.jobid, name,)
+	else:
+		filename = ', '.join(options.filenames)
+		dws = [mkdw('default', 'csvimport_multi of ' + filename, filename, datasets.previous)]
+
+	# Slices that get no lines for a dataset still need (empty) files.
+	for dw in dws:
+		for l in labels:
+			if l not in options.discard:
+				for sliceno in range(params.slices):
+					open(dw.column_filename(l, sliceno), 'wb').close()
+
+	# Biggest file to the least loaded slice.
+	load = [0] * params.slices
+	assignments = [[] for _ in range(params.slices)]
+	for ix in sorted(range(len(sources)), key=lambda ix: -sources[ix][2]):
+		sliceno = load.index(min(load))
+		assignments[sliceno].append(ix)
+		load[sliceno] += sources[ix][2]
+	for slice_sources in assignments:
+		slice_sources.sort()
+
+	return labels, sources, assignments, dws,
+
+
+def analysis(sliceno, prepare_res, params):
+	labels, sources, assignments, dws = prepare_res
+	mode = 'spread' if options.hashlabel else 'all'
+	res = []
+	for ix in assignments[sliceno]:
+		filename, member, _ = sources[ix]
+		dw = dws[ix if options.chain else 0]
+		a = (labels, dw, sliceno, params.slices, mode, options.labelsonfirstline,)
+		if member:
+			source_res = import_member(filename, member, *a)
+		else:
+			source_res = a_csvimport.import_file(options, filename, *a)
+		res.append((ix, source_res,))
+	return res
+
+
+def synthesis(prepare_res, analysis_res, params):
+	labels, sources, assignments, dws = prepare_res
+	labels = [n for n in labels if n not in options.discard]
+
+	if options.hashlabel:
+		for dw in dws:
+			a_csvimport.join_parts(dw, labels, params.slices)
+
+	def minmax_update(mm, source_mm):
+		for l, (a, b) in source_mm.items():
+			if l in mm:
+				mm[l] = (min(a, mm[l][0]), max(b, mm[l][1]),)
+			else:
+				mm[l] = (a, b,)
+
+	res = {}
+	res['num_broken_lines'] = 0
+	res['num_lines'] = 0
+	res['lines_per_slice'] = [0] * params.slices
+	res['lines_per_file'] = [0] * len(sources)
+	res['num_defaulted'] = {l: 0 for l in options.defaults}
+	lines = [[0] * params.slices for _ in dws]
+	minmax = [[{} for _ in range(params.slices)] for _ in dws]
+	for sliceno, slice_res in enumerate(analysis_res):
+		for ix, tmp in slice_res:
+			dwix = ix if options.chain else 0
+			if options.hashlabel:
+				per_slice = enumerate(tmp['num_lines'])
+			else:
+				per_slice = [(sliceno, tmp['num_lines'])]
+			for dest, num_lines in per_slice:
+				lines[dwix][dest] += num_lines
+				res['lines_per_slice'][dest] += num_lines
+				res['lines_per_file'][ix] += num_lines
+			# Not the minmax of the slice with a hashlabel, but it all gets merged anyway.
+			minmax_update(minmax[dwix][sliceno], tmp['minmax'])
+			res['num_broken_lines'] += tmp['num_broken_lines']
+			for l, cnt in tmp['num_defaulted'].items():
+				if l in res['num_defaulted']:
+					res['num_defaulted'][l] += cnt
+	res['num_lines'] = sum(res['lines_per_slice'])
+	for dw, dw_lines, dw_minmax in zip(dws, lines, minmax):
+		for sliceno in range(params.slices):
+			dw.set_lines(sliceno, dw_lines[sliceno])
+			dw.set_minmax(sliceno, dw_minmax[sliceno])
+
+	blob.save(res, 'import')
+
+	# write report
+	r = report.report()
+	r.println('Number of rows read\n')
+	r.println('  file                                                         lines')
+	for source, nlines in zip(sources, res['lines_per_file']):
+		r.println('  %-50s  %15d' % (source_name(source)[-50:], nlines,))
+	r.println('  total                                               %15d' % (res['num_lines'],))
+	r.line()
+	r.println('  slice                            lines')
+	for sliceno, nlines in enumerate(res['lines_per_slice']):
+		if res['num_lines']:
+			r.println('    %2d                         %9d  (%6.2f%%)' % (sliceno, nlines, 100 * nlines / res['num_lines']))
+		else:
+			r.println('    %2d                         %9d' % (sliceno, nlines,))
+	r.line()
+	r.println('Number of files                %9d' % (len(sources),))
+	r.println('Number of columns              %9d' % (len(labels),))
+	if res['num_defaulted']:
+		r.line()
+		r.println('Defaulted values')
+		for l, cnt in sorted(res['num_defaulted'].items()):
+			r.println('  %-28s %9d' % (l, cnt,))
+	r.close()
+
+	if res['num_broken_lines'] and not options.allow_bad:
+		raise Exception('%d bad lines without options.allow_bad' % (res['num_broken_lines'],))
@@ -22,10 +22,33 @@ from __future__ import absolute_import
 description = r'''
 Like dataset_type, but can guess the type of columns (number or ascii)
 It does not look at previous, only the current dataset is considered.
+
+With guess=native more specific types are guessed: strbool (only for
+true/false/t/f/yes/no/on/off), int32_10, int64_10, float64, date and
+datetime (ISO 8601, optionally with microseconds). Columns that are
+none of these are number or ascii as usual (also integers that are too
+big for int64_10).
+
+The values are checked in C, without making python objects. With
+max_lines_per_slice only the first that many lines of each slice are
+looked at. That is faster, but a later value may fail to convert (use
+filter_bad or defaults if that is a problem).
+
+The guessed types and the ranges of the values are in result.json.
 '''
 
+import cffi
+from datetime import date, datetime
+
 from dataset import Dataset
 from subjobs import build
+from extras import OptionEnum, json_save
+from report import report
+from . import dataset_typing
+
+depend_extra = (dataset_typing,)
+
+GuessEnum = OptionEnum('number native')
 
 options = {
 	'column2type'               : {}, # {'COLNAME': 'type'}, for columns where you don't want autodetection
@@ -38,10 +61,234 @@ options = {
 	'discard_untyped'           : bool,  # Make unconverted columns inaccessible ("new" dataset)
 	'filter_bad'                : False, # Implies discard_untyped, only applies to manually typed columns.
 	'numeric_comma'             : False, # floats as "3,14"
+	'guess'                     : GuessEnum.number, # number: number or ascii, native: see description
+	'max_lines_per_slice'       : 0,     # Only look at this many lines in each slice (0 for all)
 }
 
 datasets = ('source', 'previous',)
 
+# Candidate types, in the order the C code has them, which is also the
+# order of preference with guess=native. (name, dataset_type type)
+# int becomes int32_10 or int64_10 depending on the range. bigint is
+# integers of any size, so number is preferred over float for those.
+candidates = (
+	('bool'       , 'strbool'                       ),
+	('int'        , None                            ),
+	('float'      , 'float64'                       ),
+	('number'     , 'number'                        ),
+	('date'       , 'date:%Y-%m-%d'                 ),
+	('datetime'   , 'datetime:%Y-%m-%d %H:%M:%S'    ),
+	('datetimeT'  , 'datetime:%Y-%m-%dT%H:%M:%S'    ),
+	('datetimef'  , 'datetime:%Y-%m-%d %H:%M:%S.%f' ),
+	('datetimeTf' , 'datetime:%Y-%m-%dT%H:%M:%S.%f' ),
+	('bigint'     , 'number'                        ),
+)
+N_CAND = len(candidates)
+
+sniff_res_decl = r'''
+typedef struct {
+	uint64_t lines;
+	int      ok[%d];
+	int64_t  int_min;
+	int64_t  int_max;
+	double   float_min[%d];
+	double   float_max[%d];
+	uint64_t packed_min[%d];
+	uint64_t packed_max[%d];
+} sniff_res;
+''' % ((N_CAND,) * 5)
+
+ffi = cffi.FFI()
+ffi.cdef(sniff_res_decl + r'''
+int sniff_column(const char *in_fn, size_t offset, int64_t max_count, sniff_res *res);
+int numeric_comma(void);
+''')
+backend = ffi.verify(r'''
+#include <zlib.h>
+#include <time.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <strings.h>
+#include <errno.h>
+#include <locale.h>
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+
+#define Z (128 * 1024)
+
+typedef struct {
+	gzFile fh;
+	int len;
+	int pos;
+	char buf[Z + 1];
+} g;
+
+int numeric_comma(void)
+{
+	return !setlocale(LC_NUMERIC, "sv_SE.UTF-8");
+}
+
+static int read_chunk(g *g, int offset)
+{
+	const int len = gzread(g->fh, g->buf + offset, Z - offset);
+	if (len <= 0) return 1;
+	g->len = offset + len;
+	g->buf[g->len] = 0;
+	g->pos = 0;
+	return 0;
+}
+
+static char *read_line(g *g)
+{
+	if (g->pos >= g->len) {
+		if (read_chunk(g, 0)) return 0;
+	}
+	char *ptr = g->buf + g->pos;
+	char *end = strchr(ptr, '\n');
+	if (!end) {
+		const int linelen = g->len - g->pos;
+		memmove(g->buf, g->buf + g->pos, linelen);
+		if (read_chunk(g, linelen)) { // if eof
+			g->pos = g->len;
+			g->buf[linelen] = 0;
+			return linelen ? g->buf : 0;
+		}
+		ptr = g->buf;
+		end = strchr(ptr, '\n');
+		if (!end) end = ptr + g->len; // very long line - split it
+	}
+	const int linelen = end - ptr;
+	g->pos += linelen + 1;
+	ptr[linelen] = 0;
+	if (linelen && ptr[linelen - 1] == '\r') ptr[linelen - 1] = 0;
+	return ptr;
+}
+''' + sniff_res_decl + dataset_typing.strptime_data + r'''
+static int is_space(const char c)
+{
+	return c == 32 || (c >= 9 && c <= 13);
+}
+
+// Nothing but whitespace left
+static int at_end(const char *s)
+{
+	while (is_space(*s)) s++;
+	return !*s;
+}
+
+static void float_minmax(sniff_res *res, const int cand, const double v)
+{
+	if (v < res->float_min[cand]) res->float_min[cand] = v;
+	if (v > res->float_max[cand]) res->float_max[cand] = v;
+}
+
+static void packed_minmax(sniff_res *res, const int cand, const uint64_t v)
+{
+	if (v < res->packed_min[cand]) res->packed_min[cand] = v;
+	if (v > res->packed_max[cand]) res->packed_max[cand] = v;
+}
+
+// Clears the candidates in res->ok that value is not valid for.
+static void sniff_value(const char *line, sniff_res *res)
+{
+	static const char *bools[] = {"true", "false", "t", "f", "yes", "no", "on", "off"};
+	static const char *date_fmts[] = {"%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S.%f"};
+	int *ok = res->ok;
+	while (is_space(*line)) line++;
+	if (!*line) { // Empty values are only ok for strings.
+		memset(ok, 0, sizeof(res->ok));
+		return;
+	}
+	if (ok[0]) {
+		int found = 0;
+		for (size_t i = 0; i < sizeof(bools) / sizeof(*bools); i++) {
+			found |= !strcasecmp(line, bools[i]);
+		}
+		ok[0] = found;
+	}
+	if (ok[1] || ok[9]) {
+		char *end;
+		errno = 0;
+		const long long v = strtoll(line, &end, 10);
+		if (!at_end(end)) {
+			ok[1] = ok[9] = 0;
+		} else if (errno) { // An integer, but too big for int64.
+			ok[1] = 0;
+		} else {
+			if (v < res->int_min) res->int_min = v;
+			if (v > res->int_max) res->int_max = v;
+		}
+	}
+	if (ok[2] || ok[3]) {
+		char *end;
+		const double v = strtod(line, &end);
+		if (!at_end(end)) {
+			ok[2] = ok[3] = 0;
+		} else {
+			if (ok[2]) float_minmax(res, 2, v);
+			// Like the number converter, only plain decimal numbers.
+			if (strpbrk(line, "xXpPnNiI")) ok[3] = 0;
+			if (ok[3]) float_minmax(res, 3, v);
+		}
+	}
+	for (int i = 0; i < 5; i++) {
+		const int cand = 4 + i;
+		if (!ok[cand]) continue;
+		struct tm tm;
+		uint32_t usec;
+		memset(&tm, 0, sizeof(tm));
+		const char *end = strptime_f(line, date_fmts[i], &tm, &usec);
+		if (!end || !at_end(end)) {
+			ok[cand] = 0;
+		} else if (i == 0) {
+			packed_minmax(res, cand, (uint64_t)(tm.tm_year + 1900) << 9 | (uint64_t)(tm.tm_mon + 1) << 5 | tm.tm_mday);
+		} else {
+			const uint64_t p0 = (uint64_t)(tm.tm_year + 1900) << 14 | (uint64_t)(tm.tm_mon + 1) << 10 | (uint64_t)tm.tm_mday << 5 | tm.tm_hour;
+			const uint64_t p1 = (uint64_t)tm.tm_min << 26 | (uint64_t)tm.tm_sec << 20 | usec;
+			packed_minmax(res, cand, p0 << 32 | p1);
+		}
+	}
+}
+
+int sniff_column(const char *in_fn, size_t offset, int64_t max_count, sniff_res *res)
+{
+	g g;
+	const char *line;
+	int fd = open(in_fn, O_RDONLY);
+	if (fd < 0) return 1;
+	if (lseek(fd, offset, 0) != (off_t)offset) {
+		close(fd);
+		return 1;
+	}
+	g.fh = gzdopen(fd, "rb");
+	if (!g.fh) {
+		close(fd);
+		return 1;
+	}
+	g.pos = g.len = 0;
+	res->lines = 0;
+	for (size_t i = 0; i < sizeof(res->ok) / sizeof(*res->ok); i++) {
+		res->ok[i] = 1;
+		res->float_min[i] = 1.0 / 0.0;
+		res->float_max[i] = -1.0 / 0.0;
+		res->packed_min[i] = UINT64_MAX;
+		res->packed_max[i] = 0;
+	}
+	res->int_min = INT64_MAX;
+	res->int_max = INT64_MIN;
+	if (max_count < 0) max_count = INT64_MAX;
+	for (; (int64_t)res->lines < max_count && (line = read_line(&g)); res->lines++) {
+		sniff_value(line, res);
+	}
+	gzclose(g.fh);
+	return 0;
+}
+''', libraries=['z'], extra_compile_args=['-std=c99'])
+
+
 def prepare():
 	assert (not options.exclude) or (not options.include), "Specify at most one of exclude and include"
 	cols = set(datasets.source.columns)
@@ -54,36 +301,97 @@ def prepare():
 	return cols - options.exclude - set(options.column2type)
 
 def analysis(sliceno, prepare_res):
-	badnesses = {}
+	if options.numeric_comma:
+		if backend.numeric_comma():
+			raise Exception("Failed to enable numeric_comma")
 	d = datasets.source
+	res = {}
 	for colname in prepare_res:
-		badness = 0
-		for v in d.iterate(sliceno, colname):
-			if badness < 1:
-				try:
-					int(v, 10)
-				except ValueError:
-					badness = 1
-			try:
-				if options.numeric_comma:
-					v = v.replace(".", "nope").replace(",", ".")
-				float(v)
-			except ValueError:
-				badness = 2
-				break
-		badnesses[colname] = badness
-	return badnesses
+		assert d.columns[colname].compression.startswith('gzip'), "Can't read %s compressed column %s" % (d.columns[colname].compression, colname,)
+		in_fn = d.column_filename(colname, sliceno).encode('ascii')
+		if d.columns[colname].offsets:
+			offset = d.columns[colname].offsets[sliceno]
+			max_count = d.lines[sliceno]
+		else:
+			offset = 0
+			max_count = -1
+		if options.max_lines_per_slice:
+			max_count = min(max_count % (2 ** 63), options.max_lines_per_slice)
+		sniff = ffi.new('sniff_res *')
+		assert not backend.sniff_column(in_fn, offset, max_count, sniff), "Failed to read " + colname
+		res[colname] = (
+			sniff.lines,
+			list(sniff.ok),
+			(sniff.int_min, sniff.int_max,),
+			zip(sniff.float_min, sniff.float_max),
+			zip(sniff.packed_min, sniff.packed_max),
+		)
+	return res
+
+def unpack(name, v):
+	if name == 'date':
+		return date(v >> 9, (v >> 5) & 15, v & 31)
+	p0, p1 = v >> 32, v & 0xffffffff
+	return datetime(p0 >> 14, (p0 >> 10) & 15, (p0 >> 5) & 31, p0 & 31, p1 >> 26, (p1 >> 20) & 63, p1 & 0xfffff)
+
+def guess(lines, ok, int_range, float_ranges, packed_ranges):
+	# (type, (min, max)) for a column, or (type, None) without a range.
+	if not lines: # Nothing says it isn't.
+		return 'number', None
+	if options.guess != 'native':
+		if ok[3]:
+			return 'number', float_ranges[3]
+		return 'ascii:encode', None
+	for ix, (name, coltype) in enumerate(candidates):
+		if not ok[ix]:
+			continue
+		if name == 'int':
+			if -0x7fffffff <= int_range[0] and int_range[1] <= 0x7fffffff:
+				return 'int32_10', int_range
+			else:
+				return 'int64_10', int_range
+		elif name == 'float' and ok[9] and ok[3]:
+			# Integers too big for int64, number keeps them exact.
+			return 'number', float_ranges[3]
+		elif name in ('float', 'number'):
+			return coltype, float_ranges[ix]
+		elif name.startswith('date'):
+			return coltype, tuple(str(unpack(name, v)) for v in packed_ranges[ix])
+		else:
+			return coltype, None
+	return 'ascii:encode', None
 
 def synthesis(analysis_res, params):
-	badnesses = next(analysis_res)
-	for tmp in analysis_res:
-		badnesses = {k: max(badnesses[k], tmp[k]) for k in tmp}
-	badness2type = {
-		0: "number", # this used to be int64_10
-		1: "number", # and this used to be float64
-		2: "ascii:encode",
-	}
-	types = {k: badness2type[v] for k, v in badnesses.iteritems()}
+	merged = {}
+	for slice_res in analysis_res:
+		for colname, (lines, ok, int_range, float_ranges, packed_ranges) in slice_res.iteritems():
+			if colname not in merged:
+				merged[colname] = [lines, ok, int_range, float_ranges, packed_ranges]
+				continue
+			m = merged[colname]
+			if not lines:
+				continue
+			if not m[0]:
+				merged[colname] = [lines, ok, int_range, float_ranges, packed_ranges]
+				continue
+			m[0] += lines
+			m[1] = [a and b for a, b in zip(m[1], ok)]
+			m[2] = (min(m[2][0], int_range[0]), max(m[2][1], int_range[1]),)
+			m[3] = [(min(a[0], b[0]), max(a[1], b[1]),) for a, b in zip(m[3], float_ranges)]
+			m[4] = [(min(a[0], b[0]), max(a[1], b[1]),) for a, b in zip(m[4], packed_ranges)]
+	types = {}
+	ranges = {}
+	for colname, m in merged.iteritems():
+		types[colname], ranges[colname] = guess(*m)
+	r = report()
+	r.println('Guessed type                      Column')
+	for colname in sorted(types):
+		if ranges[colname]:
+			r.println('%-32s  %s  (%s - %s)' % (types[colname], colname, ranges[colname][0], ranges[colname][1],))
+		else:
+			r.println('%-32s  %s' % (types[colname], colname,))
+	r.close()
+	json_save(dict(types=types, ranges=ranges, lines_looked_at={k: m[0] for k, m in merged.iteritems()}))
 	types.update(options.column2type)
 	sub_opts = dict(
 		column2type     = types,
@@ -33,31 +33,266 @@ options.columns defaults to all columns in the source dataset.
 
 Note that this uses about 64 bytes of RAM per line, so you can't sum huge
 datasets. (So one GB per 20M lines or so.)
+
+With options.hashsum=True each line gets a 128 bit hash instead, and the
+checksum is the sum of those (modulo 2**128). That doesn't depend on
+order (so sort doesn't matter) and uses no memory per line. The hashes
+are of the values as they are stored, so this sum is not comparable to
+the md5 one, and columns also have to have the same types.
 '''
 
+import cffi
 from hashlib import md5
 from itertools import chain
 from extras import DotDict
+from sourcedata import c_readable
 
 options = dict(
 	columns      = set(),
 	sort         = True,
+	hashsum      = False, # order independent sum of line hashes, computed in C
 )
 
 datasets = ('source',)
 
+# How the C code reads the columns: > 0 is the width of fixed width
+# types, 0 is lines and -1 is number.
+type_widths = {
+	'ascii'   : 0,
+	'bytes'   : 0,
+	'unicode' : 0,
+	'json'    : 0,
+	'number'  : -1,
+	'int64'   : 8,
+	'int32'   : 4,
+	'bits64'  : 8,
+	'bits32'  : 4,
+	'bool'    : 1,
+	'float64' : 8,
+	'float32' : 4,
+	'datetime': 8,
+	'date'    : 4,
+	'time'    : 8,
+}
+
+ffi = cffi.FFI()
+ffi.cdef('''
+int hashsum_slice(const int n_cols, const char *in_fns[], const int *widths, const int *raw, const int64_t *offsets, const int64_t lines, uint64_t *res);
+''')
+backend = ffi.verify(r'''
+#include <zlib.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+
+#define err1(v) if (v) goto err
+#define Z (128 * 1024)
+
+typedef struct {
+	gzFile fh;
+	int fd; // instead of fh for uncompressed columns
+	char *buf;
+	int size;
+	int len;
+	int pos;
+} col_t;
+
+// Move what is left to the start of the buffer (growing it if full) and read more.
+static int col_fill(col_t *c)
+{
+	const int left = c->len - c->pos;
+	if (left && c->pos) memmove(c->buf, c->buf + c->pos, left);
+	c->len = left;
+	c->pos = 0;
+	if (c->len == c->size) {
+		char *buf = realloc(c->buf, c->size * 2);
+		if (!buf) return -1;
+		c->buf = buf;
+		c->size *= 2;
+	}
+	const int len = c->fh ? gzread(c->fh, c->buf + c->len, c->size - c->len) : read(c->fd, c->buf + c->len, c->size - c->len);
+	if (len < 0) return -1;
+	c->len += len;
+	return len;
+}
+
+static const char *col_read(col_t *c, const int size)
+{
+	while (c->len - c->pos < size) {
+		if (col_fill(c) <= 0) return 0;
+	}
+	const char *res = c->buf + c->pos;
+	c->pos += size;
+	return res;
+}
+
+// Lines can contain NUL, so no strchr here.
+static const char *col_read_line(col_t *c, int *len)
+{
+	char *end;
+	while (!(end = memchr(c->buf + c->pos, '\n', c->len - c->pos))) {
+		if (col_fill(c) <= 0) return 0;
+	}
+	const char *res = c->buf + c->pos;
+	*len = end - res;
+	c->pos += *len + 1;
+	return res;
+}
+
+// A simple 2x64 bit hash, fed a word at a time. Not cryptographic,
+// but it only has to make accidentally equal sums unlikely.
+typedef struct {
+	uint64_t a;
+	uint64_t b;
+} hash_t;
+
+static inline uint64_t rotl(const uint64_t v, const int n)
+{
+	return (v << n) | (v >> (64 - n));
+}
+
+static inline void hash_word(hash_t *h, const uint64_t w)
+{
+	h->a = rotl((h->a ^ w) * 0x9e3779b97f4a7c15ULL, 31);
+	h->b = rotl((h->b ^ w) * 0xc2b2ae3d27d4eb4fULL, 29) + h->a;
+}
+
+// The length goes in first, so values can't run into each other.
+static void hash_bytes(hash_t *h, const char *ptr, const int len)
+{
+	int pos = 0;
+	hash_word(h, len);
+	for (; pos + 8 <= len; pos += 8) {
+		uint64_t w;
+		memcpy(&w, ptr + pos, 8);
+		hash_word(h, w);
+	}
+	if (pos < len) {
+		uint64_t w = 0;
+		memcpy(&w, ptr + pos, len - pos);
+		hash_word(h, w);
+	}
+}
+
+static inline uint64_t fmix64(uint64_t k)
+{
+	k ^= k >> 33;
+	k *= 0xff51afd7ed558ccdULL;
+	k ^= k >> 33;
+	k *= 0xc4ceb9fe1a85ec53ULL;
+	k ^= k >> 33;
+	return k;
+}
+
+int hashsum_slice(const int n_cols, const char *in_fns[], const int *widths, const int *raw, const int64_t *offsets, const int64_t lines, uint64_t *res)
+{
+	int err = 1;
+	col_t cols[n_cols];
+	uint64_t sum_lo = 0, sum_hi = 0;
+	memset(cols, 0, sizeof(cols));
+	for (int i = 0; i < n_cols; i++) cols[i].fd = -1;
+	for (int i = 0; i < n_cols; i++) {
+		const int fd = open(in_fns[i], O_RDONLY);
+		err1(fd < 0);
+		if (lseek(fd, offsets[i], 0) != offsets[i]) {
+			close(fd);
+			goto err;
+		}
+		if (raw[i]) {
+			cols[i].fd = fd;
+		} else if (!(cols[i].fh = gzdopen(fd, "rb"))) {
+			close(fd);
+			goto err;
+		}
+		cols[i].size = Z;
+		cols[i].buf = malloc(Z);
+		err1(!cols[i].buf);
+	}
+	for (int64_t line = 0; line < lines; line++) {
+		hash_t h = {0x243f6a8885a308d3ULL, 0x13198a2e03707344ULL};
+		for (int i = 0; i < n_cols; i++) {
+			const int width = widths[i];
+			const char *ptr;
+			int len;
+			if (width > 0) {
+				len = width;
+				ptr = col_read(cols + i, len);
+			} else if (width == 0) {
+				ptr = col_read_line(cols + i, &len);
+			} else {
+				// 0 is None, 1 is a double, 8 is an int64, else that many bytes.
+				ptr = col_read(cols + i, 1);
+				err1(!ptr);
+				const unsigned char n = *ptr;
+				len = (n == 1 || n == 8) ? 9 : n ? n + 1 : 1;
+				cols[i].pos--; // all of it in one piece
+				ptr = col_read(cols + i, len);
+			}
+			err1(!ptr);
+			hash_bytes(&h, ptr, len);
+		}
+		const uint64_t lo = fmix64(h.a ^ rotl(h.b, 17));
+		const uint64_t hi = fmix64(h.b + lo);
+		sum_lo += lo;
+		sum_hi += hi + (sum_lo < lo); // carry
+	}
+	res[0] = sum_lo;
+	res[1] = sum_hi;
+	err = 0;
+err:
+	for (int i = 0; i < n_cols; i++) {
+		if (cols[i].fh) gzclose(cols[i].fh);
+		if (cols[i].fd >= 0) close(cols[i].fd);
+		free(cols[i].buf);
+	}
+	return err;
+}
+''', libraries=['z'], extra_compile_args=['-std=c99'])
+
+# These are also used by dataset_checksum_chain.
+
+def line_digests(ds, sliceno, columns):
+	src = ds.iterate(sliceno, columns)
+	return [md5('\0'.join(map(str, line))).digest() for line in src]
+
+def combine_digests(digests, sort):
+	if sort:
+		digests = sorted(digests)
+	return int(md5(''.join(digests)).hexdigest(), 16)
+
+def hashsum(ds, sliceno, columns):
+	for n in columns:
+		assert c_readable(ds.columns[n].compression), "hashsum can't read %s compressed column %s in %s" % (ds.columns[n].compression, n, ds,)
+	in_fns = [ffi.new('char []', ds.column_filename(n, sliceno).encode('ascii')) for n in columns]
+	widths = [type_widths[ds.columns[n].type] for n in columns]
+	raw = [ds.columns[n].compression == 'none' for n in columns]
+	offsets = [ds.columns[n].offsets[sliceno] if ds.columns[n].offsets else 0 for n in columns]
+	res = ffi.new('uint64_t [2]')
+	assert not backend.hashsum_slice(len(columns), in_fns, widths, raw, offsets, ds.lines[sliceno], res), "Failed to read %s slice %d" % (ds, sliceno,)
+	return res[0] | res[1] << 64
+
+def combine_hashsums(sums):
+	return sum(sums) % (1 << 128)
+
+
 def prepare():
 	return sorted(options.columns or datasets.source.columns)
 
 def analysis(sliceno, prepare_res):
 	columns = prepare_res
-	src = datasets.source.iterate(sliceno, columns)
-	return [md5('\0'.join(map(str, line))).digest() for line in src]
+	if options.hashsum:
+		return hashsum(datasets.source, sliceno, columns)
+	return line_digests(datasets.source, sliceno, columns)
 
 def synthesis(prepare_res, analysis_res):
-	all = chain.from_iterable(analysis_res)
-	if options.sort:
-		all = sorted(all)
-	res = md5(''.join(all)).hexdigest()
-	print("%s: %s" % (datasets.source, res,))
-	return DotDict(sum=int(res, 16), sort=options.sort, columns=prepare_res, source=datasets.source)
+	if options.hashsum:
+		res = combine_hashsums(analysis_res)
+		print("%s: %032x" % (datasets.source, res,))
+		return DotDict(sum=res, hashsum=True, columns=prepare_res, source=datasets.source)
+	res = combine_digests(chain.from_iterable(analysis_res), options.sort)
+	print("%s: %032x" % (datasets.source, res,))
+	return DotDict(sum=res, sort=options.sort, columns=prepare_res, source=datasets.source)
@@ -28,26 +28,70 @@ datasets.source is mandatory, datasets.stop is optional.
 options.chain_length defaults to -1.
 
 Sort does not sort across datasets.
+
+All datasets are checksummed in this job, each slice goes through the
+whole chain. The total is the xor of the checksums of the datasets, which
+are in the result as sums (in chain order), so the checksum of the chain
+up to any dataset can be checked too.
+
+With jobids.previous (an earlier dataset_checksum_chain with the same
+options) the sums of the datasets it already has are reused, so only
+the new datasets are read.
 '''
 
-from subjobs import build
-from extras import DotDict
+from extras import DotDict, job_params
 import blob
+from . import a_dataset_checksum
+
+depend_extra = (a_dataset_checksum,)
 
 options = dict(
 	chain_length = -1,
 	columns      = set(),
 	sort         = True,
+	hashsum      = False, # see dataset_checksum
 )
 
 datasets = ('source', 'stop',)
+jobids = ('previous',)
 
-def synthesis():
-	sum = 0
+def prepare():
 	jobs = datasets.source.chain(length=options.chain_length, stop_ds=datasets.stop)
-	for src in jobs:
-		jid = build('dataset_checksum', options=dict(columns=options.columns, sort=options.sort), datasets=dict(source=src))
-		data = blob.load(jobid=jid)
-		sum ^= data.sum
-	print("Total: %016x" % (sum,))
-	return DotDict(sum=sum, columns=data.columns, sort=options.sort, sources=jobs)
+	known = {}
+	if jobids.previous:
+		prev_options = job_params(jobids.previous).options
+		assert set(prev_options.columns) == set(options.columns), "previous has different columns"
+		assert (prev_options.sort, prev_options.hashsum) == (options.sort, options.hashsum), "previous has different sort or hashsum"
+		prev = blob.load(jobid=jobids.previous)
+		known = dict(zip(prev.sources, prev.sums))
+	# (src, columns, sum from previous or None)
+	return [(src, sorted(options.columns or src.columns), known.get(src),) for src in jobs]
+
+def analysis(sliceno, prepare_res):
+	todo = [(ix, src, columns) for ix, (src, columns, known) in enumerate(prepare_res) if known is None]
+	if options.hashsum:
+		return {ix: a_dataset_checksum.hashsum(src, sliceno, columns) for ix, src, columns in todo}
+	# The digests are only needed one dataset at a time in synthesis.
+	for ix, src, columns in todo:
+		digests = a_dataset_checksum.line_digests(src, sliceno, columns)
+		blob.save(digests, 'digests.%d' % (ix,), sliceno=sliceno, temp=True)
+
+def synthesis(prepare_res, analysis_res, params):
+	if options.hashsum:
+		per_slice = list(analysis_res)
+	sums = []
+	total = 0
+	for ix, (src, columns, known) in enumerate(prepare_res):
+		if known is not None:
+			res = known
+		elif options.hashsum:
+			res = a_dataset_checksum.combine_hashsums(slice_res[ix] for slice_res in per_slice)
+		else:
+			digests = []
+			for sliceno in range(params.slices):
+				digests.extend(blob.load('digests.%d' % (ix,), sliceno=sliceno))
+			res = a_dataset_checksum.combine_digests(digests, options.sort)
+		sums.append(res)
+		total ^= res
+	print("Total: %016x" % (total,))
+	return DotDict(sum=total, sums=sums, columns=columns, sort=options.sort, hashsum=options.hashsum, sources=[src for src, _, _ in prepare_res])
@@ -30,6 +30,14 @@ spilled data from them (for fast re-reading, when there isn't much of it).
 Intended to be used in a continually trailing chain from some source with
 less than perfect date splitting.
 
+Datasets where the date column min/max shows that all lines end up in
+the same place are not written when nothing has to be written from
+them, and copied without recompressing when everything is included.
+They are only read for the min/max of each slice, which is not needed
+for already handled lines or datasets written with block_rows. For
+re-read datasets the same is done with the min/max of what they spilled
+last time.
+
 You can extract spilled data by not specifying a source, optionally into
 several datasets by incrementing split_date, or all at once by not setting
 any split_date.
@@ -45,11 +53,12 @@ import cffi
 from os.path import exists
 from datetime import datetime, date, time
 from os import unlink
+from gzip import GzipFile
 
 from extras import OptionString, json_save, job_params, DotDict
 from dataset import Dataset, DatasetWriter
 from . import dataset_typing
-from sourcedata import type2iter
+from sourcedata import type2iter, c_readable
 import blob
 
 
@@ -91,7 +100,7 @@ minmax_code = dataset_typing.minmax_data + ''.join(funcs) + r'''
 
 ffi = cffi.FFI()
 ffi.cdef(r'''
-int filter(const int count, const char *in_files[], const size_t offsets[], const char *out_files[], const char *minmax_files[], const int sizes[], uint64_t counters[4], const uint32_t dates[6], const int minmax_typeidx[], const int64_t line_count);
+int filter(const int count, const char *in_files[], const size_t offsets[], const int raw[], const char *out_files[], const char *minmax_files[], const int sizes[], uint64_t counters[4], const uint32_t dates[6], const int minmax_typeidx[], const int64_t line_count);
 ''')
 backend = ffi.verify(r'''
 #include <zlib.h>
@@ -108,14 +117,27 @@ backend = ffi.verify(r'''
 
 typedef struct {
 	gzFile fh;
+	int fd; // instead of fh for uncompressed columns
 	int len;
 	int pos;
 	char buf[Z + 1];
 } g;
 
+static int g_read(g *g, char *buf, const int size)
+{
+	if (g->fh) return gzread(g->fh, buf, size);
+	int pos = 0;
+	while (pos < size) {
+		const ssize_t got = read(g->fd, buf + pos, size - pos);
+		if (got <= 0) break;
+		pos += got;
+	}
+	return pos;
+}
+
 static int read_chunk(g *g, int offset)
 {
-	const int len = gzread(g->fh, g->buf + offset, Z - offset);
+	const int len = g_read(g, g->buf + offset, Z - offset);
 	if (len <= 0) return 1;
 	g->len = offset + len;
 	g->buf[g->len] = 0;
@@ -163,7 +185,7 @@ static const char *read_line(g *g, int *len)
 	(see minmax_setup and minmax_code)
 */
 
-int filter(const int count, const char *in_files[static count], const size_t offsets[static count], const char *out_files[], const char *minmax_files[static count], const int sizes[static count], uint64_t counters[static 4], const uint32_t dates[static 6], const int minmax_typeidx[static count], const int64_t line_count)
+int filter(const int count, const char *in_files[static count], const size_t offsets[static count], const int raw[static count], const char *out_files[], const char *minmax_files[static count], const int sizes[static count], uint64_t counters[static 4], const uint32_t dates[static 6], const int minmax_typeidx[static count], const int64_t line_count)
 {
 	g in_fh[count];
 	gzFile out_fh[4][count];
@@ -173,14 +195,19 @@ int filter(const int count, const char *in_files[static count], const size_t off
 	int res = 1;
 	int fd = -1;
 	memset(in_fh, 0, count * sizeof(g));
+	for (int i = 0; i < count; i++) in_fh[i].fd = -1;
 	memset(out_fh, 0, 4 * count * sizeof(gzFile));
 	err1(sizes[0] != 4 && sizes[0] != 8); // sanity check (it must be a date type)
 	for (int i = 0; i < count; i++) {
 		fd = open(in_files[i], O_RDONLY);
 		err2(fd < 0, in_files[i]);
 		err2(lseek(fd, offsets[i], 0) != offsets[i], in_files[i]);
-		in_fh[i].fh = gzdopen(fd, "rb");
-		err2(!in_fh[i].fh, in_files[i]);
+		if (raw[i]) {
+			in_fh[i].fd = fd;
+		} else {
+			in_fh[i].fh = gzdopen(fd, "rb");
+			err2(!in_fh[i].fh, in_files[i]);
+		}
 		fd = -1;
 		for (int c = 0; c < 3; c++) {
 			const char * const fn = out_files[count * c + i];
@@ -219,7 +246,7 @@ int filter(const int count, const char *in_files[static count], const size_t off
 		char buf[8];
 		const uint32_t * const u32p = (uint32_t *)buf;
 		enum { CLS_ALREADY_HANDLED, CLS_TOO_OLD, CLS_VALID, CLS_TOO_NEW } class;
-		err2(gzread(in_fh[0].fh, buf, sizes[0]) != sizes[0], "read");
+		err2(g_read(&in_fh[0], buf, sizes[0]) != sizes[0], "read");
 		if (u32p[0] < dates[0] || (sizes[0] == 8 && u32p[0] == dates[0] && u32p[1] < dates[1])) {
 			class = CLS_ALREADY_HANDLED;
 		} else if (u32p[0] < dates[2] || (sizes[0] == 8 && u32p[0] == dates[2] && u32p[1] < dates[3])) {
@@ -241,7 +268,7 @@ int filter(const int count, const char *in_files[static count], const size_t off
 		WRITE_VAL(0);
 		for (int i = 1; i < count; i++) {
 			if (sizes[i]) {
-				err2(gzread(in_fh[i].fh, buf, sizes[i]) != sizes[i], "read");
+				err2(g_read(&in_fh[i], buf, sizes[i]) != sizes[i], "read");
 				WRITE_VAL(i);
 			} else {
 				const char *ptr;
@@ -276,6 +303,7 @@ err:
 	if (fd >= 0) close(fd);
 	for (int i = 0; i < count; i++) {
 		if (in_fh[i].fh && gzclose(in_fh[i].fh)) res = 1;
+		if (in_fh[i].fd >= 0) close(in_fh[i].fd);
 		for (int c = 1; c < 4; c++) {
 			if (out_fh[c][i] && gzclose(out_fh[c][i])) res = 1;
 		}
@@ -314,18 +342,78 @@ def prepare():
 
 def empty_spilldata(spill_ds='default'):
 	return DotDict(
-		version     = 1,
+		version     = 2,
 		counter     = 0,
 		spill_ds    = spill_ds,
 		last_time   = False,
 		seen_before = False,
+		spill_lines = None, # (version 2) lines spilled last time
+		spill_minmax= None, # (version 2) {colname: [min, max]} of those
+		spill_minmax_bound = False, # spill_minmax is only a bound (not exact)
 	)
 
+def single_class(dates, lo, hi):
+	"""The class (see the C code) of all dates from lo to hi (as date2cfmt
+	tuples), or None if they are not all in the same class."""
+	def cls(v):
+		for c, ix in enumerate((0, 2, 4,)):
+			if v < tuple(dates[ix:ix + 2]):
+				return c
+		return 3
+	c = cls(lo)
+	if cls(hi) == c:
+		return c
+
+def slice_minmax(d, sliceno, colnames):
+	"""{colname: [min, max]} of sliceno in d from the block minmax, or None
+	if not all colnames have that."""
+	res = {}
+	for colname in colnames:
+		block_minmax = d.columns[colname].block_minmax
+		if not block_minmax:
+			return None
+		values = [mm[:2] for mm in block_minmax[sliceno] if mm[0] is not None]
+		if values:
+			res[colname] = [min(mn for mn, _ in values), max(mx for _, mx in values)]
+	return res
+
+def copy_slice(d, colname, sliceno, out_fn):
+	"""Append the compressed data for sliceno of colname in d to out_fn.
+	(gzip files can be concatenated.)"""
+	if not d.lines[sliceno]:
+		return
+	dc = d.columns[colname]
+	if dc.compression == 'none':
+		# Compress it as a new member instead.
+		mm, start, stop = d.column_mmap(colname, sliceno)
+		with open(out_fn, 'ab') as ofh:
+			with GzipFile(fileobj=ofh, mode='wb') as gzfh:
+				for pos in range(start, stop, 1024 * 1024):
+					gzfh.write(mm[pos:min(stop, pos + 1024 * 1024)])
+		mm.close()
+		return
+	offsets = dc.offsets
+	with open(d.column_filename(colname, sliceno), 'rb') as ifh:
+		if offsets:
+			start = offsets[sliceno]
+			ifh.seek(start)
+			later = [o for o in offsets if o > start]
+			left = min(later) - start if later else None
+		else:
+			left = None
+		with open(out_fn, 'ab') as ofh:
+			while left is None or left > 0:
+				data = ifh.read(1024 * 1024 if left is None else min(left, 1024 * 1024))
+				if not data:
+					break
+				ofh.write(data)
+				if left is not None:
+					left -= len(data)
+
 def process_one(sliceno, options, source, prepare_res, data=None, save_discard=False):
-	# Future improvement: Look at the old minmax to determine if we will get anything from reading this data
 	dw, dw_spill, column_names, column_sizes, column_types, minmax_typeidx = prepare_res
 	if data:
-		assert data.version == 1
+		assert data.version in (1, 2)
 		data.seen_before = True
 	else:
 		data = empty_spilldata()
@@ -333,6 +421,7 @@ def process_one(sliceno, options, source, prepare_res, data=None, save_discard=F
 	in_files = []
 	out_files = []
 	offsets = []
+	raw = []
 	if not save_discard:
 		out_files += [ffi.NULL] * len(column_names) # don't save "too old" lines
 	minmax_files = []
@@ -344,11 +433,15 @@ def process_one(sliceno, options, source, prepare_res, data=None, save_discard=F
 		in_files.append(ffi.new('char []', in_fn))
 		out_files.append(ffi.new('char []', out_fn))
 		offsets.append(offset)
+		compression = d.columns[colname].compression
+		assert c_readable(compression), "Can't split %s compressed column %s in %s" % (compression, colname, d,)
+		raw.append(compression == 'none')
 		minmax_fn = out_fn + '_minmax'
 		minmax_files.append(ffi.new('char []', minmax_fn))
 		minmax_d[colname] = minmax_fn
 	if save_discard:
 		out_files += [ffi.NULL] * len(column_names) # don't save "good" lines (save discard instead)
+	minmax_names = [n for n, size in zip(column_names, column_sizes) if size]
 	date_coltype = column_types[options.date_column]
 	def date2cfmt(dt):
 		if date_coltype == 'datetime':
@@ -385,14 +478,68 @@ def process_one(sliceno, options, source, prepare_res, data=None, save_discard=F
 	if options.discard_before_date:
 		if options.split_date:
 			assert options.discard_before_date < options.split_date
-		dates[2:3] = date2cfmt(options.discard_before_date)
+		dates[2:4] = date2cfmt(options.discard_before_date)
 		data.process_date = options.discard_before_date
 	if options.split_date:
 		dates[4:6] = date2cfmt(options.split_date)
 		data.process_date = max(data.process_date, options.split_date)
+	# Can we tell the class of all lines without reading them?
+	# That gives (class, lines in that class, {colname: [min, max]} of them).
+	known = None
+	if data.get('spill_lines') and options.date_column in data.spill_minmax:
+		# Only what was spilled last time is not already handled.
+		mn, mx = data.spill_minmax[options.date_column]
+		c = single_class(dates, date2cfmt(mn), date2cfmt(mx))
+		if c is not None:
+			# (A bound is enough for the class, but not as the minmax.)
+			known = c, data.spill_lines, None if data.get('spill_minmax_bound') else data.spill_minmax
+	elif not data.get('counter'):
+		# A new dataset. None is (0, 0), lower than any date.
+		# The dataset min/max only decides the class, the minmax is for
+		# this slice (from the blocks, or None to get it from the filter).
+		col = d.columns[options.date_column]
+		c = single_class(dates, (0, 0), date2cfmt(col.max) if col.max is not None else (0, 0))
+		if c is not None:
+			known = c, d.lines[sliceno], slice_minmax(d, sliceno, minmax_names)
 	counters = ffi.new('uint64_t [4]') # one for each class-enum
-	res = backend.filter(len(in_files), in_files, offsets, out_files, minmax_files, column_sizes, counters, dates, minmax_typeidx, d.lines[sliceno])
-	assert not res, "cffi converter returned error on data from " + source
+	minmax_bound = False
+	if known:
+		c, count, known_minmax = known
+		count_cols = len(column_names)
+		class_out_files = out_files[(c - 1) * count_cols:c * count_cols] if c else []
+		if not any(class_out_files):
+			copy = False
+			if known_minmax is None:
+				# Nothing is written, so the minmax only goes in the stats
+				# and the spill minmax, where the dataset min/max is
+				# close enough (it just makes it less likely that the
+				# class is known next time).
+				known_minmax = {n: [d.columns[n].min, d.columns[n].max] for n in minmax_names if d.columns[n].min is not None}
+				minmax_bound = True
+		elif count == d.lines[sliceno]:
+			copy = True
+		else:
+			known = None # have to pick out the lines
+	if known:
+		# Still run the filter, but on no lines. That gives us the minmax
+		# files (with nothing in them) and makes any output files.
+		res = backend.filter(len(in_files), in_files, offsets, raw, out_files, minmax_files, column_sizes, counters, dates, minmax_typeidx, 0)
+		assert not res, "cffi converter returned error on data from " + source
+		if c and known_minmax is None:
+			# Copying without block minmax, read the lines (but don't
+			# write them again) for the minmax.
+			null_files = [ffi.NULL] * len(out_files)
+			res = backend.filter(len(in_files), in_files, offsets, raw, null_files, minmax_files, column_sizes, counters, dates, minmax_typeidx, d.lines[sliceno])
+			assert not res, "cffi converter returned error on data from " + source
+		else:
+			counters[0] = d.lines[sliceno] - count
+			counters[c] += count
+		if copy:
+			for colname, out_fn in zip(column_names, class_out_files):
+				copy_slice(d, colname, sliceno, ffi.string(out_fn))
+	else:
+		res = backend.filter(len(in_files), in_files, offsets, raw, out_files, minmax_files, column_sizes, counters, dates, minmax_typeidx, d.lines[sliceno])
+		assert not res, "cffi converter returned error on data from " + source
 	stats.version = 0
 	stats.counters = list(counters)
 	stats.minmax = {}
@@ -401,6 +548,11 @@ def process_one(sliceno, options, source, prepare_res, data=None, save_discard=F
 			with type2iter[column_types[colname]](fn) as it:
 				stats.minmax[colname] = list(it)
 			unlink(fn)
+	if known and c and count and known_minmax:
+		for colname, (mn, mx) in known_minmax.iteritems():
+			if colname in stats.minmax:
+				stats.minmax[colname][c - 1] = mn
+				stats.minmax[colname][c + 2] = mx
 	# If there is at most 2% left, spill it next time.
 	# Or if there is at most 10% left and we have read it at least 8 times.
 	# Or if there is at most 20% left and we have read it at least 16 times.
@@ -411,6 +563,14 @@ def process_one(sliceno, options, source, prepare_res, data=None, save_discard=F
 		(data.counter >= 8 and counters[3] <= total_lines / 10) or
 		(data.counter >= 16 and counters[3] <= total_lines / 5)
 	)
+	# What is left for next time, so it might not have to be read.
+	data.version = 2
+	data.spill_lines = counters[3]
+	data.spill_minmax = {}
+	for colname, mm in stats.minmax.iteritems():
+		if mm[2] <= mm[5]:
+			data.spill_minmax[colname] = [mm[2], mm[5]]
+	data.spill_minmax_bound = minmax_bound
 	# If no lines were spilled we will not need this dataset again,
 	# nor if we wrote the spill in this dataset.
 	if not counters[3] or not stats.virtual_spill:
@@ -0,0 +1,467 @@
+############################################################################
+#                                                                          #
+# Copyright (c) 2017 eBay Inc.                                             #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#  http://www.apache.org/licenses/LICENSE-2.0                              #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+#                                                                          #
+############################################################################
+
+from __future__ import division
+from __future__ import absolute_import
+
+description = r'''
+Group datasets.source (and its chain back to the source of
+jobids.previous) by the group_by columns and aggregate the numeric
+columns for each group.
+
+The result has the group_by columns, count (the number of lines in the
+group) and for each column <column>_count (values that are not None),
+<column>_sum, <column>_min, <column>_max and <column>_mean. None values
+are skipped, a group with no values gets None.
+
+columns defaults to all numeric (bool, int32, int64, float32, float64
+and number) columns that are not in group_by. No group_by gives a single
+group for the whole dataset.
+
+Fixed width columns are aggregated in C, number columns in python.
+
+If the datasets are hashed on one of the group_by columns each slice is
+aggregated and written by itself, otherwise the slices are merged in
+synthesis. The result is hashed on that column (or the first group_by
+column).
+
+With jobids.previous (an earlier dataset_groupby with the same
+group_by and columns) only the new datasets are read, and the groups
+from previous are merged into the result.
+'''
+
+from array import array
+from itertools import izip, imap, repeat
+import cffi
+
+from extras import job_params
+from dataset import Dataset, DatasetWriter
+from sourcedata import c_readable
+from . import dataset_typing
+
+depend_extra = (dataset_typing,)
+
+options = {
+	'group_by'   : [],   # no columns gives one group
+	'columns'    : [],   # default all numeric columns not in group_by
+	'caption'    : 'groupby',
+}
+
+datasets = ('source',)
+jobids = ('previous',)
+
+# How each type is aggregated, and the width of it in the column file.
+type_kinds = {
+	'bool'   : ('int', 1),
+	'int32'  : ('int', 4),
+	'int64'  : ('int', 8),
+	'float32': ('float', 4),
+	'float64': ('float', 8),
+	'number' : ('number', 0),
+}
+
+sum_types = {
+	'int'   : 'int64',
+	'float' : 'float64',
+	'number': 'number',
+}
+
+# n, sum, min and max before anything has been added.
+initial_values = {
+	'int'   : (0, 0, 2 ** 63 - 1, -2 ** 63),
+	'float' : (0, 0.0, float('inf'), float('-inf')),
+	'number': (0, 0, None, None),
+}
+
+ffi = cffi.FFI()
+ffi.cdef('''
+void count_groups(const int64_t lines, const int64_t *gidx, int64_t *count);
+int aggregate_int(const char *fn, const int64_t offset, const int raw, const int width, const int64_t lines, const int64_t *gidx, int64_t *n, int64_t *sum, int64_t *min, int64_t *max);
+int aggregate_float(const char *fn, const int64_t offset, const int raw, const int width, const int64_t lines, const int64_t *gidx, int64_t *n, double *sum, double *min, double *max);
+''')
+backend = ffi.verify(r'''
+#include <zlib.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+
+#define Z (128 * 1024)
+
+''' + dataset_typing.noneval_data + r'''
+
+// Uncompressed columns are read with plain read(2) on fd, others through fh.
+typedef struct {
+	int fd;
+	gzFile fh;
+} col_t;
+
+static int col_open(col_t *c, const char *fn, const int64_t offset, const int raw)
+{
+	c->fh = 0;
+	c->fd = open(fn, O_RDONLY);
+	if (c->fd < 0) return 1;
+	if (lseek(c->fd, offset, 0) != offset) return 1;
+	if (raw) return 0;
+	c->fh = gzdopen(c->fd, "rb");
+	if (!c->fh) return 1;
+	c->fd = -1;
+	return 0;
+}
+
+static int col_read(col_t *c, unsigned char *buf, const int64_t len)
+{
+	if (c->fh) return gzread(c->fh, buf, len) != len;
+	int64_t pos = 0;
+	while (pos < len) {
+		const ssize_t got = read(c->fd, buf + pos, len - pos);
+		if (got <= 0) return 1;
+		pos += got;
+	}
+	return 0;
+}
+
+static void col_close(col_t *c)
+{
+	if (c->fh) gzclose(c->fh);
+	if (c->fd >= 0) close(c->fd);
+}
+
+void count_groups(const int64_t lines, const int64_t *gidx, int64_t *count)
+{
+	for (int64_t line = 0; line < lines; line++) {
+		count[gidx[line]]++;
+	}
+}
+
+// Returns 0 when ok, 1 for read errors and 2 if a sum overflows.
+int aggregate_int(const char *fn, const int64_t offset, const int raw, const int width, const int64_t lines, const int64_t *gidx, int64_t *n, int64_t *sum, int64_t *min, int64_t *max)
+{
+	int res = 1;
+	int64_t line = 0;
+	unsigned char *buf = malloc(Z);
+	col_t c;
+	const int open_err = col_open(&c, fn, offset, raw);
+	if (!buf || open_err) goto err;
+	while (line < lines) {
+		int64_t cnt = Z / width;
+		if (cnt > lines - line) cnt = lines - line;
+		if (col_read(&c, buf, cnt * width)) goto err;
+		for (int64_t i = 0; i < cnt; i++, line++) {
+			int64_t v;
+			if (width == 8) {
+				memcpy(&v, buf + i * 8, 8);
+				if (v == noneval_int64) continue;
+			} else if (width == 4) {
+				int32_t v32;
+				memcpy(&v32, buf + i * 4, 4);
+				if (v32 == noneval_int32) continue;
+				v = v32;
+			} else {
+				if (buf[i] == noneval_bool) continue;
+				v = buf[i];
+			}
+			const int64_t g = gidx[line];
+			if ((v > 0 && sum[g] > INT64_MAX - v) || (v < 0 && sum[g] < INT64_MIN - v)) {
+				res = 2;
+				goto err;
+			}
+			sum[g] += v;
+			n[g]++;
+			if (v < min[g]) min[g] = v;
+			if (v > max[g]) max[g] = v;
+		}
+	}
+	res = 0;
+err:
+	col_close(&c);
+	free(buf);
+	return res;
+}
+
+int aggregate_float(const char *fn, const int64_t offset, const int raw, const int width, const int64_t lines, const int64_t *gidx, int64_t *n, double *sum, double *min, double *max)
+{
+	int res = 1;
+	int64_t line = 0;
+	unsigned char *buf = malloc(Z);
+	col_t c;
+	const int open_err = col_open(&c, fn, offset, raw);
+	if (!buf || open_err) goto err;
+	while (line < lines) {
+		int64_t cnt = Z / width;
+		if (cnt > lines - line) cnt = lines - line;
+		if (col_read(&c, buf, cnt * width)) goto err;
+		for (int64_t i = 0; i < cnt; i++, line++) {
+			double v;
+			if (width == 8) {
+				if (!memcmp(buf + i * 8, noneval_float64, 8)) continue;
+				memcpy(&v, buf + i * 8, 8);
+			} else {
+				float v32;
+				if (!memcmp(buf + i * 4, noneval_float32, 4)) continue;
+				memcpy(&v32, buf + i * 4, 4);
+				v = v32;
+			}
+			const int64_t g = gidx[line];
+			sum[g] += v;
+			n[g]++;
+			if (v < min[g]) min[g] = v;
+			if (v > max[g]) max[g] = v;
+		}
+	}
+	res = 0;
+err:
+	col_close(&c);
+	free(buf);
+	return res;
+}
+''', libraries=['z'], extra_compile_args=['-std=c99'])
+
+
+class Groups(dict):
+	"""Gives each new key the next index"""
+	def __missing__(self, key):
+		ix = self[key] = len(self)
+		return ix
+
+class CodeGroups(dict):
+	"""The group index for each code in a dictionary encoded column.
+	(Looked up the first time a code is seen, so the groups get the
+	same order as when grouping on the values.)"""
+	def __init__(self, groups, dictionary):
+		self.groups = groups
+		self.dictionary = dictionary
+	def __missing__(self, code):
+		ix = self[code] = self.groups[None if code is None else self.dictionary[code]]
+		return ix
+
+def _ptr(typ, a):
+	return ffi.cast(typ + ' *', ffi.from_buffer(a))
+
+class Aggregates(object):
+	"""count per group, and n (values that are not None), sum, min and
+	max per column and group. All kept in arrays indexed by group."""
+
+	def __init__(self, group_by, kinds):
+		self.group_by = group_by
+		self.kinds = kinds
+		self.groups = Groups()
+		self.count = array('l')
+		self.cols = []
+		for kind in kinds:
+			if kind == 'number':
+				self.cols.append((array('l'), [], [], [],))
+			else:
+				typecode = 'l' if kind == 'int' else 'd'
+				self.cols.append((array('l'), array(typecode), array(typecode), array(typecode),))
+
+	def _grow(self):
+		more = len(self.groups) - len(self.count)
+		if more:
+			self.count.extend(repeat(0, more))
+			for kind, col in zip(self.kinds, self.cols):
+				for a, v in zip(col, initial_values[kind]):
+					a.extend(repeat(v, more))
+
+	def add_dataset(self, d, sliceno, columns):
+		lines = d.lines[sliceno]
+		if not lines:
+			return
+		if len(self.group_by) == 1 and d.columns[self.group_by[0]].dictionary:
+			dictionary = d.column_dictionary(self.group_by[0], sliceno)
+		else:
+			dictionary = None
+		if dictionary is not None:
+			# Group on the codes, each value is only looked up once.
+			codes = CodeGroups(self.groups, dictionary)
+			gidx = array('l', imap(codes.__getitem__, d.column_codes(self.group_by[0], sliceno)))
+		elif self.group_by:
+			keys = d.iterate(sliceno, self.group_by if len(self.group_by) > 1 else self.group_by[0])
+			gidx = array('l', imap(self.groups.__getitem__, keys))
+		else:
+			gidx = array('l', repeat(self.groups[()], lines))
+		self._grow()
+		gidx_p = _ptr('int64_t', gidx)
+		backend.count_groups(lines, gidx_p, _ptr('int64_t', self.count))
+		for column, kind, col in zip(columns, self.kinds, self.cols):
+			n, s, mi, ma = col
+			dc = d.columns[column]
+			if kind == 'number' or not c_readable(dc.compression):
+				# (Also for columns the C code can't read.)
+				for g, v in izip(gidx, d.iterate(sliceno, column)):
+					if v is not None:
+						n[g] += 1
+						s[g] += v
+						if n[g] == 1 or v < mi[g]:
+							mi[g] = v
+						if n[g] == 1 or v > ma[g]:
+							ma[g] = v
+				continue
+			fn = d.column_filename(column, sliceno).encode('ascii')
+			offset = dc.offsets[sliceno] if dc.offsets else 0
+			width = type_kinds[dc.type][1]
+			raw = (dc.compression == 'none')
+			if kind == 'int':
+				err = backend.aggregate_int(fn, offset, raw, width, lines, gidx_p, _ptr('int64_t', n), _ptr('int64_t', s), _ptr('int64_t', mi), _ptr('int64_t', ma))
+			else:
+				err = backend.aggregate_float(fn, offset, raw, width, lines, gidx_p, _ptr('int64_t', n), _ptr('double', s), _ptr('double', mi), _ptr('double', ma))
+			assert err != 2, "Sum of %s overflows int64 in %s slice %d" % (column, d, sliceno,)
+			assert not err, "Failed to read %s in %s slice %d" % (column, d, sliceno,)
+
+	def add_state(self, state):
+		"""Merge in another state (from another slice or previous)"""
+		keys, count, cols = state
+		gix = [self.groups[k] for k in keys]
+		self._grow()
+		for g, c in izip(gix, count):
+			self.count[g] += c
+		for (n, s, mi, ma), (o_n, o_s, o_mi, o_ma) in zip(self.cols, cols):
+			for g, on, os, omi, oma in izip(gix, o_n, o_s, o_mi, o_ma):
+				if on:
+					n[g] += on
+					s[g] += os
+					if mi[g] is None or omi < mi[g]:
+						mi[g] = omi
+					if ma[g] is None or oma > ma[g]:
+						ma[g] = oma
+
+	def add_result(self, d, sliceno, columns):
+		"""Merge in slice sliceno of an earlier result"""
+		names = list(self.group_by) + ['count']
+		for column in columns:
+			names.extend(column + suffix for suffix in ('_count', '_sum', '_min', '_max'))
+		rows = list(d.iterate(sliceno, names))
+		ngb = len(self.group_by)
+		if ngb == 1:
+			keys = [row[0] for row in rows]
+		else:
+			keys = [row[:ngb] for row in rows]
+		cols = []
+		for ix in range(len(columns)):
+			pos = ngb + 1 + ix * 4
+			cols.append(tuple([row[pos + jx] for row in rows] for jx in range(4)))
+		self.add_state((keys, [row[ngb] for row in rows], cols,))
+
+	def state(self):
+		keys = [None] * len(self.groups)
+		for k, ix in self.groups.iteritems():
+			keys[ix] = k
+		return keys, self.count, self.cols
+
+	def rows(self, types):
+		"""Result rows, in the order of result_columns"""
+		keys, count, cols = self.state()
+		if len(self.group_by) == 1:
+			keys = [(k,) for k in keys]
+		for g, key in enumerate(keys):
+			row = list(key)
+			row.append(count[g])
+			for (n, s, mi, ma), typ in zip(cols, types):
+				if n[g]:
+					if typ == 'bool':
+						row.extend((n[g], s[g], bool(mi[g]), bool(ma[g]), s[g] / n[g],))
+					else:
+						row.extend((n[g], s[g], mi[g], ma[g], s[g] / n[g],))
+				else:
+					row.extend((0, None, None, None, None,))
+			yield row
+
+
+def result_columns(d, group_by, columns):
+	res = [(n, d.columns[n].type) for n in group_by]
+	res.append(('count', 'int64'))
+	for n in columns:
+		typ = d.columns[n].type
+		res.append((n + '_count', 'int64'))
+		res.append((n + '_sum', sum_types[type_kinds[typ][0]]))
+		res.append((n + '_min', typ))
+		res.append((n + '_max', typ))
+		res.append((n + '_mean', 'float64'))
+	return res
+
+def make_writer(res_columns, hashlabel):
+	dw = DatasetWriter(hashlabel=hashlabel, caption=options.caption)
+	# Added in the order the rows are written.
+	for n, typ in res_columns:
+		dw.add(n, typ)
+	return dw
+
+def prepare():
+	source = datasets.source
+	group_by = list(options.group_by)
+	for n in group_by:
+		assert n in source.columns, "group_by column %s not in source" % (n,)
+	columns = options.columns or sorted(n for n, c in source.columns.items() if c.type in type_kinds and n not in group_by)
+	for n in columns:
+		assert n in source.columns, "column %s not in source" % (n,)
+		assert source.columns[n].type in type_kinds, "column %s is %s, not numeric" % (n, source.columns[n].type,)
+	res_columns = result_columns(source, group_by, columns)
+	names = [n for n, _ in res_columns]
+	assert len(set(names)) == len(names), "Duplicate column names in result: %r" % (names,)
+	chain = source.chain(stop_ds={jobids.previous: 'source'})
+	for d in chain:
+		for n in group_by + columns:
+			assert n in d.columns and d.columns[n].type == source.columns[n].type, "%s has a different type in %s" % (n, d,)
+	if jobids.previous:
+		prev_ds = Dataset(jobids.previous)
+		prev_columns = {n: c.type for n, c in prev_ds.columns.items()}
+		assert prev_columns == dict(res_columns), "previous has different columns: %r" % (prev_columns,)
+		assert job_params(jobids.previous).options.group_by == group_by, "previous has different group_by"
+	else:
+		prev_ds = None
+	hashlabels = set(d.hashlabel for d in chain)
+	if prev_ds:
+		hashlabels.add(prev_ds.hashlabel)
+	if len(hashlabels) == 1 and hashlabels & set(group_by):
+		hashlabel = hashlabels.pop()
+		cohashed = True
+	else:
+		hashlabel = group_by[0] if group_by else None
+		cohashed = False
+	if cohashed:
+		make_writer(res_columns, hashlabel)
+	kinds = [type_kinds[source.columns[n].type][0] for n in columns]
+	return chain, prev_ds, group_by, columns, kinds, res_columns, hashlabel, cohashed
+
+def analysis(sliceno, prepare_res):
+	chain, prev_ds, group_by, columns, kinds, res_columns, hashlabel, cohashed = prepare_res
+	agg = Aggregates(group_by, kinds)
+	if prev_ds:
+		agg.add_result(prev_ds, sliceno, columns)
+	for d in chain:
+		agg.add_dataset(d, sliceno, columns)
+	if not cohashed:
+		return agg.state()
+	write = DatasetWriter().write_list
+	for row in agg.rows([datasets.source.columns[n].type for n in columns]):
+		write(row)
+
+def synthesis(prepare_res, analysis_res):
+	chain, prev_ds, group_by, columns, kinds, res_columns, hashlabel, cohashed = prepare_res
+	if cohashed:
+		return
+	agg = Aggregates(group_by, kinds)
+	for state in analysis_res:
+		agg.add_state(state)
+	dw = make_writer(res_columns, hashlabel)
+	write = dw.get_split_write_list()
+	for row in agg.rows([datasets.source.columns[n].type for n in columns]):
+		write(row)
@@ -0,0 +1,187 @@
+############################################################################
+#                                                                          #
+# Copyright (c) 2017 eBay Inc.                                             #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#  http://www.apache.org/licenses/LICENSE-2.0                              #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+#                                                                          #
+############################################################################
+
+from __future__ import division
+from __future__ import absolute_import
+
+description = r'''
+Join datasets.left and datasets.right on left_key == right_key.
+
+join=inner gives the lines that have a match on both sides, join=left
+also the left lines with no match (with None for the right columns) and
+join=semi the left lines that have a match (only the left columns).
+Lines with None as key never match.
+
+Both datasets should be hashed on the key, so each slice can be joined
+by itself. If a dataset isn't, it is rehashed (with a dataset_rehash
+subjob) first. The keys must have the same type on both sides.
+
+The result has all left columns and the right_columns (default all but
+right_key), renamed by rename. It is hashed on left_key.
+
+In each slice a hash table is built from one side (the smaller for inner
+joins, otherwise right) and the other side is streamed through it. If
+the build side of a slice has more than max_build_lines lines both sides
+are first split by key into partitions on disk, which are then joined
+one at a time. (That changes the order of the result lines.)
+'''
+
+from array import array
+import cPickle
+
+from extras import OptionString, OptionEnum
+from dataset import Dataset, DatasetWriter
+from subjobs import build
+
+JoinEnum = OptionEnum('inner left semi')
+
+options = {
+	'left_key'                  : OptionString,
+	'right_key'                 : '',    # defaults to left_key
+	'join'                      : JoinEnum.inner,
+	'right_columns'             : [],    # default all except right_key
+	'rename'                    : {},    # {'right column': 'result column'}
+	'max_build_lines'           : 10000000, # per partition
+	'caption'                   : 'joined dataset',
+}
+
+datasets = ('left', 'right', 'previous',)
+
+
+def hashed(d, key):
+	"""d, or d rehashed on key if it isn't hashed on it"""
+	if d.hashlabel == key:
+		return d
+	jid = build('dataset_rehash', options=dict(hashlabel=key, length=1), datasets=dict(source=d))
+	return Dataset(jid)
+
+def prepare():
+	join = options.join or 'inner'
+	left_key = options.left_key
+	right_key = options.right_key or left_key
+	assert left_key in datasets.left.columns, "left_key %s not in left" % (left_key,)
+	assert right_key in datasets.right.columns, "right_key %s not in right" % (right_key,)
+	left_type = datasets.left.columns[left_key].type
+	right_type = datasets.right.columns[right_key].type
+	assert left_type == right_type, "Keys have different types (%s and %s), they won't hash the same" % (left_type, right_type,)
+	left = hashed(datasets.left, left_key)
+	right = hashed(datasets.right, right_key)
+	left_columns = [left_key] + sorted(n for n in left.columns if n != left_key)
+	if join == 'semi':
+		right_columns = []
+	else:
+		right_columns = sorted(options.right_columns or (n for n in right.columns if n != right_key))
+	for n in right_columns:
+		assert n in right.columns, "right column %s not in right" % (n,)
+	result_columns = [(n, left.columns[n].type) for n in left_columns]
+	result_columns += [(options.rename.get(n, n), right.columns[n].type) for n in right_columns]
+	result_names = [n for n, _ in result_columns]
+	assert len(set(result_names)) == len(result_names), "Duplicate column names in result, use rename"
+	dw = DatasetWriter(
+		hashlabel=left_key,
+		caption=options.caption,
+		previous=datasets.previous,
+	)
+	# Added in the order the rows are written.
+	for n, coltype in result_columns:
+		dw.add(n, coltype)
+	return join, left, right, left_columns, [right_key] + right_columns
+
+def analysis(sliceno, prepare_res):
+	join, left, right, left_columns, right_columns = prepare_res
+	write = DatasetWriter().write_list
+	if join == 'inner' and left.lines[sliceno] < right.lines[sliceno]:
+		build_ds, build_columns, probe_ds, probe_columns = left, left_columns, right, right_columns
+		def combine(build_row, probe_row):
+			return build_row + probe_row[1:]
+	else:
+		build_ds, build_columns, probe_ds, probe_columns = right, right_columns, left, left_columns
+		def combine(build_row, probe_row):
+			return probe_row + build_row[1:]
+	parts = -(-build_ds.lines[sliceno] // options.max_build_lines) if options.max_build_lines > 0 else 1
+	build_it = build_ds.iterate(sliceno, build_columns)
+	probe_it = probe_ds.iterate(sliceno, probe_columns)
+	if parts > 1:
+		build_parts = partition(build_it, parts, 'part.%d.build' % (sliceno,))
+		probe_parts = partition(probe_it, parts, 'part.%d.probe' % (sliceno,))
+		for build_fn, probe_fn in zip(build_parts, probe_parts):
+			join_part(join, read_part(build_fn), read_part(probe_fn), combine, len(right_columns) - 1, write)
+	else:
+		join_part(join, build_it, probe_it, combine, len(right_columns) - 1, write)
+
+def partition(it, parts, basename):
+	"""Split the rows from it into parts files by key, returns their names"""
+	filenames = ['%s.%d' % (basename, ix,) for ix in range(parts)]
+	fhs = [open(fn, 'wb') for fn in filenames]
+	picklers = []
+	for fh in fhs:
+		p = cPickle.Pickler(fh, 2)
+		p.fast = True # no memo, these are all different objects
+		picklers.append(p.dump)
+	for row in it:
+		picklers[hash(row[0]) % parts](row)
+	for fh in fhs:
+		fh.close()
+	return filenames
+
+def read_part(filename):
+	from os import unlink
+	with open(filename, 'rb') as fh:
+		load = cPickle.Unpickler(fh).load
+		try:
+			while True:
+				yield load()
+		except EOFError:
+			pass
+	unlink(filename)
+
+def join_part(join, build_it, probe_it, combine, right_width, write):
+	if join == 'semi':
+		keys = set(row[0] for row in build_it)
+		keys.discard(None)
+		for row in probe_it:
+			if row[0] in keys:
+				write(row)
+		return
+	# Rows with the same key are linked through nexts, so each key only
+	# costs a dict entry (and an int in an array).
+	heads = {}
+	nexts = array('l')
+	rows = []
+	for ix, row in enumerate(build_it):
+		k = row[0]
+		if k is None:
+			nexts.append(-1)
+		else:
+			nexts.append(heads.get(k, -1))
+			heads[k] = ix
+		rows.append(row)
+	missing = (None,) * right_width
+	for row in probe_it:
+		ix = heads.get(row[0], -1)
+		if ix < 0:
+			if join == 'left':
+				write(row + missing)
+			continue
+		# The chain is newest first, so collect it to keep the build order.
+		matches = []
+		while ix >= 0:
+			matches.append(rows[ix])
+			ix = nexts[ix]
+		for build_row in reversed(matches):
+			write(combine(build_row, row))
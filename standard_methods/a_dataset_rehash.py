@@ -23,10 +23,14 @@ description = r'''
 Rewrite a dataset (or chain to previous) with new hashlabel.
 '''
 
-from shutil import copyfileobj
-
 from extras import OptionString, job_params
 from dataset import DatasetWriter
+from safe_pool import Pool
+from sourcedata import codec
+from gzwrite import recompress
+from . import file_concat
+
+depend_extra = (file_concat,)
 
 options = {
 	'hashlabel'                 : OptionString,
@@ -46,6 +50,9 @@ def prepare(params):
 		filename = d.filename
 	else:
 		filename = None
+	# Blocks (and dictionaries) can't be concatenated, so without
+	# as_chain those are made when the slices are put together.
+	block_rows = next((c.blocks[0] for c in d.columns.values() if c.blocks), None)
 	dws = []
 	previous = datasets.previous
 	for sliceno in range(params.slices):
@@ -60,6 +67,7 @@ def prepare(params):
 			previous=previous,
 			name=name,
 			for_single_slice=sliceno,
+			block_rows=block_rows if options.as_chain else None,
 		)
 		previous = (params.jobid, name)
 		dws.append(dw)
@@ -68,9 +76,13 @@ def prepare(params):
 		# names has to be in the same order as the add calls
 		# so the iterator returns the same order the writer expects.
 		names.append(n)
+		if options.as_chain or not (block_rows or codec(c.compression) == 'dict'):
+			compression = c.compression
+		else:
+			compression = 'gzip'
 		for dw in dws:
-			dw.add(n, c.type)
-	return dws, names, prev_source, caption, filename
+			dw.add(n, c.type, compression=compression)
+	return dws, names, prev_source, caption, filename, block_rows
 
 def analysis(sliceno, prepare_res):
 	dws, names, prev_source = prepare_res[:3]
@@ -84,29 +96,49 @@ def analysis(sliceno, prepare_res):
 	for values in it:
 		write(values)
 
+def concat_slice(columns):
+	res = {}
+	for n, dst_fn, src_fns, to_recompress in columns:
+		file_concat.concat(dst_fn, src_fns)
+		if to_recompress:
+			res[n] = recompress(dst_fn, *to_recompress)
+	return res
+
 def synthesis(prepare_res, params):
 	if not options.as_chain:
 		# If we don't want a chain we abuse our knowledge of dataset internals
 		# to avoid recompressing. Don't do this stuff yourself.
-		dws, names, prev_source, caption, filename = prepare_res
+		# (The slices are put together in parallel, see file_concat.
+		# Columns that could not be written in their compression are
+		# recompressed there too, the rest are already done.)
+		dws, names, prev_source, caption, filename, block_rows = prepare_res
+		columns = datasets.source.columns
 		merged_dw = DatasetWriter(
 			caption=caption,
 			hashlabel=options.hashlabel,
 			filename=filename,
 			previous=datasets.previous,
 			meta_only=True,
-			columns=datasets.source.columns,
+			columns=columns,
+			block_rows=block_rows,
 		)
+		todo = []
 		for sliceno in range(params.slices):
 			merged_dw.set_lines(sliceno, sum(dw._lens[sliceno] for dw in dws))
 			for dwno, dw in enumerate(dws):
 				merged_dw.set_minmax((sliceno, dwno), dw._minmax[sliceno])
-			for n in names:
-				fn = merged_dw.column_filename(n, sliceno=sliceno)
-				with open(fn, "wb") as out_fh:
-					for dw in dws:
-						fn = dw.column_filename(n, sliceno=sliceno)
-						with open(fn, "rb") as in_fh:
-							copyfileobj(in_fh, out_fh)
+			todo.append([(
+				n,
+				merged_dw.column_filename(n, sliceno=sliceno),
+				[dw.column_filename(n, sliceno=sliceno) for dw in dws],
+				(columns[n].compression, columns[n].type, block_rows) if block_rows or codec(columns[n].compression) == 'dict' else None,
+			) for n in names])
+		pool = Pool(params.slices)
+		try:
+			for sliceno, res in enumerate(pool.map(concat_slice, todo)):
+				merged_dw._recompress_res[sliceno] = res
+				merged_dw._recompressed.add(sliceno)
+		finally:
+			pool.close()
 		for dw in dws:
 			dw.discard()
@@ -22,12 +22,38 @@ from __future__ import absolute_import
 description = r'''
 Stable sort a dataset based on one or more columns.
 You'll have to type the sort column(s) approprietly.
+
+With sort_across_slices the rows are range partitioned over the slices
+(slice 0 gets the first rows, and so on). The ranges are chosen from a
+sample of the sort columns, so slices will be about (not exactly) the
+same size. Each slice only reads its own part of the source, sends the
+rows to the slice they belong in (as sorted runs on disk), and the runs
+are then merged per slice in parallel.
+
+Without sort_across_slices, fixed width columns (numbers that are not
+"number", dates, times and bools) are sorted and reordered without
+making python objects. If all sort columns are fixed width the sorting
+itself is done that way too. (NaN sorts after None and before all other
+values then.)
 '''
 
 from functools import partial
+from itertools import islice
+from bisect import bisect_right
+from heapq import merge
+from os import unlink, ftruncate
+from mmap import mmap
+import cPickle
+import cffi
 
 from extras import OptionEnum, OptionString
 from dataset import Dataset, DatasetWriter
+from gzwrite import typed_writer
+from sourcedata import c_readable, decompressed_chunks
+from safe_pool import Pool
+from . import dataset_typing
+
+depend_extra = (dataset_typing,)
 
 OrderEnum = OptionEnum('ascending descending')
 
@@ -38,20 +64,328 @@ options = {
 }
 datasets = ('source', 'previous',)
 
+# Rows per slice kept in memory before they are written out as sorted runs.
+RUN_ROWS = 1000000
+# Rows sampled per slice to choose the ranges with.
+SAMPLES_PER_SLICE = 1000
+# Spread over this many ranges of rows, when the sort columns can seek.
+SAMPLE_RANGES = 16
+# Rows per pickle in run files.
+CHUNK_ROWS = 4096
+
+# Fixed width types are sorted and permuted in C, without making
+# python objects. {type: (bytes per value, type number in C)}
+fixed_types = {
+	'int64'   : (8, 0),
+	'int32'   : (4, 1),
+	'bits64'  : (8, 2),
+	'bits32'  : (4, 3),
+	'float64' : (8, 4),
+	'float32' : (4, 5),
+	'bool'    : (1, 6),
+	'date'    : (4, 7),
+	'datetime': (8, 8),
+	'time'    : (8, 8),
+}
+
+ffi = cffi.FFI()
+ffi.cdef('''
+int load_column(const char *in_fn, const uint64_t offset, const uint64_t size, char *dst);
+int argsort(const int n_keys, char **keys, const int *types, const uint64_t count, const int reverse, uint64_t *idx);
+int write_permuted(const char *out_fn, const char *data, const int width, const uint64_t *idx, const uint64_t count);
+''')
+backend = ffi.verify(r'''
+#include <zlib.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <math.h>
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+
+#define err1(v) if (v) goto err
+''' + dataset_typing.noneval_data + r'''
+
+// Read size bytes (count values) of a column into dst.
+int load_column(const char *in_fn, const uint64_t offset, const uint64_t size, char *dst)
+{
+	int res = 1;
+	int fd = open(in_fn, O_RDONLY);
+	if (fd < 0) return 1;
+	if (lseek(fd, offset, 0) != (off_t)offset) {
+		close(fd);
+		return 1;
+	}
+	gzFile fh = gzdopen(fd, "rb");
+	if (!fh) {
+		close(fd);
+		return 1;
+	}
+	uint64_t pos = 0;
+	while (pos < size) {
+		const uint64_t want = size - pos > 0x40000000 ? 0x40000000 : size - pos;
+		const int got = gzread(fh, dst + pos, want);
+		err1(got <= 0);
+		pos += got;
+	}
+	res = 0;
+err:
+	gzclose(fh);
+	return res;
+}
+
+// None sorts first (like in python), then NaN, then numbers.
+#define FLOAT_RANK(T, v, p) (!memcmp(p, noneval_##T, sizeof(noneval_##T)) ? 0 : isnan(v) ? 1 : 2)
+#define CMP(a, b) (((a) > (b)) - ((a) < (b)))
+
+static int cmp_one(const int type, const char *a, const char *b)
+{
+	switch (type) {
+		case 0: {
+			int64_t x, y;
+			memcpy(&x, a, 8); memcpy(&y, b, 8);
+			return CMP(x, y); // None is INT64_MIN
+		}
+		case 1: {
+			int32_t x, y;
+			memcpy(&x, a, 4); memcpy(&y, b, 4);
+			return CMP(x, y); // None is INT32_MIN
+		}
+		case 2: {
+			uint64_t x, y;
+			memcpy(&x, a, 8); memcpy(&y, b, 8);
+			return CMP(x, y);
+		}
+		case 3: {
+			uint32_t x, y;
+			memcpy(&x, a, 4); memcpy(&y, b, 4);
+			return CMP(x, y);
+		}
+		case 4: {
+			double x, y;
+			memcpy(&x, a, 8); memcpy(&y, b, 8);
+			const int rx = FLOAT_RANK(float64, x, a), ry = FLOAT_RANK(float64, y, b);
+			if (rx != 2 || ry != 2) return CMP(rx, ry);
+			return CMP(x, y);
+		}
+		case 5: {
+			float x, y;
+			memcpy(&x, a, 4); memcpy(&y, b, 4);
+			const int rx = FLOAT_RANK(float32, x, a), ry = FLOAT_RANK(float32, y, b);
+			if (rx != 2 || ry != 2) return CMP(rx, ry);
+			return CMP(x, y);
+		}
+		case 6: {
+			// None is 255, make it the smallest.
+			const uint8_t x = (uint8_t)*a + 1, y = (uint8_t)*b + 1;
+			return CMP(x, y);
+		}
+		case 7: {
+			uint32_t x, y;
+			memcpy(&x, a, 4); memcpy(&y, b, 4);
+			return CMP(x, y); // None is 0
+		}
+		case 8: {
+			// Two uint32s, most significant first. None is 0.
+			uint32_t x[2], y[2];
+			memcpy(x, a, 8); memcpy(y, b, 8);
+			if (x[0] != y[0]) return CMP(x[0], y[0]);
+			return CMP(x[1], y[1]);
+		}
+	}
+	return 0;
+}
+
+static const int widths[] = {8, 4, 8, 4, 8, 4, 1, 4, 8};
+
+typedef struct {
+	int n_keys;
+	char **keys;
+	const int *types;
+	int reverse;
+} keys_t;
+
+static int cmp_idx(const keys_t *k, const uint64_t a, const uint64_t b)
+{
+	for (int i = 0; i < k->n_keys; i++) {
+		const int w = widths[k->types[i]];
+		const int c = cmp_one(k->types[i], k->keys[i] + a * w, k->keys[i] + b * w);
+		if (c) return k->reverse ? -c : c;
+	}
+	return 0;
+}
+
+// Bottom up merge sort, so equal keys keep their order.
+int argsort(const int n_keys, char **keys, const int *types, const uint64_t count, const int reverse, uint64_t *idx)
+{
+	const keys_t k = {n_keys, keys, types, reverse};
+	uint64_t *tmp = malloc(count * sizeof(uint64_t) + 1);
+	if (!tmp) return 1;
+	uint64_t *src = idx, *dst = tmp;
+	for (uint64_t i = 0; i < count; i++) idx[i] = i;
+	for (uint64_t width = 1; width < count; width *= 2) {
+		for (uint64_t lo = 0; lo < count; lo += width * 2) {
+			const uint64_t mid = lo + width < count ? lo + width : count;
+			const uint64_t hi = lo + width * 2 < count ? lo + width * 2 : count;
+			uint64_t a = lo, b = mid, o = lo;
+			while (a < mid && b < hi) {
+				if (cmp_idx(&k, src[b], src[a]) < 0) {
+					dst[o++] = src[b++];
+				} else {
+					dst[o++] = src[a++];
+				}
+			}
+			while (a < mid) dst[o++] = src[a++];
+			while (b < hi) dst[o++] = src[b++];
+		}
+		uint64_t *t = src;
+		src = dst;
+		dst = t;
+	}
+	if (src != idx) memcpy(idx, src, count * sizeof(uint64_t));
+	free(tmp);
+	return 0;
+}
+
+int write_permuted(const char *out_fn, const char *data, const int width, const uint64_t *idx, const uint64_t count)
+{
+	int res = 1;
+	char buf[65536];
+	const uint64_t per_buf = sizeof(buf) / width;
+	gzFile fh = gzopen(out_fn, "wb");
+	if (!fh) return 1;
+	for (uint64_t i = 0; i < count;) {
+		uint64_t n = 0;
+		for (; n < per_buf && i < count; n++, i++) {
+			memcpy(buf + n * width, data + idx[i] * width, width);
+		}
+		err1(gzwrite(fh, buf, n * width) != (int)(n * width));
+	}
+	res = 0;
+err:
+	if (gzclose(fh)) res = 1;
+	return res;
+}
+''', libraries=['z'], extra_compile_args=['-std=c99'])
+
 
 def sort(columniter):
 	lst = list(columniter(options.sort_columns))
 	reverse = (options.sort_order == 'descending')
 	return sorted(range(len(lst)), key=lst.__getitem__, reverse=reverse)
 
+class FixedColumn(object):
+	# A fixed width column (for all of ds_list in one slice), in an
+	# mmap:ed temporary file so it doesn't have to fit in memory.
+	def __init__(self, name, sliceno, ds_list, count):
+		self.width = fixed_types[datasets.source.columns[name].type][0]
+		self.fn = 'sortcol.%d.%s' % (sliceno, name,)
+		size = count * self.width
+		with open(self.fn, 'w+b') as fh:
+			ftruncate(fh.fileno(), size)
+			self.map = mmap(fh.fileno(), size)
+		self.data = ffi.from_buffer(self.map)
+		pos = 0
+		for ds in ds_list:
+			dc = ds.columns[name]
+			lines = ds.lines[sliceno]
+			offset = dc.offsets[sliceno] if dc.offsets else 0
+			size = lines * self.width
+			if dc.compression == 'none':
+				mm, start, stop = ds.column_mmap(name, sliceno)
+				if mm:
+					self.map[pos:pos + size] = mm[start:stop]
+					mm.close()
+			elif c_readable(dc.compression):
+				in_fn = ds.column_filename(name, sliceno).encode('utf-8')
+				res = backend.load_column(in_fn, offset, size, self.data + pos)
+				assert not res, "Failed to read %s from %s" % (name, ds,)
+			else:
+				end = pos + size
+				p = pos
+				for data in decompressed_chunks(ds.column_filename(name, sliceno), dc.compression, offset):
+					data = data[:end - p]
+					self.map[p:p + len(data)] = data
+					p += len(data)
+					if p == end:
+						break
+				assert p == end, "Failed to read %s from %s" % (name, ds,)
+			pos += size
+
+	def close(self):
+		del self.data
+		self.map.close()
+		unlink(self.fn)
+
+def sortkey(key, ds_ix, sliceno, rowno):
+	# Unique key, with the same order as the stable sort of everything.
+	# (Descending sorts sort the position part descending too, so it is negated.)
+	if options.sort_order == 'descending':
+		return key + (-ds_ix, -sliceno, -rowno,)
+	else:
+		return key + (ds_ix, sliceno, rowno,)
+
+def sample_slice(args):
+	ds_ix, ds, sliceno, step = args
+	ds = Dataset(ds)
+	lines = ds.lines[sliceno]
+	range_rows = -(-lines // step) // SAMPLE_RANGES + 1
+	if range_rows * SAMPLE_RANGES * 2 < lines and all(ds.columns[n].blocks or ds.columns[n].compression == 'none' for n in options.sort_columns):
+		# Only read a few ranges of rows (iterate can start near them).
+		res = []
+		for ix in range(SAMPLE_RANGES):
+			start = lines * ix // SAMPLE_RANGES
+			it = ds.iterate(sliceno, options.sort_columns, status_reporting=False, rows=(start, start + range_rows))
+			res.extend(sortkey(key, ds_ix, sliceno, rowno) for rowno, key in enumerate(it, start))
+		return res
+	it = ds.iterate(sliceno, options.sort_columns, status_reporting=False)
+	return [sortkey(key, ds_ix, sliceno, rowno) for rowno, key in islice(enumerate(it), 0, None, step)]
+
+def read_run(fn):
+	with open(fn, 'rb') as fh:
+		while True:
+			try:
+				chunk = cPickle.load(fh)
+			except EOFError:
+				return
+			for item in chunk:
+				yield item
+
+class Reversed(object):
+	__slots__ = ('v',)
+	def __init__(self, v):
+		self.v = v
+	def __lt__(self, other):
+		return other.v < self.v
+	def __eq__(self, other):
+		return self.v == other.v
+
+def merge_slice(args):
+	# Merge all runs for this slice and write it.
+	sliceno, run_fns, columns, out_fns = args
+	runs = [read_run(fn) for fn in run_fns]
+	if options.sort_order == 'descending':
+		runs = [((Reversed(k), v) for k, v in run) for run in runs]
+	writers = [typed_writer(coltype)(fn) for (_, coltype), fn in zip(columns, out_fns)]
+	writes = [w.write for w in writers]
+	count = 0
+	for _, values in merge(*runs):
+		for w, v in zip(writes, values):
+			w(v)
+		count += 1
+	minmax = {}
+	for (name, _), w in zip(columns, writers):
+		minmax[name] = (w.min, w.max,)
+		w.close()
+	for fn in run_fns:
+		unlink(fn)
+	return count, minmax
+
 def prepare(params):
 	d = datasets.source
 	ds_list = d.chain(stop_ds={datasets.previous: 'source'})
-	if options.sort_across_slices:
-		columniter = partial(Dataset.iterate_list, None, datasets=ds_list)
-		sort_idx = sort(columniter)
-	else:
-		sort_idx = None
 	if options.sort_across_slices:
 		hashlabel = None
 	else:
@@ -65,23 +399,133 @@ def prepare(params):
 		caption=params.caption,
 		hashlabel=hashlabel,
 		filename=filename,
+		meta_only=True,
 	)
-	return dw, ds_list, sort_idx
+	if options.sort_across_slices:
+		total = sum(sum(ds.lines) for ds in ds_list)
+		step = max(total // (SAMPLES_PER_SLICE * params.slices), 1)
+		todo = [(ds_ix, unicode(ds), sliceno, step,) for ds_ix, ds in enumerate(ds_list) for sliceno in range(params.slices)]
+		pool = Pool(params.slices)
+		try:
+			samples = sorted(key for part in pool.map(sample_slice, todo) for key in part)
+		finally:
+			pool.close()
+		# params.slices - 1 splitters give params.slices ranges.
+		splitters = [samples[len(samples) * ix // params.slices] for ix in range(1, params.slices)] if samples else []
+	else:
+		splitters = None
+	return dw, ds_list, splitters
 
 def analysis(sliceno, params, prepare_res):
-	dw, ds_list, sort_idx = prepare_res
+	dw, ds_list, splitters = prepare_res
 	if options.sort_across_slices:
-		columniter = partial(Dataset.iterate_list, None, datasets=ds_list)
-		per_slice = len(sort_idx) // params.slices
-		if sliceno + 1 ==  params.slices:
-			sort_idx = sort_idx[per_slice * sliceno:]
+		return route(sliceno, params.slices, ds_list, splitters)
+	columniter = partial(Dataset.iterate_list, sliceno, datasets=ds_list)
+	columns = datasets.source.columns
+	count = sum(ds.lines[sliceno] for ds in ds_list)
+	if not count:
+		for name, dc in columns.items():
+			typed_writer(dc.type)(dw.column_filename(name, sliceno)).close()
+		return 0, {}
+	loaded = {}
+	try:
+		if all(columns[n].type in fixed_types for n in options.sort_columns):
+			for name in options.sort_columns:
+				if name not in loaded:
+					loaded[name] = FixedColumn(name, sliceno, ds_list, count)
+			keys = [loaded[n].data for n in options.sort_columns]
+			types = [fixed_types[columns[n].type][1] for n in options.sort_columns]
+			sort_idx = ffi.new('uint64_t []', count)
+			res = backend.argsort(len(keys), keys, types, count, options.sort_order == 'descending', sort_idx)
+			assert not res, "argsort failed"
 		else:
-			sort_idx = sort_idx[per_slice * sliceno:per_slice * (sliceno + 1)]
-	else:
-		columniter = partial(Dataset.iterate_list, sliceno, datasets=ds_list)
-		sort_idx = sort(columniter)
-	for column in datasets.source.columns:
-		lst = list(columniter(column))
-		w = dw.writers[column].write
-		for idx in sort_idx:
-			w(lst[idx])
+			sort_idx = ffi.new('uint64_t []', sort(columniter))
+		minmax = {}
+		for name, dc in columns.items():
+			out_fn = dw.column_filename(name, sliceno)
+			if dc.type in fixed_types:
+				col = loaded.pop(name, None) or FixedColumn(name, sliceno, ds_list, count)
+				try:
+					res = backend.write_permuted(out_fn.encode('utf-8'), col.data, col.width, sort_idx, count)
+					assert not res, "Failed to write " + out_fn
+				finally:
+					col.close()
+				# Same values as before, so the same min and max.
+				minmax[name] = source_minmax(ds_list, name)
+			else:
+				lst = list(columniter(name))
+				with typed_writer(dc.type)(out_fn) as w:
+					write = w.write
+					for idx in sort_idx:
+						write(lst[idx])
+				minmax[name] = (w.min, w.max,)
+				del lst
+	finally:
+		for col in loaded.values():
+			col.close()
+	# Here, so compressed columns are recompressed in parallel.
+	dw.set_lines(sliceno, count)
+	return count, minmax
+
+def source_minmax(ds_list, name):
+	values = [(ds.columns[name].min, ds.columns[name].max,) for ds in ds_list]
+	lo = [a for a, _ in values if a is not None]
+	hi = [b for _, b in values if b is not None]
+	return (min(lo) if lo else None, max(hi) if hi else None,)
+
+def route(sliceno, slices, ds_list, splitters):
+	# Send our rows to the slices they belong in, as sorted runs.
+	columns = sorted(datasets.source.columns)
+	key_ixs = [columns.index(n) for n in options.sort_columns]
+	reverse = (options.sort_order == 'descending')
+	buffers = [[] for _ in range(slices)]
+	run_fns = [[] for _ in range(slices)]
+	def flush():
+		for dest, buf in enumerate(buffers):
+			if not buf:
+				continue
+			buf.sort(reverse=reverse)
+			fn = 'sortrun.%d.%d.%d' % (dest, sliceno, len(run_fns[dest]),)
+			with open(fn, 'wb') as fh:
+				for ix in range(0, len(buf), CHUNK_ROWS):
+					cPickle.dump(buf[ix:ix + CHUNK_ROWS], fh, 2)
+			run_fns[dest].append(fn)
+			del buf[:]
+	buffered = 0
+	for ds_ix, ds in enumerate(ds_list):
+		for rowno, values in enumerate(ds.iterate(sliceno, columns)):
+			key = sortkey(tuple(values[ix] for ix in key_ixs), ds_ix, sliceno, rowno)
+			dest = bisect_right(splitters, key)
+			if reverse:
+				dest = slices - 1 - dest
+			buffers[dest].append((key, values,))
+			buffered += 1
+			if buffered == RUN_ROWS:
+				flush()
+				buffered = 0
+	flush()
+	return run_fns
+
+def synthesis(params, prepare_res, analysis_res):
+	dw, ds_list, splitters = prepare_res
+	if not options.sort_across_slices:
+		for sliceno, (count, minmax) in enumerate(analysis_res):
+			dw.set_lines(sliceno, count)
+			dw.set_minmax(sliceno, minmax)
+		return
+	analysis_res = list(analysis_res)
+	# Same order as the values in the runs
+	columns = sorted((name, dc.type) for name, dc in datasets.source.columns.items())
+	todo = []
+	for sliceno in range(params.slices):
+		run_fns = [fn for slice_runs in analysis_res for fn in slice_runs[sliceno]]
+		out_fns = [dw.column_filename(name, sliceno) for name, _ in columns]
+		todo.append((sliceno, run_fns, columns, out_fns,))
+	pool = Pool(params.slices)
+	try:
+		res = pool.map(merge_slice, todo)
+	finally:
+		pool.close()
+	for sliceno, (count, minmax) in enumerate(res):
+		dw.set_lines(sliceno, count)
+		dw.set_minmax(sliceno, minmax)
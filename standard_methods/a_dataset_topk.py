@@ -0,0 +1,93 @@
+############################################################################
+#                                                                          #
+# Copyright (c) 2017 eBay Inc.                                             #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#  http://www.apache.org/licenses/LICENSE-2.0                              #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+#                                                                          #
+############################################################################
+
+from __future__ import division
+from __future__ import absolute_import
+
+description = r'''
+The first count rows of a dataset (or chain to previous) sorted on one
+or more columns, without sorting all of it. By default that's the
+largest rows, use sort_order=ascending for the smallest.
+
+The result is the same as the first count rows of dataset_sort with
+sort_across_slices, ties are kept in the order they were in. All rows
+end up in slice 0, in sorted order.
+
+Each slice only keeps count rows in memory.
+'''
+
+from heapq import nsmallest, nlargest
+
+from extras import OptionEnum, OptionString
+from dataset import DatasetWriter
+
+OrderEnum = OptionEnum('ascending descending')
+
+options = {
+	'sort_columns'           : [OptionString],
+	'sort_order'             : OrderEnum.descending,
+	'count'                  : 1000,
+}
+datasets = ('source', 'previous',)
+
+
+def prepare():
+	assert options.count >= 0, "count must not be negative"
+	d = datasets.source
+	ds_list = d.chain(stop_ds={datasets.previous: 'source'})
+	columns = sorted(d.columns)
+	key_ixs = [columns.index(n) for n in options.sort_columns]
+	return ds_list, columns, key_ixs
+
+def topk(items):
+	# (key, position, values), the position keeps equal keys in order.
+	# The default (descending) arrives as None, like all OptionEnumValue defaults.
+	if options.sort_order == 'ascending':
+		return nsmallest(options.count, items, key=lambda t: t[0] + t[1])
+	else:
+		return nlargest(options.count, items, key=lambda t: t[0] + t[1])
+
+def analysis(sliceno, prepare_res):
+	ds_list, columns, key_ixs = prepare_res
+	if options.sort_order == 'ascending':
+		sign = 1
+	else:
+		sign = -1
+	def items():
+		for ds_ix, ds in enumerate(ds_list):
+			for rowno, values in enumerate(ds.iterate(sliceno, columns)):
+				key = tuple(values[ix] for ix in key_ixs)
+				yield key, (sign * ds_ix, sign * sliceno, sign * rowno,), values
+	return topk(items())
+
+def synthesis(params, prepare_res, analysis_res):
+	ds_list, columns, key_ixs = prepare_res
+	d = datasets.source
+	res = topk(item for slice_res in analysis_res for item in slice_res)
+	dw = DatasetWriter(
+		columns=d.columns,
+		caption=params.caption,
+		filename=d.filename if len(ds_list) == 1 else None,
+		previous=datasets.previous,
+	)
+	dw.set_slice(0)
+	write = dw.write_list
+	for _, _, values in res:
+		write(values)
+	for sliceno in range(1, params.slices):
+		dw.set_slice(sliceno)
@@ -23,9 +23,10 @@ from __future__ import absolute_import
 
 import cffi
 from resource import getpagesize
-from os import unlink, symlink
+from os import unlink, symlink, rename
 from mmap import mmap, PROT_READ
 from itertools import imap
+from multiprocessing.pool import ThreadPool
 from types import NoneType
 
 from extras import OptionEnum, json_save, DotDict
@@ -57,6 +58,9 @@ options = {
 	'discard_untyped'           : bool, # Make unconverted columns inaccessible ("new" dataset)
 	'filter_bad'                : False, # Implies discard_untyped
 	'numeric_comma'             : False, # floats as "3,14"
+	'threads'                   : 1, # Columns converted at the same time in each slice
+	'uncompressed'              : [], # (Fixed width) result columns to store uncompressed, for faster reading
+	'compression'               : {}, # {'COLNAME': 'compression'} for result columns, e.g. 'gzip:9' or 'lzma' (see DatasetWriter)
 }
 
 datasets = ('source', 'previous',)
@@ -105,16 +109,15 @@ convert_template = r'''
 	%(minmax_setup)s;
 	if (max_count < 0) max_count = INT64_MAX;
 	for (int i = 0; (line = read_line(&g)) && i < max_count; i++) {
-		if (skip_bad && badmap[i / 8] & (1 << (i %% 8))) {
-			*bad_count += 1;
-			continue;
-		}
 		char *ptr = buf;
 		%(convert)s;
 		if (!ptr) {
 			if (record_bad && !default_value) {
 				badmap[i / 8] |= 1 << (i %% 8);
 				*bad_count += 1;
+				// Keep the line, it is removed by compact_%(destname)s.
+				memset(buf, 0, %(datalen)s);
+				err1(gzwrite(outfh, buf, %(datalen)s) != %(datalen)s);
 				continue;
 			}
 			if (!default_value) {
@@ -147,6 +150,28 @@ convert_number_template = r'''
 // Up to +-(2**1007 - 1). Don't increase this.
 #define GZNUMBER_MAX_BYTES 127
 
+// Needs the GIL.
+static int convert_big_number(const char *inptr, const int inlen, unsigned char *outptr)
+{
+	PyObject *s = PyString_FromStringAndSize(inptr, inlen);
+	if (!s) exit(1); // All is lost
+	PyObject *i = PyNumber_Long(s);
+	if (!i) PyErr_Clear();
+	Py_DECREF(s);
+	if (!i) return 0;
+	const size_t len_bits = _PyLong_NumBits(i);
+	err1(len_bits == (size_t)-1);
+	const size_t len_bytes = len_bits / 8 + 1;
+	err1(len_bytes >= GZNUMBER_MAX_BYTES);
+	*outptr = len_bytes;
+	err1(_PyLong_AsByteArray((PyLongObject *)i, outptr + 1, len_bytes, 1, 1) < 0);
+	Py_DECREF(i);
+	return len_bytes + 1;
+err:
+	Py_DECREF(i);
+	return 0;
+}
+
 static inline int convert_number_do(const char *inptr, char * const outptr_, const int allow_float)
 {
 	unsigned char *outptr = (unsigned char *)outptr_;
@@ -207,23 +232,10 @@ static inline int convert_number_do(const char *inptr, char * const outptr_, con
 		errno = 0;
 		const int64_t value = strtol(inptr, &end, 10);
 		if (errno || end != inptr + inlen) { // big or invalid
-			PyObject *s = PyString_FromStringAndSize(inptr, inlen);
-			if (!s) exit(1); // All is lost
-			PyObject *i = PyNumber_Long(s);
-			if (!i) PyErr_Clear();
-			Py_DECREF(s);
-			if (!i) return 0;
-			const size_t len_bits = _PyLong_NumBits(i);
-			err1(len_bits == (size_t)-1);
-			const size_t len_bytes = len_bits / 8 + 1;
-			err1(len_bytes >= GZNUMBER_MAX_BYTES);
-			*outptr = len_bytes;
-			err1(_PyLong_AsByteArray((PyLongObject *)i, outptr + 1, len_bytes, 1, 1) < 0);
-			Py_DECREF(i);
-			return len_bytes + 1;
-err:
-			Py_DECREF(i);
-			return 0;
+			PyGILState_STATE gstate = PyGILState_Ensure();
+			const int res = convert_big_number(inptr, inlen, outptr);
+			PyGILState_Release(gstate);
+			return res;
 		} else {
 			*outptr = 8;
 			memcpy(outptr + 1, &value, 8);
@@ -232,6 +244,124 @@ err:
 	}
 }
 
+typedef struct {
+	char buf_col_min[GZNUMBER_MAX_BYTES];
+	char buf_col_max[GZNUMBER_MAX_BYTES];
+	int  minlen;
+	int  maxlen;
+	PyObject *o_col_min;
+	PyObject *o_col_max;
+	double d_col_min;
+	double d_col_max;
+} number_minmax;
+
+// minmax tracking, not done for None-values
+// Only takes the GIL when python objects are needed.
+static int number_minmax_update(number_minmax *mm, const char *ptr, const int len)
+{
+	if (len <= 1) return 0;
+	double d_v = 0;
+	int64_t i_v = 0;
+	int is_double = 1;
+	if (*ptr == 1) { // It's a double
+		memcpy(&d_v, ptr + 1, 8);
+	} else if (*ptr == 8) { // It's an int64_t
+		memcpy(&i_v, ptr + 1, 8);
+		if (i_v <= ((int64_t)1 << 53) && i_v >= -((int64_t)1 << 53)) {
+			// Fits in a double without precision loss
+			d_v = i_v;
+		} else {
+			is_double = 0;
+		}
+	} else { // It's a big number
+		is_double = 0;
+	}
+
+	if (is_double && !mm->o_col_min && !mm->o_col_max) {
+		if (!mm->minlen || d_v < mm->d_col_min) {
+			memcpy(mm->buf_col_min, ptr, len);
+			mm->minlen = len;
+			mm->d_col_min = d_v;
+		}
+		if (!mm->maxlen || d_v > mm->d_col_max) {
+			memcpy(mm->buf_col_max, ptr, len);
+			mm->maxlen = len;
+			mm->d_col_max = d_v;
+		}
+		return 0;
+	}
+
+	int res = 1;
+	PyGILState_STATE gstate = PyGILState_Ensure();
+	PyObject *o_v;
+	if (is_double) {
+		o_v = PyFloat_FromDouble(d_v);
+	} else if (*ptr == 8) {
+		o_v = PyLong_FromLong(i_v);
+	} else {
+		o_v = _PyLong_FromByteArray((unsigned char *)ptr + 1, *ptr, 1, 1);
+	}
+	err1(!o_v);
+	if (mm->minlen) {
+		if (!mm->o_col_min) {
+			mm->o_col_min = PyFloat_FromDouble(mm->d_col_min);
+		}
+		if (!mm->o_col_max) {
+			mm->o_col_max = PyFloat_FromDouble(mm->d_col_max);
+		}
+		if (PyObject_RichCompareBool(o_v, mm->o_col_min, Py_LT)) {
+			memcpy(mm->buf_col_min, ptr, len);
+			mm->minlen = len;
+			Py_INCREF(o_v);
+			Py_DECREF(mm->o_col_min);
+			mm->o_col_min = o_v;
+		}
+		if (PyObject_RichCompareBool(o_v, mm->o_col_max, Py_GT)) {
+			memcpy(mm->buf_col_max, ptr, len);
+			mm->maxlen = len;
+			Py_INCREF(o_v);
+			Py_DECREF(mm->o_col_max);
+			mm->o_col_max = o_v;
+		}
+		Py_DECREF(o_v);
+	} else {
+		memcpy(mm->buf_col_min, ptr, len);
+		memcpy(mm->buf_col_max, ptr, len);
+		mm->minlen = mm->maxlen = len;
+		mm->o_col_min = mm->o_col_max = o_v;
+		Py_INCREF(o_v);
+	}
+	res = 0;
+err:
+	PyGILState_Release(gstate);
+	return res;
+}
+
+static void number_minmax_free(number_minmax *mm)
+{
+	if (mm->o_col_min || mm->o_col_max) {
+		PyGILState_STATE gstate = PyGILState_Ensure();
+		Py_XDECREF(mm->o_col_min);
+		Py_XDECREF(mm->o_col_max);
+		PyGILState_Release(gstate);
+	}
+}
+
+static int number_minmax_write(number_minmax *mm, const char *minmax_fn)
+{
+	int res = 0;
+	gzFile minmaxfh = gzopen(minmax_fn, "wb");
+	if (!minmaxfh) return 1;
+	if (mm->minlen) {
+		if (gzwrite(minmaxfh, mm->buf_col_min, mm->minlen) != mm->minlen) res = 1;
+		if (gzwrite(minmaxfh, mm->buf_col_max, mm->maxlen) != mm->maxlen) res = 1;
+	} else {
+		if (gzwrite(minmaxfh, "\0\0", 2) != 2) res = 1;
+	}
+	if (gzclose(minmaxfh)) res = 1;
+	return res;
+}
+
 %(proto)s
 {
 	g g;
@@ -240,18 +370,10 @@ err:
 	int  res = 1;
 	char buf[GZNUMBER_MAX_BYTES];
 	char defbuf[GZNUMBER_MAX_BYTES];
-	char buf_col_min[GZNUMBER_MAX_BYTES];
-	char buf_col_max[GZNUMBER_MAX_BYTES];
 	int  deflen = 0;
-	int  minlen = 0;
-	int  maxlen = 0;
-	PyObject *o_col_min = 0;
-	PyObject *o_col_max = 0;
-	double d_col_min;
-	double d_col_max;
+	number_minmax mm = {.minlen = 0, .maxlen = 0, .o_col_min = 0, .o_col_max = 0};
 	char *badmap = 0;
 	const int allow_float = !fmt;
-	PyGILState_STATE gstate = PyGILState_Ensure();
 	int fd = open(in_fn, O_RDONLY);
 	if (fd < 0) goto errfd;
 	if (lseek(fd, offset, 0) != offset) goto errfd;
@@ -276,16 +398,14 @@ err:
 	}
 	if (max_count < 0) max_count = INT64_MAX;
 	for (int i = 0; (line = read_line(&g)) && i < max_count; i++) {
-		if (skip_bad && badmap[i / 8] & (1 << (i %% 8))) {
-			*bad_count += 1;
-			continue;
-		}
 		char *ptr = buf;
 		int len = convert_number_do(line, ptr, allow_float);
 		if (!len) {
 			if (record_bad && !deflen) {
 				badmap[i / 8] |= 1 << (i %% 8);
 				*bad_count += 1;
+				// Keep the line, it is removed by compact_number.
+				err1(gzwrite(outfh, "", 1) != 1);
 				continue;
 			}
 			if (!deflen) {
@@ -296,108 +416,110 @@ err:
 			len = deflen;
 			*default_count += 1;
 		}
-		// minmax tracking, not done for None-values
-		if (len > 1) {
-			double d_v = 0;
-			PyObject *o_v = 0;
-			if (*ptr == 1) { // It's a double
-				memcpy(&d_v, ptr + 1, 8);
-			} else if (*ptr == 8) { // It's an int64_t
-				int64_t tmp;
-				memcpy(&tmp, ptr + 1, 8);
-				if (tmp <= ((int64_t)1 << 53) && tmp >= -((int64_t)1 << 53)) {
-					// Fits in a double without precision loss
-					d_v = tmp;
-				} else {
-					o_v = PyLong_FromLong(tmp);
-					err1(!o_v);
-				}
-			} else { // It's a big number
-				o_v = _PyLong_FromByteArray((unsigned char *)ptr + 1, *ptr, 1, 1);
-				err1(!o_v);
-			}
-			if (!o_v && (o_col_min || o_col_max)) {
-				o_v = PyFloat_FromDouble(d_v);
-				err1(!o_v);
-			}
+		err1(number_minmax_update(&mm, ptr, len));
+		err1(gzwrite(outfh, ptr, len) != len);
+	}
+	res = number_minmax_write(&mm, minmax_fn);
+err:
+	number_minmax_free(&mm);
+	if (g.fh) gzclose(g.fh);
+	if (outfh && gzclose(outfh)) res = 1;
+	if (badmap) munmap(badmap, badmap_size);
+errfd:
+	if (fd >= 0) close(fd);
+	return res;
+}
 
-			if (minlen) {
-				if (o_v) {
-					if (!o_col_min) {
-						o_col_min = PyFloat_FromDouble(d_col_min);
-					}
-					if (!o_col_max) {
-						o_col_max = PyFloat_FromDouble(d_col_max);
-					}
-					if (PyObject_RichCompareBool(o_v, o_col_min, Py_LT)) {
-						memcpy(buf_col_min, ptr, len);
-						minlen = len;
-						Py_INCREF(o_v);
-						Py_DECREF(o_col_min);
-						o_col_min = o_v;
-					}
-					if (PyObject_RichCompareBool(o_v, o_col_max, Py_GT)) {
-						memcpy(buf_col_max, ptr, len);
-						maxlen = len;
-						Py_INCREF(o_v);
-						Py_DECREF(o_col_max);
-						o_col_max = o_v;
-					}
-					Py_DECREF(o_v);
-				} else {
-					if (d_v < d_col_min) {
-						memcpy(buf_col_min, ptr, len);
-						minlen = len;
-						d_col_min = d_v;
-					}
-					if (d_v > d_col_max) {
-						memcpy(buf_col_max, ptr, len);
-						maxlen = len;
-						d_col_max = d_v;
-					}
-				}
-			} else {
-				memcpy(buf_col_min, ptr, len);
-				memcpy(buf_col_max, ptr, len);
-				minlen = maxlen = len;
-				d_col_min = d_col_max = d_v;
-				o_col_min = o_col_max = o_v;
-				if (o_v) Py_INCREF(o_v);
-			}
+%(compact_proto)s
+{
+	gzFile infh = 0;
+	gzFile outfh = 0;
+	int  res = 1;
+	char buf[GZNUMBER_MAX_BYTES];
+	number_minmax mm = {.minlen = 0, .maxlen = 0, .o_col_min = 0, .o_col_max = 0};
+	char *badmap = mmap(0, badmap_size, PROT_READ, MAP_NOSYNC | MAP_SHARED, badmap_fd, 0);
+	err1(badmap == MAP_FAILED);
+	infh = gzopen(in_fn, "rb");
+	err1(!infh);
+	outfh = gzopen(out_fn, "wb");
+	err1(!outfh);
+	int got;
+	for (int64_t i = 0; (got = gzread(infh, buf, 1)) == 1; i++) {
+		const unsigned char c = *buf;
+		const int len = c == 0 ? 1 : c == 1 ? 9 : c + 1;
+		err1(len > GZNUMBER_MAX_BYTES);
+		if (len > 1) err1(gzread(infh, buf + 1, len - 1) != len - 1);
+		if (badmap[i / 8] & (1 << (i %% 8))) {
+			*bad_count += 1;
+			continue;
 		}
-		err1(gzwrite(outfh, ptr, len) != len);
+		err1(number_minmax_update(&mm, buf, len));
+		err1(gzwrite(outfh, buf, len) != len);
 	}
+	err1(got != 0);
+	res = number_minmax_write(&mm, minmax_fn);
+err:
+	number_minmax_free(&mm);
+	if (infh) gzclose(infh);
+	if (outfh && gzclose(outfh)) res = 1;
+	if (badmap != MAP_FAILED) munmap(badmap, badmap_size);
+	return res;
+}
+'''
+
+compact_template = r'''
+%(proto)s
+{
+	gzFile infh = 0;
+	gzFile outfh = 0;
+	int res = 1;
+	char buf[%(datalen)s];
+	char buf_col_min[%(datalen)s];
+	char buf_col_max[%(datalen)s];
+	char *badmap = mmap(0, badmap_size, PROT_READ, MAP_NOSYNC | MAP_SHARED, badmap_fd, 0);
+	err1(badmap == MAP_FAILED);
+	infh = gzopen(in_fn, "rb");
+	err1(!infh);
+	outfh = gzopen(out_fn, "wb");
+	err1(!outfh);
+	%(minmax_setup)s;
+	int got;
+	for (int64_t i = 0; (got = gzread(infh, buf, %(datalen)s)) == %(datalen)s; i++) {
+		if (badmap[i / 8] & (1 << (i %% 8))) {
+			*bad_count += 1;
+			continue;
+		}
+		char *ptr = buf;
+		%(minmax_code)s;
+		err1(gzwrite(outfh, ptr, %(datalen)s) != %(datalen)s);
+	}
+	err1(got != 0);
 	gzFile minmaxfh = gzopen(minmax_fn, "wb");
 	err1(!minmaxfh);
 	res = 0;
-	if (minlen) {
-		if (gzwrite(minmaxfh, buf_col_min, minlen) != minlen) res = 1;
-		if (gzwrite(minmaxfh, buf_col_max, maxlen) != maxlen) res = 1;
-	} else {
-		if (gzwrite(minmaxfh, "\0\0", 2) != 2) res = 1;
-	}
+	if (gzwrite(minmaxfh, buf_col_min, %(datalen)s) != %(datalen)s) res = 1;
+	if (gzwrite(minmaxfh, buf_col_max, %(datalen)s) != %(datalen)s) res = 1;
 	if (gzclose(minmaxfh)) res = 1;
 err:
-	Py_XDECREF(o_col_min);
-	Py_XDECREF(o_col_max);
-	PyGILState_Release(gstate);
-	if (g.fh) gzclose(g.fh);
+	if (infh) gzclose(infh);
 	if (outfh && gzclose(outfh)) res = 1;
-	if (badmap) munmap(badmap, badmap_size);
-errfd:
-	if (fd >= 0) close(fd);
+	if (badmap != MAP_FAILED) munmap(badmap, badmap_size);
 	return res;
 }
 '''
 
-proto_template = 'int convert_column_%s(const char *in_fn, const char *out_fn, const char *minmax_fn, const char *default_value, int default_value_is_None, const char *fmt, int record_bad, int skip_bad, int badmap_fd, size_t badmap_size, uint64_t *bad_count, uint64_t *default_count, size_t offset, int64_t max_count)'
+proto_template = 'int convert_column_%s(const char *in_fn, const char *out_fn, const char *minmax_fn, const char *default_value, int default_value_is_None, const char *fmt, int record_bad, int badmap_fd, size_t badmap_size, uint64_t *bad_count, uint64_t *default_count, size_t offset, int64_t max_count)'
+# Removes the lines in the badmap from a converted column (and redoes minmax).
+compact_proto_template = 'int compact_%s(const char *in_fn, const char *out_fn, const char *minmax_fn, int badmap_fd, size_t badmap_size, uint64_t *bad_count)'
 
 protos = []
-funcs = [dataset_typing.minmax_data, dataset_typing.noneval_data]
+funcs = [dataset_typing.minmax_data, dataset_typing.noneval_data, dataset_typing.strptime_data]
 
 proto = proto_template % ('number',)
-code = convert_number_template % dict(proto=proto,)
+compact_proto = compact_proto_template % ('number',)
+code = convert_number_template % dict(proto=proto, compact_proto=compact_proto,)
 protos.append(proto + ';')
+protos.append(compact_proto + ';')
 funcs.append(code)
 
 for name, ct in dataset_typing.convfuncs.iteritems():
@@ -412,7 +534,13 @@ for name, ct in dataset_typing.convfuncs.iteritems():
 	mm = dataset_typing.minmaxfuncs[destname]
 	noneval_support = not destname.startswith('bits')
 	noneval_name = 'noneval_' + destname
-	code = convert_template % dict(proto=proto, datalen=ct.size, convert=ct.conv_code_str, minmax_setup=mm.setup, minmax_code=mm.code, noneval_support=noneval_support, noneval_name=noneval_name)
+	code = convert_template % dict(proto=proto, datalen=ct.size, convert=ct.conv_code_str, minmax_setup=mm.setup, minmax_code=mm.code, noneval_support=noneval_support, noneval_name=noneval_name, destname=destname)
+	protos.append(proto + ';')
+	funcs.append(code)
+
+for destname, mm in dataset_typing.minmaxfuncs.iteritems():
+	proto = compact_proto_template % (destname,)
+	code = compact_template % dict(proto=proto, datalen=dataset_typing.typesizes[destname], minmax_setup=mm.setup, minmax_code=mm.code)
 	protos.append(proto + ';')
 	funcs.append(code)
 
@@ -460,6 +588,7 @@ errfd:
 protos.append('int filter_strings(const char *in_fn, const char *out_fn, int badmap_fd, size_t badmap_size, size_t offset, int64_t max_count);')
 protos.append('int filter_stringstrip(const char *in_fn, const char *out_fn, int badmap_fd, size_t badmap_size, size_t offset, int64_t max_count);')
 protos.append('int numeric_comma(void);')
+protos.append('int merge_badmap(int dst_fd, int src_fd, size_t badmap_size);')
 funcs.append(filter_string_template % dict(name='filter_strings', conv=r'''
 		int len = strlen(line);
 '''))
@@ -503,6 +632,23 @@ int numeric_comma(void)
 	return !setlocale(LC_NUMERIC, "sv_SE.UTF-8");
 }
 
+int merge_badmap(int dst_fd, int src_fd, size_t badmap_size)
+{
+	int res = 1;
+	uint64_t *dst = mmap(0, badmap_size, PROT_READ | PROT_WRITE, MAP_NOSYNC | MAP_SHARED, dst_fd, 0);
+	if (dst == MAP_FAILED) return 1;
+	const uint64_t *src = mmap(0, badmap_size, PROT_READ, MAP_NOSYNC | MAP_SHARED, src_fd, 0);
+	err1(src == MAP_FAILED);
+	for (size_t i = 0; i < badmap_size / 8; i++) {
+		dst[i] |= src[i];
+	}
+	munmap((void *)src, badmap_size);
+	res = 0;
+err:
+	munmap(dst, badmap_size);
+	return res;
+}
+
 static int read_chunk(g *g, int offset)
 {
 	const int len = gzread(g->fh, g->buf + offset, Z - offset);
@@ -545,6 +691,7 @@ def prepare():
 	columns = {}
 	for colname, coltype in options.column2type.iteritems():
 		assert d.columns[colname].type == 'bytes', colname
+		assert d.columns[colname].compression.startswith('gzip'), "Can't type %s compressed column %s" % (d.columns[colname].compression, colname,)
 		coltype = coltype.split(':', 1)[0]
 		columns[options.rename.get(colname, colname)] = dataset_typing.typerename.get(coltype, coltype)
 	if options.filter_bad or options.discard_untyped:
@@ -552,8 +699,11 @@ def prepare():
 		parent = None
 	else:
 		parent = datasets.source
-	return DatasetWriter(
-		columns=columns,
+	compression = dict.fromkeys(options.uncompressed, 'none')
+	compression.update(options.compression)
+	for colname in compression:
+		assert colname in columns, "compression for column %s which is not typed" % (colname,)
+	dw = DatasetWriter(
 		caption=options.caption,
 		hashlabel=options.rename.get(d.hashlabel, d.hashlabel),
 		hashlabel_override=True,
@@ -561,161 +711,235 @@ def prepare():
 		previous=datasets.previous,
 		meta_only=True,
 	)
+	for colname, coltype in sorted(columns.items()):
+		dw.add(colname, coltype, compression=compression.get(colname, 'gzip'))
+	return dw
 
 def analysis(sliceno):
 	if options.numeric_comma:
 		if backend.numeric_comma():
 			raise Exception("Failed to enable numeric_comma")
 	if options.filter_bad:
+		pagesize = getpagesize()
+		badmap_size = (datasets.source.lines[sliceno] // 8 // pagesize + 1) * pagesize
 		badmap_fh = open('badmap%d' % (sliceno,), 'w+b')
-		bad_count, default_count, minmax, link_candidates = analysis_lap(sliceno, badmap_fh, True)
-		if sum(bad_count.itervalues()):
-			final_bad_count, default_count, minmax, link_candidates = analysis_lap(sliceno, badmap_fh, False)
-			final_bad_count = max(final_bad_count.itervalues())
+		badmap_fh.truncate(badmap_size)
+		badmap_fd = badmap_fh.fileno()
+	else:
+		badmap_size = 0
+		badmap_fd = -1
+	# Every column is converted once. Lines that are bad in any column
+	# are then removed from the converted columns by compact_columns,
+	# and string columns are filtered when the badmap is complete.
+	# Each column has its own badmap while converting, so they can be
+	# converted in parallel. They are merged into badmap_fh after.
+	bad_count = {}
+	default_count = {}
+	minmax = {}
+	string_columns = []
+	todo = [(sliceno, colix, colname, coltype, badmap_size,) for colix, (colname, coltype) in enumerate(options.column2type.iteritems())]
+	for (_, colix, colname, _, _), res in zip(todo, in_threads(convert_column, todo)):
+		bad_count[colname], default_count[colname], column_minmax, string_column = res
+		if column_minmax is None:
+			string_columns.append(string_column)
 		else:
-			final_bad_count = 0
-		badmap_fh.close()
+			minmax[colname] = column_minmax
+		if options.filter_bad:
+			colmap_fn = column_badmap_fn(sliceno, colix)
+			if bad_count[colname]:
+				with open(colmap_fn, 'rb') as fh:
+					res = backend.merge_badmap(badmap_fd, fh.fileno(), badmap_size)
+					assert not res, "Failed to merge badmaps"
+			unlink(colmap_fn)
+	if sum(bad_count.itervalues()):
+		final_bad_count = compact_columns(sliceno, badmap_fd, badmap_size, minmax)
 	else:
-		bad_count, default_count, minmax, link_candidates = analysis_lap(sliceno, None, False)
 		final_bad_count = 0
-	for src, dst in link_candidates:
-		symlink(src, dst)
+		badmap_fd = -1
+	filter_string_columns(string_columns, badmap_fd, badmap_size)
+	if options.filter_bad:
+		badmap_fh.close()
+	# Here, so compressed columns are recompressed in parallel.
+	DatasetWriter().set_lines(sliceno, datasets.source.lines[sliceno] - final_bad_count)
 	return bad_count, final_bad_count, default_count, minmax
 
-def analysis_lap(sliceno, badmap_fh, first_lap):
-	known_line_count = 0
-	badmap_size = 0
-	badmap_fd = -1
-	res_bad_count = {}
-	res_default_count = {}
-	res_minmax = {}
-	link_candidates = []
-	if first_lap:
-		record_bad = options.filter_bad
-		skip_bad = 0
+def in_threads(func, todo):
+	if options.threads > 1 and len(todo) > 1:
+		pool = ThreadPool(min(options.threads, len(todo)))
+		try:
+			return pool.map(func, todo, chunksize=1)
+		finally:
+			pool.close()
+	else:
+		return map(func, todo)
+
+def column_destname(coltype):
+	coltype = coltype.split(':', 1)[0]
+	return dataset_typing.typerename.get(coltype, coltype)
+
+def column_badmap_fn(sliceno, colix):
+	return 'badmap%d.%d' % (sliceno, colix,)
+
+def convert_column(args):
+	sliceno, colix, colname, coltype, badmap_size = args
+	if options.filter_bad:
+		with open(column_badmap_fn(sliceno, colix), 'w+b') as badmap_fh:
+			badmap_fh.truncate(badmap_size)
+			return convert_column_do(sliceno, colix, colname, coltype, badmap_fh.fileno(), badmap_size)
 	else:
-		record_bad = 0
-		skip_bad = options.filter_bad
-	minmax_fn = 'minmax%d' % (sliceno,)
+		return convert_column_do(sliceno, colix, colname, coltype, -1, 0)
+
+def convert_column_do(sliceno, colix, colname, coltype, badmap_fd, badmap_size):
+	record_bad = options.filter_bad
+	minmax_fn = 'minmax%d.%d' % (sliceno, colix,)
 	dw = DatasetWriter()
-	for colname, coltype in options.column2type.iteritems():
-		out_fn = dw.column_filename(options.rename.get(colname, colname)).encode('ascii')
-		if ':' in coltype and not coltype.startswith('number:'):
-			coltype, fmt = coltype.split(':', 1)
-			_, cfunc, pyfunc = dataset_typing.convfuncs[coltype + ':*']
-			if '%f' in fmt:
-				# needs to fall back to python version
-				cfunc = None
-			if not cfunc:
-				pyfunc = pyfunc(coltype, fmt)
-		else:
-			_, cfunc, pyfunc = dataset_typing.convfuncs[coltype]
-			fmt = ffi.NULL
-		d = datasets.source
-		assert d.columns[colname].type in ('bytes', 'string',), colname
-		if options.filter_bad:
-			line_count = d.lines[sliceno]
-			if known_line_count:
-				assert line_count == known_line_count, (colname, line_count, known_line_count)
-			else:
-				known_line_count = line_count
-				pagesize = getpagesize()
-				badmap_size = (line_count // 8 // pagesize + 1) * pagesize
-				badmap_fh.truncate(badmap_size)
-				badmap_fd = badmap_fh.fileno()
-		in_fn = d.column_filename(colname, sliceno).encode('ascii')
-		if d.columns[colname].offsets:
-			offset = d.columns[colname].offsets[sliceno]
-			max_count = d.lines[sliceno]
+	out_fn = dw.column_filename(options.rename.get(colname, colname)).encode('ascii')
+	if ':' in coltype and not coltype.startswith('number:'):
+		coltype, fmt = coltype.split(':', 1)
+		_, cfunc, pyfunc = dataset_typing.convfuncs[coltype + ':*']
+		if not cfunc:
+			pyfunc = pyfunc(coltype, fmt)
+	else:
+		_, cfunc, pyfunc = dataset_typing.convfuncs[coltype]
+		fmt = ffi.NULL
+	d = datasets.source
+	assert d.columns[colname].type in ('bytes', 'string',), colname
+	in_fn = d.column_filename(colname, sliceno).encode('ascii')
+	if d.columns[colname].offsets:
+		offset = d.columns[colname].offsets[sliceno]
+		max_count = d.lines[sliceno]
+	else:
+		offset = 0
+		max_count = -1
+	if coltype == 'number':
+		cfunc = True
+	if coltype == 'number:int':
+		coltype = 'number'
+		cfunc = True
+		fmt = "int"
+	if cfunc:
+		default_value = options.defaults.get(colname, ffi.NULL)
+		if default_value is None:
+			default_value = ffi.NULL
+			default_value_is_None = True
 		else:
-			offset = 0
-			max_count = -1
-		if coltype == 'number':
-			cfunc = True
-		if coltype == 'number:int':
-			coltype = 'number'
-			cfunc = True
-			fmt = "int"
-		if cfunc:
-			default_value = options.defaults.get(colname, ffi.NULL)
-			if default_value is None:
-				default_value = ffi.NULL
-				default_value_is_None = True
-			else:
-				default_value_is_None = False
-			bad_count = ffi.new('uint64_t [1]', [0])
-			default_count = ffi.new('uint64_t [1]', [0])
-			c = getattr(backend, 'convert_column_' + coltype)
-			res = c(in_fn, out_fn, minmax_fn, default_value, default_value_is_None, fmt, record_bad, skip_bad, badmap_fd, badmap_size, bad_count, default_count, offset, max_count)
-			assert not res, 'Failed to convert ' + colname
-			res_bad_count[colname] = bad_count[0]
-			res_default_count[colname] = default_count[0]
-			with type2iter[dataset_typing.typerename.get(coltype, coltype)](minmax_fn) as it:
-				res_minmax[colname] = list(it)
-			unlink(minmax_fn)
-		elif pyfunc is str:
-			# We skip it the first time around, and link it from
-			# the source dataset if there were no bad lines.
-			# (That happens at the end of analysis.)
-			# We can't do that if the file is not slice-specific though.
-			if skip_bad or '%s' not in d.column_filename(colname, '%s'):
-				res = backend.filter_strings(in_fn, out_fn, badmap_fd, badmap_size, offset, max_count);
-				assert not res, 'Failed to convert ' + colname
+			default_value_is_None = False
+		bad_count = ffi.new('uint64_t [1]', [0])
+		default_count = ffi.new('uint64_t [1]', [0])
+		c = getattr(backend, 'convert_column_' + coltype)
+		res = c(in_fn, out_fn, minmax_fn, default_value, default_value_is_None, fmt, record_bad, badmap_fd, badmap_size, bad_count, default_count, offset, max_count)
+		assert not res, 'Failed to convert ' + colname
+		with type2iter[dataset_typing.typerename.get(coltype, coltype)](minmax_fn) as it:
+			minmax = list(it)
+		unlink(minmax_fn)
+		return bad_count[0], default_count[0], minmax, None
+	elif pyfunc in (str, str.strip,):
+		# These don't have bad values, so they are done
+		# when we know which lines to filter out.
+		return 0, 0, None, (colname, in_fn, out_fn, offset, max_count, pyfunc is str.strip,)
+	else:
+		# python func
+		nodefault = object()
+		if colname in options.defaults:
+			if options.defaults[colname] is None:
+				default_value = None
 			else:
-				link_candidates.append((in_fn, out_fn,))
-			res_bad_count[colname] = 0
-			res_default_count[colname] = 0
-		elif pyfunc is str.strip:
-			res = backend.filter_stringstrip(in_fn, out_fn, badmap_fd, badmap_size, offset, max_count);
-			assert not res, 'Failed to convert ' + colname
-			res_bad_count[colname] = 0
-			res_default_count[colname] = 0
+				default_value = pyfunc(options.defaults[colname])
 		else:
-			# python func
-			nodefault = object()
-			if colname in options.defaults:
-				if options.defaults[colname] is None:
-					default_value = None
-				else:
-					default_value = pyfunc(options.defaults[colname])
-			else:
-				default_value = nodefault
-			if options.filter_bad:
-				badmap = mmap(badmap_fd, badmap_size)
-			bad_count = 0
-			default_count = 0
-			with typed_writer(dataset_typing.typerename.get(coltype, coltype))(out_fn) as fh:
-				col_min = col_max = None
-				for ix, v in enumerate(d.iterate(sliceno, colname)):
-					if skip_bad:
-						if ord(badmap[ix // 8]) & (1 << (ix % 8)):
-							bad_count += 1
-							continue
-					try:
-						v = pyfunc(v)
-					except ValueError:
-						if default_value is not nodefault:
-							v = default_value
-							default_count += 1
-						elif record_bad:
-							bad_count += 1
-							bv = ord(badmap[ix // 8])
-							badmap[ix // 8] = chr(bv | (1 << (ix % 8)))
-							continue
-						else:
-							raise Exception("Invalid value %r with no default in %s" % (v, colname,))
-					if not isinstance(v, (NoneType, str, unicode,)):
-						if col_min is None:
-							col_min = col_max = v
-						if v < col_min: col_min = v
-						if v > col_max: col_max = v
-					fh.write(v)
-			if options.filter_bad:
-				badmap.close()
-			res_bad_count[colname] = bad_count
-			res_default_count[colname] = default_count
-			res_minmax[colname] = [col_min, col_max]
-	return res_bad_count, res_default_count, res_minmax, link_candidates
+			default_value = nodefault
+		if options.filter_bad:
+			badmap = mmap(badmap_fd, badmap_size)
+		bad_count = 0
+		default_count = 0
+		with typed_writer(dataset_typing.typerename.get(coltype, coltype))(out_fn) as fh:
+			col_min = col_max = None
+			for ix, v in enumerate(d.iterate(sliceno, colname)):
+				try:
+					v = pyfunc(v)
+				except ValueError:
+					if default_value is not nodefault:
+						v = default_value
+						default_count += 1
+					elif record_bad:
+						bad_count += 1
+						bv = ord(badmap[ix // 8])
+						badmap[ix // 8] = chr(bv | (1 << (ix % 8)))
+						# Keep the line, it is removed by compact_columns.
+						fh.write(None)
+						continue
+					else:
+						raise Exception("Invalid value %r with no default in %s" % (v, colname,))
+				if not isinstance(v, (NoneType, str, unicode,)):
+					if col_min is None:
+						col_min = col_max = v
+					if v < col_min: col_min = v
+					if v > col_max: col_max = v
+				fh.write(v)
+		if options.filter_bad:
+			badmap.close()
+		return bad_count, default_count, [col_min, col_max], None
+
+def compact_columns(sliceno, badmap_fd, badmap_size, res_minmax):
+	# Remove the bad lines from all converted columns.
+	# Returns the number of bad lines.
+	todo = [(sliceno, colix, colname, badmap_fd, badmap_size,) for colix, colname in enumerate(sorted(res_minmax))]
+	final_bad_count = 0
+	for (_, _, colname, _, _), (minmax, bad_count) in zip(todo, in_threads(compact_column, todo)):
+		res_minmax[colname] = minmax
+		final_bad_count = max(final_bad_count, bad_count)
+	return final_bad_count
+
+def compact_column(args):
+	sliceno, colix, colname, badmap_fd, badmap_size = args
+	minmax_fn = 'minmax%d.%d' % (sliceno, colix,)
+	destname = column_destname(options.column2type[colname])
+	dw = DatasetWriter()
+	out_fn = dw.column_filename(options.rename.get(colname, colname)).encode('ascii')
+	in_fn = out_fn + '.uncompacted'
+	rename(out_fn, in_fn)
+	if destname == 'number' or destname in dataset_typing.minmaxfuncs:
+		bad_count = ffi.new('uint64_t [1]', [0])
+		c = getattr(backend, 'compact_' + destname)
+		res = c(in_fn, out_fn, minmax_fn, badmap_fd, badmap_size, bad_count)
+		assert not res, 'Failed to filter ' + colname
+		with type2iter[destname](minmax_fn) as it:
+			minmax = list(it)
+		unlink(minmax_fn)
+		bad_count = bad_count[0]
+	else:
+		badmap = mmap(badmap_fd, badmap_size, prot=PROT_READ)
+		bad_count = 0
+		with typed_writer(destname)(out_fn) as fh:
+			col_min = col_max = None
+			for ix, v in enumerate(type2iter[destname](in_fn)):
+				if ord(badmap[ix // 8]) & (1 << (ix % 8)):
+					bad_count += 1
+					continue
+				if not isinstance(v, (NoneType, str, unicode,)):
+					if col_min is None:
+						col_min = col_max = v
+					if v < col_min: col_min = v
+					if v > col_max: col_max = v
+				fh.write(v)
+		badmap.close()
+		minmax = [col_min, col_max]
+	unlink(in_fn)
+	return minmax, bad_count
+
+def filter_string_columns(string_columns, badmap_fd, badmap_size):
+	in_threads(filter_string_column, [column + (badmap_fd, badmap_size,) for column in string_columns])
+
+def filter_string_column(args):
+	colname, in_fn, out_fn, offset, max_count, strip, badmap_fd, badmap_size = args
+	if strip:
+		res = backend.filter_stringstrip(in_fn, out_fn, badmap_fd, badmap_size, offset, max_count)
+	elif badmap_fd == -1 and '%s' in datasets.source.column_filename(colname, '%s'):
+		# No bad lines and a slice specific file, so it can be used as is.
+		symlink(in_fn, out_fn)
+		return
+	else:
+		res = backend.filter_strings(in_fn, out_fn, badmap_fd, badmap_size, offset, max_count)
+	assert not res, 'Failed to convert ' + colname
 
 def synthesis(params, analysis_res, prepare_res):
 	r = report()
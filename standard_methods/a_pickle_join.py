@@ -19,10 +19,25 @@
 from __future__ import division
 from __future__ import absolute_import
 
-from extras import OptionEnum, JobWithFile
+description = r'''
+Join pickles (the same file from several jobs, sliced or not) into one.
+
+flavour=dict updates the first with the others, dictofset does a union
+of the sets for each key. Both load everything into memory.
+
+flavour=pairset joins pairset files (as made by columnpair_to_set with
+flavour=compact) like dictofset, but streams through the files in key
+order, so it doesn't load them and the result is a pairset file too.
+'''
+
+from extras import OptionEnum, JobWithFile, full_filename
 from blob import load, save
+from . import pairset
+from . import file_concat
+
+depend_extra = (pairset, file_concat,)
 
-FlavourEnum = OptionEnum('dict dictofset')
+FlavourEnum = OptionEnum('dict dictofset pairset')
 
 options = {
 	'pickles'   : [JobWithFile],
@@ -38,8 +53,16 @@ def upd_dictofset(res, tmp):
 		res.setdefault(k, set()).update(v)
 
 def one_slice(sliceno):
+	if options.flavour == 'pairset':
+		sources = [pairset.PairSet(full_filename(fn, '.pairset', sliceno)) for fn in options.pickles]
+		pairset.merge(sources, options.resultname, sliceno=sliceno, temp=False)
+		for ps in sources:
+			ps.close()
+		return
 	first = True
-	updater = globals()['upd_' + options.flavour]
+	# The default flavour arrives as None. (OptionEnumValue pickles as a
+	# class, so defaults from the runner end up None in params2defaults.)
+	updater = globals()['upd_' + (options.flavour or 'dict')]
 	for pickle in options.pickles:
 		tmp = load(pickle, sliceno=sliceno)
 		if first:
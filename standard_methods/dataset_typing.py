@@ -27,6 +27,8 @@ from collections import namedtuple
 from functools import partial
 import ujson
 
+import sourcedata
+
 __all__ = ('convfuncs', 'typerename', 'typesizes', 'minmaxfuncs',)
 
 def _mk_conv_datetime(coltype, fmt):
@@ -104,8 +106,9 @@ def _conv_number(v):
 
 _c_conv_date_template = r'''
 	struct tm tm;
+	uint32_t usec;
 	memset(&tm, 0, sizeof(tm));
-	char *pres = strptime(line, fmt, &tm);
+	char *pres = strptime_f(line, fmt, &tm, &usec);
 	if (%(whole)d && pres) {
 		while (*pres == 32 || (*pres >= 9 && *pres <= 13)) pres++;
 	}
@@ -119,14 +122,15 @@ _c_conv_date_template = r'''
 _c_conv_datetime = r'''
 		p[0] = (uint32_t)(tm.tm_year + 1900) << 14 | (uint32_t)(tm.tm_mon + 1) << 10 |
 		       (uint32_t)tm.tm_mday << 5 | tm.tm_hour;
-		p[1] = (uint32_t)tm.tm_min << 26 | (uint32_t)tm.tm_sec << 20;
+		p[1] = (uint32_t)tm.tm_min << 26 | (uint32_t)tm.tm_sec << 20 | usec;
 '''
 _c_conv_date = r'''
+		(void) usec;
 		p[0] = (uint32_t)(tm.tm_year + 1900) << 9 | (uint32_t)(tm.tm_mon + 1) << 5 | tm.tm_mday;
 '''
 _c_conv_time = r'''
 		p[0] = 32277536 | tm.tm_hour; // 1970 if read as datetime
-		p[1] = (uint32_t)tm.tm_min << 26 | (uint32_t)tm.tm_sec << 20;
+		p[1] = (uint32_t)tm.tm_min << 26 | (uint32_t)tm.tm_sec << 20 | usec;
 '''
 
 _c_conv_float_template = r'''
@@ -319,10 +323,119 @@ static const unsigned char noneval_double[8] = {0xde, 0xad, 0xde, 0xad, 0xde, 0x
 static const unsigned char noneval_float[4] = {0xde, 0xad, 0x80, 0xff};
 '''
 
+# Used by the date/time converters, needs <time.h>, <string.h> and <stdint.h>.
+strptime_data = r'''
+// Fixed number of digits, for the ISO 8601 parser.
+static inline const char *iso_digits(const char *s, const int count, int *res)
+{
+	*res = 0;
+	for (int i = 0; i < count; i++) {
+		if (s[i] < '0' || s[i] > '9') return 0;
+		*res = *res * 10 + s[i] - '0';
+	}
+	return s + count;
+}
+
+// "YYYY-MM-DD", optionally followed by sep and "HH:MM:SS", optionally followed by ".f".
+// (Like the strptime formats do, with ".f" being 1 to 6 digits.)
+static const char *iso_parse(const char *s, struct tm *tm, uint32_t *usec, const char sep, const int frac)
+{
+	int year, mon, mday, hour = 0, min = 0, sec = 0;
+	s = iso_digits(s, 4, &year);
+	if (!s || *s++ != '-') return 0;
+	s = iso_digits(s, 2, &mon);
+	if (!s || *s++ != '-') return 0;
+	s = iso_digits(s, 2, &mday);
+	if (!s) return 0;
+	if (sep) {
+		if (*s++ != sep) return 0;
+		s = iso_digits(s, 2, &hour);
+		if (!s || *s++ != ':') return 0;
+		s = iso_digits(s, 2, &min);
+		if (!s || *s++ != ':') return 0;
+		s = iso_digits(s, 2, &sec);
+		if (!s) return 0;
+	}
+	// Same limits as strptime
+	if (mon < 1 || mon > 12 || mday < 1 || mday > 31 || hour > 23 || min > 59 || sec > 61) return 0;
+	if (frac) {
+		if (*s++ != '.') return 0;
+		int digits = 0;
+		*usec = 0;
+		while (*s >= '0' && *s <= '9' && digits < 6) {
+			*usec = *usec * 10 + *s++ - '0';
+			digits++;
+		}
+		if (!digits) return 0;
+		for (; digits < 6; digits++) *usec *= 10;
+	}
+	tm->tm_year = year - 1900;
+	tm->tm_mon = mon - 1;
+	tm->tm_mday = mday;
+	tm->tm_hour = hour;
+	tm->tm_min = min;
+	tm->tm_sec = sec;
+	return s;
+}
+
+// strptime, but %f (microseconds, 1 to 6 digits like in python) works,
+// and the common ISO 8601 formats are parsed without using strptime.
+// What fmt doesn't have is 1900-01-01 00:00:00, like in python.
+static char *strptime_f(const char *s, const char *fmt, struct tm *tm, uint32_t *usec)
+{
+	memset(tm, 0, sizeof(*tm));
+	tm->tm_mday = 1;
+	static const struct {
+		const char *fmt;
+		char sep;
+		int frac;
+	} iso_fmts[] = {
+		{"%Y-%m-%d", 0, 0},
+		{"%Y-%m-%d %H:%M:%S", ' ', 0},
+		{"%Y-%m-%dT%H:%M:%S", 'T', 0},
+		{"%Y-%m-%d %H:%M:%S.%f", ' ', 1},
+		{"%Y-%m-%dT%H:%M:%S.%f", 'T', 1},
+	};
+	*usec = 0;
+	for (size_t i = 0; i < sizeof(iso_fmts) / sizeof(*iso_fmts); i++) {
+		if (!strcmp(fmt, iso_fmts[i].fmt)) {
+			const char *res = iso_parse(s, tm, usec, iso_fmts[i].sep, iso_fmts[i].frac);
+			if (res) return (char *)res;
+			break; // maybe strptime is more lenient
+		}
+	}
+	const char *f = fmt;
+	while ((f = strchr(f, '%'))) {
+		if (f[1] == 'f') break;
+		if (f[1]) f++;
+		f++;
+	}
+	if (!f) return strptime(s, fmt, tm);
+	const size_t prefix_len = f - fmt;
+	char prefix[prefix_len + 1];
+	memcpy(prefix, fmt, prefix_len);
+	prefix[prefix_len] = 0;
+	s = strptime(s, prefix, tm);
+	if (!s) return 0;
+	int digits = 0;
+	while (*s >= '0' && *s <= '9' && digits < 6) {
+		*usec = *usec * 10 + *s++ - '0';
+		digits++;
+	}
+	if (!digits) return 0;
+	for (; digits < 6; digits++) *usec *= 10;
+	if (f[2]) return strptime(s, f + 2, tm);
+	return (char *)s;
+}
+'''
+
+def _c_bytes(b):
+	return ', '.join('0x%02x' % (c,) for c in bytearray(b))
+
 noneval_data = r'''
 // These are signaling NaNs with extra DEADness in the significand
-static const unsigned char noneval_float64[8] = {0xde, 0xad, 0xde, 0xad, 0xde, 0xad, 0xf0, 0xff};
-static const unsigned char noneval_float32[4] = {0xde, 0xad, 0x80, 0xff};
+static const unsigned char noneval_float64[8] = {%s};
+static const unsigned char noneval_float32[4] = {%s};
 
 // The smallest value is one less than -biggest, so that seems like a good signal value.
 static const int64_t noneval_int64 = INT64_MIN;
@@ -333,12 +446,11 @@ static const uint64_t noneval_time = 0;
 static const uint32_t noneval_date = 0;
 
 static const uint8_t noneval_bool = 255;
-'''
+''' % (_c_bytes(sourcedata.noneval_float64), _c_bytes(sourcedata.noneval_float32),)
 
 ConvTuple = namedtuple('ConvTuple', 'size conv_code_str pyfunc')
 # Size is bytes per value, or 0 for newline separated.
-# Only one of conv_code_str or pyfunc needs to be specified, except
-# the date/time types always use the python_func when the format contains %f.
+# Only one of conv_code_str or pyfunc needs to be specified.
 # If conv_code_str is set, the destination type must exist in minmaxfuncs.
 convfuncs = {
 	'float64'      : ConvTuple(8, _c_conv_float_template % dict(type='double', func='strtod', whole=1), float),
@@ -0,0 +1,160 @@
+############################################################################
+#                                                                          #
+# Copyright (c) 2017 eBay Inc.                                             #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#  http://www.apache.org/licenses/LICENSE-2.0                              #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+#                                                                          #
+############################################################################
+
+# Support function for putting files together.
+# Used by methods that produce per slice files and want one file.
+
+from __future__ import division
+from __future__ import absolute_import
+
+import cffi
+
+__all__ = ('concat',)
+
+ffi = cffi.FFI()
+ffi.cdef('''
+int concat_files(const char *dst_fn, const int count, const char *src_fns[], const int threads);
+''')
+backend = ffi.verify(r'''
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <errno.h>
+#include <pthread.h>
+#include <unistd.h>
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <sys/syscall.h>
+#include <fcntl.h>
+
+#define err1(v) if (v) goto err
+
+typedef struct {
+	int dst_fd;
+	int count;
+	int step;
+	int first;
+	const char **src_fns;
+	const off_t *offsets;
+	int res;
+} job_t;
+
+// pread/pwrite copy, for when the kernel can't do it for us.
+static int copy_fallback(const int src_fd, off_t src_pos, const int dst_fd, off_t dst_pos, off_t len)
+{
+	const size_t bufsize = 1024 * 1024;
+	char *buf = malloc(bufsize);
+	if (!buf) return 1;
+	while (len) {
+		const ssize_t got = pread(src_fd, buf, len < (off_t)bufsize ? len : (off_t)bufsize, src_pos);
+		if (got <= 0) break;
+		ssize_t done = 0;
+		while (done < got) {
+			const ssize_t put = pwrite(dst_fd, buf + done, got - done, dst_pos + done);
+			if (put <= 0) goto err;
+			done += put;
+		}
+		src_pos += got;
+		dst_pos += got;
+		len -= got;
+	}
+err:
+	free(buf);
+	return len != 0;
+}
+
+static int copy_one(const char *src_fn, const int dst_fd, off_t dst_pos, const off_t len)
+{
+	const int src_fd = open(src_fn, O_RDONLY);
+	if (src_fd < 0) return 1;
+	off_t src_pos = 0;
+#ifdef SYS_copy_file_range
+	// Data never goes through user space, and some filesystems don't copy it at all.
+	while (src_pos < len) {
+		loff_t in_pos = src_pos, out_pos = dst_pos;
+		const ssize_t got = syscall(SYS_copy_file_range, src_fd, &in_pos, dst_fd, &out_pos, (size_t)(len - src_pos), 0);
+		if (got <= 0) break; // let the fallback deal with it (or fail)
+		src_pos += got;
+		dst_pos += got;
+	}
+#endif
+	const int res = copy_fallback(src_fd, src_pos, dst_fd, dst_pos, len - src_pos);
+	close(src_fd);
+	return res;
+}
+
+static void *copy_thread(void *job_)
+{
+	job_t *job = job_;
+	for (int i = job->first; i < job->count; i += job->step) {
+		if (copy_one(job->src_fns[i], job->dst_fd, job->offsets[i], job->offsets[i + 1] - job->offsets[i])) {
+			job->res = 1;
+			break;
+		}
+	}
+	return 0;
+}
+
+int concat_files(const char *dst_fn, const int count, const char *src_fns[], const int threads)
+{
+	int res = 1;
+	off_t offsets[count + 1];
+	pthread_t tids[threads];
+	job_t jobs[threads];
+	int started = 0;
+	offsets[0] = 0;
+	for (int i = 0; i < count; i++) {
+		struct stat st;
+		if (stat(src_fns[i], &st)) return 1;
+		offsets[i + 1] = offsets[i] + st.st_size;
+	}
+	const int dst_fd = open(dst_fn, O_WRONLY | O_CREAT | O_TRUNC, 0666);
+	if (dst_fd < 0) return 1;
+	// Full size first, so all parts can be written at their offsets at once.
+	err1(ftruncate(dst_fd, offsets[count]));
+	for (int i = 0; i < threads; i++) {
+		jobs[i].dst_fd = dst_fd;
+		jobs[i].count = count;
+		jobs[i].step = threads;
+		jobs[i].first = i;
+		jobs[i].src_fns = src_fns;
+		jobs[i].offsets = offsets;
+		jobs[i].res = 0;
+		err1(pthread_create(tids + i, 0, copy_thread, jobs + i));
+		started++;
+	}
+	res = 0;
+err:
+	for (int i = 0; i < started; i++) {
+		pthread_join(tids[i], 0);
+		if (jobs[i].res) res = 1;
+	}
+	if (close(dst_fd)) res = 1;
+	return res;
+}
+''', libraries=['pthread'], extra_compile_args=['-std=gnu99'])
+
+
+def concat(dst_fn, src_fns, threads=16):
+	"""Make dst_fn the concatenation of src_fns.
+	The result is presized, and the sources are copied directly to their
+	offsets in parallel. The copying uses copy_file_range where possible."""
+	src_fns = [ffi.new('char []', fn.encode('utf-8')) for fn in src_fns]
+	threads = max(min(threads, len(src_fns)), 1)
+	res = backend.concat_files(dst_fn.encode('utf-8'), len(src_fns), src_fns, threads)
+	assert not res, "Failed to concatenate files into " + dst_fn
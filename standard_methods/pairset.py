@@ -0,0 +1,522 @@
+############################################################################
+#                                                                          #
+# Copyright (c) 2017 eBay Inc.                                             #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#  http://www.apache.org/licenses/LICENSE-2.0                              #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+#                                                                          #
+############################################################################
+
+# Support functions for compact sets of (key, value) pairs.
+# Used by columnpair_to_set (flavour=compact), and by anything that wants
+# to look things up in the result of that.
+#
+# A pairset file has the distinct keys sorted, and for each key the sorted
+# ids of its values in a table of the distinct values. It is used through
+# mmap, so opening one is quick however large it is, and lookups only
+# touch the pages they need.
+#
+# Layout (little endian):
+#   header         PAIRSET1, key kind, value kind, n_keys, n_values, n_pairs
+#   key_offsets    uint64 * (n_keys + 1)    into key_data
+#   pair_start     uint64 * (n_keys + 1)    into value_ids
+#   value_offsets  uint64 * (n_values + 1)  into value_data
+#   value_ids      uint32 * n_pairs
+#   key_data       encoded keys
+#   value_data     encoded values
+#
+# Keys and values are encoded as a byte that is 0 for None and 1 for
+# anything else, followed by the value (see kinds). They are sorted as
+# encoded, which is not necessarily the natural order of the values.
+
+from __future__ import division
+from __future__ import absolute_import
+
+import os
+import cffi
+import mmap
+from array import array
+from heapq import merge as heap_merge
+from itertools import groupby
+from operator import itemgetter
+from struct import Struct, error as StructError
+
+from extras import full_filename, FileWriteMove
+from . import file_concat
+
+__all__ = ('kind_for_type', 'Builder', 'merge', 'load', 'PairSet',)
+
+ffi = cffi.FFI()
+ffi.cdef('''
+int64_t finish_pairs(uint64_t *pairs, const int64_t count, const uint32_t *key_map, const uint32_t *value_map, uint8_t *key_used, uint8_t *value_used);
+void split_pairs(const uint64_t *pairs, const int64_t count, const uint32_t *key_map, const uint32_t *value_map, const uint64_t n_keys, uint64_t *pair_start, uint32_t *value_ids);
+void mark_values(const uint32_t *value_ids, const uint64_t *pair_start, const uint64_t n_keys, const uint8_t *key_keep, const uint8_t *value_keep, uint8_t *value_used);
+''')
+backend = ffi.verify(r'''
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+
+#define DROP UINT32_MAX
+
+static int cmp_u64(const void *a_, const void *b_)
+{
+	const uint64_t a = *(const uint64_t *)a_;
+	const uint64_t b = *(const uint64_t *)b_;
+	return (a > b) - (a < b);
+}
+
+// Pairs are key id << 32 | value id. Renumber them (dropping those mapped
+// to DROP), sort, remove duplicates and note which keys and values are left.
+int64_t finish_pairs(uint64_t *pairs, const int64_t count, const uint32_t *key_map, const uint32_t *value_map, uint8_t *key_used, uint8_t *value_used)
+{
+	int64_t len = 0;
+	for (int64_t i = 0; i < count; i++) {
+		const uint32_t k = key_map[pairs[i] >> 32];
+		const uint32_t v = value_map[pairs[i] & 0xffffffff];
+		if (k == DROP || v == DROP) continue;
+		pairs[len++] = (uint64_t)k << 32 | v;
+	}
+	qsort(pairs, len, 8, cmp_u64);
+	int64_t res = 0;
+	for (int64_t i = 0; i < len; i++) {
+		if (res && pairs[res - 1] == pairs[i]) continue;
+		pairs[res++] = pairs[i];
+		key_used[pairs[i] >> 32] = 1;
+		value_used[pairs[i] & 0xffffffff] = 1;
+	}
+	return res;
+}
+
+// Renumber (in the same order) and split into pair_start and value_ids.
+void split_pairs(const uint64_t *pairs, const int64_t count, const uint32_t *key_map, const uint32_t *value_map, const uint64_t n_keys, uint64_t *pair_start, uint32_t *value_ids)
+{
+	uint64_t key = 0;
+	pair_start[0] = 0;
+	for (int64_t i = 0; i < count; i++) {
+		const uint32_t k = key_map[pairs[i] >> 32];
+		while (key < k) pair_start[++key] = i;
+		value_ids[i] = value_map[pairs[i] & 0xffffffff];
+	}
+	while (key < n_keys) pair_start[++key] = count;
+}
+
+// Note which of the kept values are in a pair with a kept key (in a pairset file).
+void mark_values(const uint32_t *value_ids, const uint64_t *pair_start, const uint64_t n_keys, const uint8_t *key_keep, const uint8_t *value_keep, uint8_t *value_used)
+{
+	for (uint64_t k = 0; k < n_keys; k++) {
+		if (!key_keep[k]) continue;
+		for (uint64_t i = pair_start[k]; i < pair_start[k + 1]; i++) {
+			const uint32_t v = value_ids[i];
+			if (value_keep[v]) value_used[v] = 1;
+		}
+	}
+}
+''', extra_compile_args=['-std=c99'])
+
+DROP = 0xffffffff
+
+_header = Struct('<8s8s8sQQQ')
+_u64 = Struct('<Q')
+_u64x2 = Struct('<QQ')
+_u32 = Struct('<I')
+_int = Struct('>Q')
+_float = Struct('>d')
+
+# kind: (encode, decode) of values that are not None.
+# ints are stored so they sort in numeric order.
+kinds = {
+	'bytes'  : (lambda v: v, lambda b: b,),
+	'unicode': (lambda v: v.encode('utf-8'), lambda b: b.decode('utf-8'),),
+	'int'    : (lambda v: _int.pack(v + 0x8000000000000000), lambda b: _int.unpack(b)[0] - 0x8000000000000000,),
+	'uint'   : (lambda v: _int.pack(v), lambda b: _int.unpack(b)[0],),
+	'bool'   : (lambda v: b'\1' if v else b'\0', lambda b: b == b'\1',),
+	'float'  : (lambda v: _float.pack(v), lambda b: _float.unpack(b)[0],),
+}
+
+_type2kind = {
+	'ascii'  : 'bytes',
+	'bytes'  : 'bytes',
+	'unicode': 'unicode',
+	'int64'  : 'int',
+	'int32'  : 'int',
+	'bits64' : 'uint',
+	'bits32' : 'uint',
+	'bool'   : 'bool',
+	'float64': 'float',
+	'float32': 'float',
+}
+
+def kind_for_type(typename):
+	"""The kind to store values from a column of type typename as"""
+	assert typename in _type2kind, "Can't store %s values in a pairset" % (typename,)
+	return _type2kind[typename]
+
+def _encoder(kind):
+	encode = kinds[kind][0]
+	def enc(v):
+		if v is None:
+			return b'\0'
+		return b'\1' + encode(v)
+	return enc
+
+def _decoder(kind):
+	decode = kinds[kind][1]
+	def dec(b):
+		if b == b'\0':
+			return None
+		return decode(b[1:])
+	return dec
+
+def _lookup_encode(encode, v):
+	"""encode(v), or None if v can't be of this kind (so it isn't there)"""
+	try:
+		return encode(v)
+	except (TypeError, AttributeError, ValueError, StructError,):
+		return None
+
+def _sort_map(encoded):
+	"""uint32 array mapping ids to their position when sorted by encoded"""
+	res = array('I', [0]) * len(encoded)
+	for pos, ix in enumerate(sorted(range(len(encoded)), key=encoded.__getitem__)):
+		res[ix] = pos
+	return res
+
+def _compact_map(used):
+	"""uint32 array mapping positions to their position among the used ones (DROP for unused)"""
+	res = array('I', [DROP]) * len(used)
+	pos = 0
+	for ix, u in enumerate(used):
+		if u:
+			res[ix] = pos
+			pos += 1
+	return res
+
+def _ptr(typ, a):
+	return ffi.cast(typ + ' *', ffi.from_buffer(a))
+
+
+class Builder(object):
+	"""Collects (key, value) pairs and saves them as a pairset file.
+	Only the distinct keys and values are kept as python objects, the
+	pairs take 8 bytes each."""
+
+	def __init__(self, key_kind, value_kind):
+		assert key_kind in kinds and value_kind in kinds
+		self.key_kind = key_kind
+		self.value_kind = value_kind
+		self.key_ids = {}
+		self.value_ids = {}
+		self.pairs = array('L')
+		assert self.pairs.itemsize == 8
+
+	def _id(self, d, v):
+		res = d.get(v)
+		if res is None:
+			res = d[v] = len(d)
+			assert res < DROP, "Too many distinct values for a pairset"
+		return res
+
+	def add(self, key, value):
+		self.pairs.append(self._id(self.key_ids, key) << 32 | self._id(self.value_ids, value))
+
+	def update(self, iterable):
+		key_ids, value_ids, append = self.key_ids, self.value_ids, self.pairs.append
+		_id = self._id
+		for key, value in iterable:
+			append(_id(key_ids, key) << 32 | _id(value_ids, value))
+
+	def save(self, filename='result', sliceno=None, temp=None):
+		"""Write a pairset file (like blob.save) and return its filename.
+		The builder can't be used after this."""
+		filename = full_filename(filename, '.pairset', sliceno)
+		def encoded_by_id(d, kind):
+			enc = _encoder(kind)
+			res = [None] * len(d)
+			for v, ix in d.iteritems():
+				res[ix] = enc(v)
+			return res
+		keys = encoded_by_id(self.key_ids, self.key_kind)
+		values = encoded_by_id(self.value_ids, self.value_kind)
+		key_used = array('B', [0]) * len(keys)
+		value_used = array('B', [0]) * len(values)
+		pairs = self.pairs
+		# (The pointers don't keep the arrays alive.)
+		key_order = _sort_map(keys)
+		value_order = _sort_map(values)
+		n_pairs = backend.finish_pairs(
+			_ptr('uint64_t', pairs), len(pairs),
+			_ptr('uint32_t', key_order), _ptr('uint32_t', value_order),
+			_ptr('uint8_t', key_used), _ptr('uint8_t', value_used),
+		)
+		del pairs[n_pairs:]
+		keys.sort()
+		values.sort()
+		key_map = _compact_map(key_used)
+		value_map = _compact_map(value_used)
+		keys = [k for k, u in zip(keys, key_used) if u]
+		values = [v for v, u in zip(values, value_used) if u]
+		pair_start = array('L', [0]) * (len(keys) + 1)
+		value_ids = array('I', [0]) * n_pairs
+		backend.split_pairs(
+			_ptr('uint64_t', pairs), n_pairs,
+			_ptr('uint32_t', key_map), _ptr('uint32_t', value_map),
+			len(keys),
+			_ptr('uint64_t', pair_start),
+			_ptr('uint32_t', value_ids),
+		)
+		def offsets(encoded):
+			res = array('L', [0]) * (len(encoded) + 1)
+			pos = 0
+			for ix, v in enumerate(encoded):
+				pos += len(v)
+				res[ix + 1] = pos
+			return res
+		with FileWriteMove(filename, temp) as fh:
+			fh.write(_header.pack(b'PAIRSET1', self.key_kind.encode('ascii'), self.value_kind.encode('ascii'), len(keys), len(values), n_pairs))
+			offsets(keys).tofile(fh)
+			pair_start.tofile(fh)
+			offsets(values).tofile(fh)
+			value_ids.tofile(fh)
+			fh.write(b''.join(keys))
+			fh.write(b''.join(values))
+		return filename
+
+
+def merge(sources, filename='result', sliceno=None, temp=None, key_filter=None, value_filter=None):
+	"""Merge the PairSets in sources into a new pairset file (like
+	Builder.save, but without building). Keys and values are merged in
+	sorted order straight from the sources, so only the value id maps
+	(4 bytes per value in each source) are kept in memory.
+	With key_filter and/or value_filter only pairs with a key/value in
+	that are kept."""
+	assert sources, "Nothing to merge"
+	key_kind, value_kind = sources[0].key_kind, sources[0].value_kind
+	for ps in sources:
+		assert (ps.key_kind, ps.value_kind) == (key_kind, value_kind), "Pairset kinds don't match"
+	filename = full_filename(filename, '.pairset', sliceno)
+	names = ('header', 'key_offsets', 'pair_start', 'value_offsets', 'value_ids', 'key_data', 'value_data',)
+	parts = [filename + '.' + name for name in names]
+	fhs = dict(zip(names, (open(fn, 'wb') for fn in parts)))
+	write_u64 = lambda name, v: fhs[name].write(_u64.pack(v))
+
+	def encoded_filter(filter, kind):
+		if filter is not None:
+			encode = _encoder(kind)
+			return set(e for e in (_lookup_encode(encode, v) for v in filter) if e is not None)
+	key_filter = encoded_filter(key_filter, key_kind)
+	value_filter = encoded_filter(value_filter, value_kind)
+	if key_filter is None and value_filter is None:
+		key_keeps = value_useds = [None] * len(sources)
+	else:
+		# Which keys are kept, and which values are still in a pair with one.
+		key_keeps = []
+		value_useds = []
+		for ps in sources:
+			key_keep = array('B', [key_filter is None or ps._key(ix) in key_filter for ix in range(ps.n_keys)])
+			value_keep = array('B', [value_filter is None or ps._value(ix) in value_filter for ix in range(ps.n_values)])
+			value_used = array('B', [0]) * ps.n_values
+			if ps.n_keys and ps.n_values:
+				backend.mark_values(
+					_ptr('uint32_t', ps._mm) + ps._ids_pos // 4,
+					_ptr('uint64_t', ps._mm) + ps._pair_start_pos // 8,
+					ps.n_keys,
+					_ptr('uint8_t', key_keep),
+					_ptr('uint8_t', value_keep),
+					_ptr('uint8_t', value_used),
+				)
+			key_keeps.append(key_keep)
+			value_useds.append(value_used)
+
+	def encoded_values(six, ps):
+		used = value_useds[six]
+		for ix in range(ps.n_values):
+			if used is None or used[ix]:
+				yield ps._value(ix), six, ix
+	value_maps = [array('I', [DROP]) * ps.n_values for ps in sources]
+	n_values = pos = 0
+	write_u64('value_offsets', 0)
+	for v, items in groupby(heap_merge(*[encoded_values(six, ps) for six, ps in enumerate(sources)]), itemgetter(0)):
+		for _, six, ix in items:
+			value_maps[six][ix] = n_values
+		fhs['value_data'].write(v)
+		pos += len(v)
+		write_u64('value_offsets', pos)
+		n_values += 1
+
+	def encoded_keys(six, ps):
+		keep = key_keeps[six]
+		for ix in range(ps.n_keys):
+			if keep is None or keep[ix]:
+				yield ps._key(ix), six, ix
+	n_keys = pos = n_pairs = 0
+	write_u64('key_offsets', 0)
+	write_u64('pair_start', 0)
+	for k, items in groupby(heap_merge(*[encoded_keys(six, ps) for six, ps in enumerate(sources)]), itemgetter(0)):
+		ids = set()
+		for _, six, ix in items:
+			ps, value_map = sources[six], value_maps[six]
+			a, b = ps._pair_range(ix)
+			src_ids = array('I')
+			src_ids.fromstring(ps._mm[ps._ids_pos + a * 4:ps._ids_pos + b * 4])
+			ids.update(value_map[vid] for vid in src_ids)
+		ids.discard(DROP)
+		if not ids: # all its values were filtered out
+			continue
+		# value ids are in value order, so sorted ids are sorted values.
+		array('I', sorted(ids)).tofile(fhs['value_ids'])
+		n_pairs += len(ids)
+		write_u64('pair_start', n_pairs)
+		fhs['key_data'].write(k)
+		pos += len(k)
+		write_u64('key_offsets', pos)
+		n_keys += 1
+
+	fhs['header'].write(_header.pack(b'PAIRSET1', key_kind.encode('ascii'), value_kind.encode('ascii'), n_keys, n_values, n_pairs))
+	for fh in fhs.values():
+		fh.close()
+	fwm = FileWriteMove(filename, temp)
+	with fwm:
+		file_concat.concat(fwm.tmp_filename, parts)
+	for fn in parts:
+		os.unlink(fn)
+	return filename
+
+
+def load(filename='result', jobid='', sliceno=None):
+	"""Open a pairset file (like blob.load, but doesn't read it)"""
+	return PairSet(full_filename(filename, '.pairset', sliceno, jobid))
+
+
+class PairSet(object):
+	"""A pairset file through mmap. Works like a read only dict of sets,
+	and also has contains(key, value)."""
+
+	def __init__(self, filename):
+		with open(filename, 'rb') as fh:
+			self._mm = mmap.mmap(fh.fileno(), 0, prot=mmap.PROT_READ)
+		magic, key_kind, value_kind, self.n_keys, self.n_values, self.n_pairs = _header.unpack_from(self._mm, 0)
+		assert magic == b'PAIRSET1', filename + " is not a pairset file"
+		self.key_kind = key_kind.rstrip(b'\0').decode('ascii')
+		self.value_kind = value_kind.rstrip(b'\0').decode('ascii')
+		self._encode_key = _encoder(self.key_kind)
+		self._encode_value = _encoder(self.value_kind)
+		self._decode_key = _decoder(self.key_kind)
+		self._decode_value = _decoder(self.value_kind)
+		self._key_offsets_pos = _header.size
+		self._pair_start_pos = self._key_offsets_pos + (self.n_keys + 1) * 8
+		self._value_offsets_pos = self._pair_start_pos + (self.n_keys + 1) * 8
+		self._ids_pos = self._value_offsets_pos + (self.n_values + 1) * 8
+		self._key_data_pos = self._ids_pos + self.n_pairs * 4
+		self._value_data_pos = self._key_data_pos + _u64.unpack_from(self._mm, self._key_offsets_pos + self.n_keys * 8)[0]
+
+	def close(self):
+		self._mm.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+	def __len__(self):
+		return self.n_keys
+
+	def _key(self, ix):
+		a, b = _u64x2.unpack_from(self._mm, self._key_offsets_pos + ix * 8)
+		return self._mm[self._key_data_pos + a:self._key_data_pos + b]
+
+	def _value(self, ix):
+		a, b = _u64x2.unpack_from(self._mm, self._value_offsets_pos + ix * 8)
+		return self._mm[self._value_data_pos + a:self._value_data_pos + b]
+
+	def _value_id(self, pos):
+		return _u32.unpack_from(self._mm, self._ids_pos + pos * 4)[0]
+
+	def _pair_range(self, ix):
+		return _u64x2.unpack_from(self._mm, self._pair_start_pos + ix * 8)
+
+	def _find_key(self, key):
+		"""index of key, or None"""
+		want = _lookup_encode(self._encode_key, key)
+		if want is None:
+			return None
+		lo, hi = 0, self.n_keys
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self._key(mid) < want:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo < self.n_keys and self._key(lo) == want:
+			return lo
+
+	def __contains__(self, key):
+		return self._find_key(key) is not None
+
+	def contains(self, key, value):
+		ix = self._find_key(key)
+		if ix is None:
+			return False
+		want = _lookup_encode(self._encode_value, value)
+		if want is None:
+			return False
+		lo, hi = self._pair_range(ix)
+		end = hi
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self._value(self._value_id(mid)) < want:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo < end and self._value(self._value_id(lo)) == want
+
+	def _values_for(self, ix):
+		a, b = self._pair_range(ix)
+		return set(self._decode_value(self._value(self._value_id(pos))) for pos in range(a, b))
+
+	def __getitem__(self, key):
+		ix = self._find_key(key)
+		if ix is None:
+			raise KeyError(key)
+		return self._values_for(ix)
+
+	def get(self, key, default=None):
+		ix = self._find_key(key)
+		if ix is None:
+			return default
+		return self._values_for(ix)
+
+	def __iter__(self):
+		decode = self._decode_key
+		for ix in range(self.n_keys):
+			yield decode(self._key(ix))
+
+	def keys(self):
+		return list(self)
+
+	def values(self):
+		"""All distinct values, in the order of their ids"""
+		decode = self._decode_value
+		return [decode(self._value(ix)) for ix in range(self.n_values)]
+
+	def iteritems(self):
+		values = self.values()
+		for ix, key in enumerate(self):
+			a, b = self._pair_range(ix)
+			yield key, set(values[_u32.unpack_from(self._mm, self._ids_pos + pos * 4)[0]] for pos in range(a, b))
+
+	def set_sizes(self):
+		"""The number of values for each key"""
+		starts = array('L')
+		starts.fromstring(self._mm[self._pair_start_pos:self._value_offsets_pos])
+		return [b - a for a, b in zip(starts, starts[1:])]